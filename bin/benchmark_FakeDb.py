@@ -0,0 +1,99 @@
+#!/usr/bin/python
+usage = "benchmark_FakeDb.py [--options]"
+description = "times iterating over every event with FakeDb.events() so we can see what serializing FakeTTPResponse bodies lazily buys us"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import shutil
+import tempfile
+
+import time
+
+import json
+
+from ligoTest.gracedb.rest import FakeDb
+
+import simUtils as utils
+
+import pipelines
+import schedule
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true')
+
+parser.add_option('-N', '--Nevents', default=100, type='int', help='the number of events we create before timing anything')
+parser.add_option('-n', '--Ncalls', default=1000, type='int', help='the number of calls we time for each benchmark')
+
+parser.add_option('', '--group', default='Test', type='string')
+parser.add_option('', '--pipeline', default='LIB', type='string')
+parser.add_option('', '--search', default=None, type='string')
+
+parser.add_option('', '--storage', default='pickle', type='string', help='the storage backend used by FakeDb')
+
+parser.add_option('-f', '--fakeDB-dir', default=None, type='string', help='DEFAULT: a temporary directory that is removed when we finish')
+parser.add_option('-o', '--output-dir', default=None, type='string', help='where we write files needed to create events. DEFAULT: a temporary directory that is removed when we finish')
+
+opts, args = parser.parse_args()
+
+cleanup = []
+if opts.fakeDB_dir is None:
+    opts.fakeDB_dir = tempfile.mkdtemp()
+    cleanup.append( opts.fakeDB_dir )
+if opts.output_dir is None:
+    opts.output_dir = tempfile.mkdtemp()
+    cleanup.append( opts.output_dir )
+
+#-------------------------------------------------
+
+def benchmark(name, foo, graceids, Ncalls):
+    '''
+    calls foo(graceid) Ncalls times, cycling through graceids, and reports the average time per call
+    '''
+    t0 = time.time()
+    for i in xrange(Ncalls):
+        foo( graceids[i%len(graceids)] )
+    dt = (time.time()-t0)/Ncalls
+
+    print "%-50s : %.3e sec/call"%(name, dt)
+    return dt
+
+#-------------------------------------------------
+
+### we disable the in-process cache so that we time what each code path costs when it has to go to disk
+gdb = FakeDb(opts.fakeDB_dir, storage=opts.storage, cache_entries=0)
+
+if opts.verbose:
+    print "creating %d events in : %s"%(opts.Nevents, opts.fakeDB_dir)
+
+gps = time.time() - 315964800 ### close enough to "now" in gps seconds for our purposes
+filename = None
+graceids = []
+for x in xrange(opts.Nevents):
+    if filename is None: ### we only need one file to create as many events as we like
+        gDBevent = schedule.GraceDBEvent(utils.genRandStr())
+        pipeObj = pipelines.initPipeline( gps, 1e-9, ['H1','L1'], opts.group, opts.pipeline, gDBevent, search=opts.search, gdb_url=opts.fakeDB_dir )
+        filename, _ = pipeObj.genFiles(directory=opts.output_dir)
+
+    graceids.append( gdb.createEvent( opts.group, opts.pipeline, filename, search=opts.search ).json()['graceid'] )
+
+#-------------------------------------------------
+
+print "\niterating over every event"
+
+### FakeTTPResponse used to serialize its data when it was built and parse it again within json(), which we mimic with an explicit round-trip
+Nevents = max(1, opts.Ncalls/100)
+old = benchmark( 'events() with a json round-trip per event', lambda graceid: [json.loads(json.dumps(event)) for event in gdb.events()], graceids, Nevents )
+new = benchmark( 'events()', lambda graceid: list(gdb.events()), graceids, Nevents )
+
+print "speed-up : %.1f"%(old/new)
+
+#-------------------------------------------------
+
+for directory in cleanup:
+    shutil.rmtree(directory)
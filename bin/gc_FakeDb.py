@@ -0,0 +1,57 @@
+#!/usr/bin/python
+usage = "gc_FakeDb.py [--options] fakeDB_dir"
+description = "removes old events (along with lvalert messages, uploaded files and cached attributes that only they refer to) from a FakeDb directory until it is within the requested limits. This may run while other processes read and write fakeDB_dir"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import time
+
+from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb.retention import Retention
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true')
+
+parser.add_option('', '--max-age', default=None, type='float', help='remove events created more than this many seconds ago')
+parser.add_option('', '--max-events', default=None, type='int', help='remove the oldest events until no more than this many remain')
+parser.add_option('', '--max-bytes', default=None, type='int', help='remove the oldest events until fakeDB_dir holds no more than this many bytes')
+
+parser.add_option('', '--segment-bytes', default=2**26, type='int', help='move lvalert.out into a numbered segment once it grows beyond this many bytes, so old alerts can be removed. DEFAULT=%d'%2**26)
+parser.add_option('', '--grace', default=60., type='float', help='never remove anything written within this many seconds. DEFAULT=60')
+parser.add_option('', '--batch', default=100, type='int', help='the number of events removed together. DEFAULT=100')
+
+parser.add_option('-i', '--interval', default=0, type='float', help='repeat every this many seconds. If 0, we only run once. DEFAULT=0')
+
+opts, args = parser.parse_args()
+
+if len(args)!=1:
+    raise ValueError('please supply exactly one input argument\n%s'%usage)
+fakeDB_dir = args[0]
+
+if (opts.max_age is None) and (opts.max_events is None) and (opts.max_bytes is None):
+    raise ValueError('please supply at least one of --max-age, --max-events, --max-bytes\n%s'%usage)
+
+#-------------------------------------------------
+
+gdb = FakeDb(fakeDB_dir)
+retention = Retention(max_age=opts.max_age, max_events=opts.max_events, max_bytes=opts.max_bytes, segment_bytes=opts.segment_bytes, grace=opts.grace, batch=opts.batch)
+
+while True:
+    t0 = time.time()
+    summary = retention.collect(gdb)
+    if opts.verbose:
+        print "removed %(events)d events and %(segments)d lvalert.out segments"%summary
+        print "freed ~%(bytes)d bytes (blobs: %(blobs)d, parsed: %(parsed)d, indexes: %(indexes)d)"%summary
+        print "%d events remain (%.3f sec)"%(gdb.numEvents(), time.time()-t0)
+
+    if not opts.interval:
+        break
+    wait = opts.interval - (time.time()-t0)
+    if wait > 0:
+        time.sleep(wait)
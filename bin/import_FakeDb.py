@@ -0,0 +1,54 @@
+#!/usr/bin/python
+usage = "import_FakeDb.py [--options] fakeDB_dir dump.jsonl [dump.jsonl ...]"
+description = "imports events dumped from GraceDb into a FakeDb directory without sending any lvalert messages. Each line of each dump is a JSON object with keys event, logs, labels and files (what GraceDb.event, GraceDb.logs, GraceDb.labels and GraceDb.files returned). Dumps ending in \".gz\" are decompressed and \"-\" is read from stdin"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import json
+
+import time
+import itertools
+
+from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb.dumps import iterDumps
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true')
+
+parser.add_option('-b', '--batch', default=1000, type='int', help='the number of events stored together. DEFAULT=1000')
+parser.add_option('', '--files-dir', default=None, type='string', help='copy uploaded files from FILES_DIR/<original graceid>/<filename> if they exist. Otherwise, no files are imported')
+parser.add_option('', '--map', default=None, type='string', help='write a JSON dictionary mapping original graceids to the new ones into this file')
+
+parser.add_option('', '--storage', default=None, type='string', help='how FakeDb stores data. Either "pickle", "journal", or "sqlite". Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--layout', default=None, type='string', help='how FakeDb arranges event directories. Either "flat" or "sharded". Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--dedup', default=None, action='store_true', help='store each distinct uploaded file once and hardlink it into event directories. Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--durability', default=None, type='string', help='when FakeDb forces what it writes onto disk. Either "none", "fsync", or "group". Must agree with whatever was used when the directory was first populated.')
+
+opts, args = parser.parse_args()
+
+if len(args)<2:
+    raise ValueError('please supply at least two input arguments\n%s'%usage)
+fakeDB_dir = args[0]
+paths = args[1:]
+
+#-------------------------------------------------
+
+gdb = FakeDb(fakeDB_dir, storage=opts.storage, layout=opts.layout, dedup=opts.dedup, durability=opts.durability, cache_entries=0) ### nothing we write is read back
+
+t0 = time.time()
+mapping = gdb.importEvents(itertools.chain(*[iterDumps(path) for path in paths]), batch=opts.batch, files_dir=opts.files_dir)
+dt = time.time()-t0
+
+if opts.verbose:
+    print "imported %d events in %.3f sec (%.1f events/sec)"%(len(mapping), dt, len(mapping)/dt if dt>0 else 0)
+
+if opts.map:
+    file_obj = open(opts.map, 'w')
+    json.dump(mapping, file_obj)
+    file_obj.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+usage = "migrate_FakeDb.py [--options] fakeDB_dir"
+description = "moves the event directories within a FakeDb directory into a new layout (eg: flat -> sharded) and updates every reference to them. This should only be run while nothing else is writing to fakeDB_dir"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import re
+
+import json
+
+from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb.storage import initStorage
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true')
+
+parser.add_option('-l', '--layout', default='sharded', type='string', help='the layout we migrate into. DEFAULT="sharded"')
+
+opts, args = parser.parse_args()
+
+if len(args)!=1:
+    raise ValueError('please supply exactly one input argument\n%s'%usage)
+fakeDB_dir = args[0]
+
+#-------------------------------------------------
+
+def relink(stuff, old, new):
+    '''
+    replace the path component(s) old with new within every path contained in stuff.
+    we only touch old where it follows a separator, so bare graceids (eg: toplevel['graceid']) are left alone
+    '''
+    if isinstance(stuff, basestring):
+        return re.sub('(?<=%s)%s(?=%s|$)'%(re.escape(os.sep), re.escape(old), re.escape(os.sep)), new, stuff)
+    elif isinstance(stuff, dict):
+        return dict((key, relink(val, old, new)) for key, val in stuff.items())
+    elif isinstance(stuff, list):
+        return [relink(val, old, new) for val in stuff]
+    return stuff
+
+#-------------------------------------------------
+
+gdb = FakeDb(fakeDB_dir) ### creates fakedb.json if this directory pre-dates it
+
+file_obj = open(gdb.config, 'r')
+config = json.load(file_obj)
+file_obj.close()
+
+if config['layout']==opts.layout:
+    if opts.verbose:
+        print "%s already uses layout=%s"%(fakeDB_dir, opts.layout)
+
+else:
+    old = gdb.storage
+    new = initStorage(config['storage'], fakeDB_dir, is_graceid=gdb.__is_graceid__, layout=opts.layout)
+
+    ### we record references to the new directory before moving it, so that re-running after an interruption picks up where we left off
+    for graceid in old.iterGraceids():
+        oldDir = old.directory(graceid)
+        newDir = new.directory(graceid)
+        if opts.verbose:
+            print "%s -> %s"%(oldDir, newDir)
+
+        oldRel = os.path.relpath(oldDir, fakeDB_dir)
+        newRel = os.path.relpath(newDir, fakeDB_dir)
+        for kind in ['toplevel']+old.collections:
+            if kind=='toplevel':
+                stuff = old.read(graceid)
+            else:
+                stuff = old.extract(graceid, kind)
+            old.replace(graceid, kind, relink(stuff, oldRel, newRel))
+
+        os.renames(oldDir, newDir) ### creates intermediate directories and prunes ones we leave empty
+
+    config['layout'] = opts.layout
+    file_obj = open(gdb.config, 'w')
+    json.dump(config, file_obj)
+    file_obj.close()
+
+    if opts.verbose:
+        print "%s now uses layout=%s"%(fakeDB_dir, opts.layout)
@@ -6,10 +6,13 @@ author = "reed.essick@ligo.org"
 #-------------------------------------------------
 
 import os
+import shutil
+import tempfile
 
 import random
 
 from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb.storage import storages
 
 import simUtils as utils
 
@@ -312,5 +315,115 @@ for graceid in sorted(graceids.keys()):
 #-------------------------------------------------
 
 ### query things about groups of events
-### events
-#raise NotImplementedError('need to set up queries over multiple events?')
+### every storage backend must answer the same queries in the same way, so we build a small, known set of events with each of them
+
+if opts.verbose:
+    print "\nchecking FakeDb.events() and FakeDb.numEvents()"
+
+queryEvents = [ ### (group, pipeline, gps, far, labels)
+    ('Test',  'LIB', 1177672330.5, 1e-8, ['EM_READY']),
+    ('Burst', 'LIB', 1177672340.5, 1e-6, ['ADVNO']),
+    ('Burst', 'CWB', 1177672350.5, 1e-9, ['EM_READY', 'H1OK']),
+    ('Test',  'CWB', 1177672360.5, 1e-5, []),
+]
+
+for storage in sorted(storages.keys()):
+    if opts.verbose:
+        print "  storage=%s"%storage
+
+    queryDir = tempfile.mkdtemp(dir=opts.output_dir)
+    try:
+        queryDB_dir = os.path.join(queryDir, 'fakeDB')
+        qdb = FakeDb(queryDB_dir, storage=storage) ### records the storage backend, so the Actions below use it too
+
+        gids = []
+        for group, pipeline, gps, far, eventLabels in queryEvents:
+            gDBevent = schedule.GraceDBEvent(utils.genRandStr())
+            pipeObj = pipelines.initPipeline( gps, far, ['H1','L1'], group, pipeline, gDBevent, gdb_url=queryDB_dir )
+            for action in pipeObj.genSchedule(directory=queryDir):
+                if isinstance(action, schedule.CreateEvent):
+                    action.execute()
+            gids.append( gDBevent.get_graceid() )
+            for label in eventLabels:
+                qdb.writeLabel( gids[-1], label )
+
+        ### query -> the indices (within queryEvents) of the events it should return
+        queries = [
+            ### what FakeDb.events has always understood
+            ('EM_READY',                                          [0, 2]),
+            ('EM_READY ADVNO',                                    [0, 1, 2]), ### consecutive labels are ORed
+            (gids[1],                                             [1]),
+            ('1177672330 .. 1177672331',                          [0]),
+            ('1177672330 .. 1177672331 1177672350 .. 1177672351', [0, 2]),    ### as are consecutive gps ranges
+            ('EM_READY 1177672330 .. 1177672345',                 [0]),
+            ('ADVNO %s'%gids[0],                                  []),
+            ### operators added with the query compiler
+            ('far < 1e-7',                                        [0, 2]),
+            ('far >= 1e-6',                                       [1, 3]),
+            ('gpstime: 1177672335 .. 1177672355',                 [1, 2]),
+            ('pipeline: cwb',                                     [2, 3]),
+            ('group: burst',                                      [1, 2]),
+            ('cwb far < 1e-7',                                    [2]),
+            ('%s .. %s'%(gids[0], gids[3]),                       [0, 3]),    ### both in the Test group, so they share a prefix
+            ('~EM_READY',                                         [1, 3]),
+            ('EM_READY & ~H1OK',                                  [0]),
+            ('(EM_READY | ADVNO) far < 1e-7',                     [0, 2]),
+        ]
+
+        for query, expected in queries:
+            found = sorted(event['graceid'] for event in qdb.events(query))
+            expected = sorted(gids[i] for i in expected)
+            assert found == expected, 'storage=%s query="%s" returned %s instead of %s'%(storage, query, found, expected)
+
+            num = qdb.numEvents(query)
+            assert num == len(found), 'storage=%s query="%s" numEvents=%d but events returned %d'%(storage, query, num, len(found))
+
+            if opts.Verbose:
+                print "    %s -> %s"%(query, found)
+
+        assert qdb.numEvents() == len(queryEvents), 'storage=%s numEvents=%d instead of %d'%(storage, qdb.numEvents(), len(queryEvents))
+
+        ### the recorded lvalert nodes and the storage backend's indexes must agree with what we find by reading every event
+        if opts.verbose:
+            print "    checking recorded nodes, orderby/count and the EM, EEL and tag searches against every event"
+
+        for graceid in gids:
+            node = FakeDb(queryDB_dir).__node__(graceid)
+            expected = qdb.__event2node__(qdb.event(graceid).json())
+            assert node == expected, 'storage=%s recorded node %s for %s instead of %s'%(storage, node, graceid, expected)
+
+        for orderby in ['created', '-created', 'gpstime', '-gpstime']:
+            found = [event['graceid'] for event in qdb.events(orderby=orderby, count=2, columns='graceid')]
+            key = orderby.strip('-')
+            expected = [event['graceid'] for event in sorted(qdb.events(), key=lambda event: event[key], reverse=orderby[0]=='-')][:2]
+            assert found == expected, 'storage=%s orderby="%s" returned %s instead of %s'%(storage, orderby, found, expected)
+
+        ras = [5., 20., 355., 180.]
+        decs = [0., 5., -5., 0.]
+        for graceid in gids[:2]:
+            qdb.writeEMObservation(graceid, 'Test', ras, [2.]*len(ras), decs, [2.]*len(decs), [1177672330.]*len(ras), [60.]*len(ras))
+        found = sorted((footprint['graceid'], footprint['N'], footprint['ra']) for footprint in qdb.searchEMObservations(ra=(350., 10.), dec=(-10., 10.)))
+        expected = sorted((graceid, observation['N'], footprint['ra']) for graceid in gids for observation in qdb.emobservations(graceid).json()['observations'] for footprint in observation['footprints'] if (abs((footprint['ra']+180.)%360.-180.) <= 10.+0.5*footprint['raWidth']) and (abs(footprint['dec']) <= 10.+0.5*footprint['decWidth']))
+        assert found == expected, 'storage=%s searchEMObservations returned %s instead of %s'%(storage, found, expected)
+
+        wavebands = ['em.radio', 'em.radio.3-6GHz', 'em.opt.R', 'em.X-ray']
+        for i, graceid in enumerate(gids):
+            for j in xrange(3):
+                qdb.writeEel(graceid, 'Test', wavebands[(i+j)%len(wavebands)], 'FO', 'OB')
+        found = [(eel['graceid'], eel['N']) for eel in qdb.searchEels(waveband='em.radio')]
+        expected = sorted(((eel['created'], graceid, eel['N']) for graceid in gids for eel in qdb.eels(graceid).json()['log'] if (eel['waveband']=='em.radio') or eel['waveband'].startswith('em.radio.')))
+        expected = [(graceid, N) for _, graceid, N in expected]
+        assert found == expected, 'storage=%s searchEels returned %s instead of %s'%(storage, found, expected)
+
+        tagged = dict((graceid, qdb.writeLogs(graceid, [('message', None, ['sky_loc', 'lvem'] if (i%2==0) and (j==0) else ['sky_loc']) for j in xrange(3)]).json()) for i, graceid in enumerate(gids))
+        qdb.deleteTag(gids[0], tagged[gids[0]][0]['N'], 'sky_loc')
+        qdb.createTag(gids[-1], tagged[gids[-1]][1]['N'], 'lvem')
+        found = [(log['graceid'], log['N']) for log in qdb.searchTags(['sky_loc', 'lvem'])]
+        expected = sorted((graceid, log['N']) for graceid in gids for log in qdb.logs(graceid).json()['log'] if ('sky_loc' in log['tag_names']) and ('lvem' in log['tag_names']))
+        assert found == expected, 'storage=%s searchTags returned %s instead of %s'%(storage, found, expected)
+
+    finally:
+        shutil.rmtree(queryDir)
+
+    if opts.verbose:
+        print "  passed all checks!"
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+usage = "serve_FakeDb.py [--options] fakeDB_dir"
+description = "serves a FakeDb directory over HTTP at the routes used by ligo.gracedb.rest.GraceDb. Point clients (or schedule.initGraceDb) at the url we print, eg: http://localhost:8000/api/"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+from ligoTest.gracedb.server import FakeDbServer
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true', help='log every request')
+
+parser.add_option('', '--host', default='localhost', type='string', help='DEFAULT="localhost"')
+parser.add_option('-p', '--port', default=8000, type='int', help='DEFAULT=8000')
+parser.add_option('-t', '--threads', default=16, type='int', help='the number of worker threads, which bounds the number of connections served at once. DEFAULT=16')
+
+parser.add_option('', '--fakedb-storage', default=None, type='string', help='how FakeDb stores data. Either "pickle", "journal", or "sqlite". Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--fakedb-layout', default=None, type='string', help='how FakeDb arranges event directories. Either "flat" or "sharded". Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--fakedb-dedup', default=None, action='store_true', help='store each distinct uploaded file once and hardlink it into event directories. Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--fakedb-durability', default=None, type='string', help='when FakeDb forces what it writes onto disk. Either "none", "fsync", or "group". Must agree with whatever was used when the directory was first populated.')
+parser.add_option('', '--fakedb-group-commit-window', default=None, type='float', help='how often (in seconds) FakeDb flushes writes when --fakedb-durability=group. Must agree with whatever was used when the directory was first populated.')
+
+parser.add_option('', '--fakedb-stats', default=False, action='store_true', help='count calls, latencies, bytes and lvalert messages, reported at /api/stats/')
+parser.add_option('', '--fakedb-metrics-file', default=None, type='string', help='periodically write what we have counted into this file as JSON. Implies --fakedb-stats')
+parser.add_option('', '--fakedb-metrics-interval', default=60., type='float', help='how often (in seconds) we write --fakedb-metrics-file. DEFAULT=60')
+
+opts, args = parser.parse_args()
+
+if len(args)!=1:
+    raise ValueError('please supply exactly one input argument\n%s'%usage)
+fakeDB_dir = args[0]
+
+#-------------------------------------------------
+
+server = FakeDbServer((opts.host, opts.port), fakeDB_dir, threads=opts.threads, verbose=opts.verbose, storage=opts.fakedb_storage, layout=opts.fakedb_layout, dedup=opts.fakedb_dedup, durability=opts.fakedb_durability, group_commit_window=opts.fakedb_group_commit_window, stats=opts.fakedb_stats, metrics_file=opts.fakedb_metrics_file, metrics_interval=opts.fakedb_metrics_interval)
+
+print("serving %s at %s"%(fakeDB_dir, server.url))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
@@ -15,6 +15,9 @@ import random
 import simUtils as utils
 import schedule
 
+from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb.retention import Retention, Collector
+
 from lal.gpstime import tconvert
 
 from ConfigParser import SafeConfigParser
@@ -40,6 +43,15 @@ parser.add_option("-p", "--pause", default=5, type="float", help="the amount of
 
 ### options about gracedb
 parser.add_option("-g", "--gracedb-url", default="https://gracedb.ligo.org/api/", type="string" )
+parser.add_option("", "--fakedb-storage", default=None, type="string", help="how FakeDb stores data if --gracedb-url is a path. Either \"pickle\", \"journal\", or \"sqlite\". Must agree with whatever was used when the directory was first populated.")
+parser.add_option("", "--fakedb-layout", default=None, type="string", help="how FakeDb arranges event directories if --gracedb-url is a path. Either \"flat\" or \"sharded\". Must agree with whatever was used when the directory was first populated (see migrate_FakeDb.py).")
+parser.add_option("", "--fakedb-dedup", default=None, action="store_true", help="store each distinct uploaded file once and hardlink it into event directories if --gracedb-url is a path. Must agree with whatever was used when the directory was first populated.")
+parser.add_option("", "--fakedb-durability", default=None, type="string", help="when FakeDb forces what it writes onto disk if --gracedb-url is a path. Either \"none\", \"fsync\", or \"group\". Must agree with whatever was used when the directory was first populated.")
+parser.add_option("", "--fakedb-group-commit-window", default=None, type="float", help="how often (in seconds) FakeDb flushes writes when --fakedb-durability=group. Must agree with whatever was used when the directory was first populated.")
+parser.add_option("", "--fakedb-max-age", default=None, type="float", help="remove events created more than this many seconds ago (along with old lvalert messages) while we run if --gracedb-url is a path. Should be longer than the follow-up scheduled for each event.")
+parser.add_option("", "--fakedb-max-events", default=None, type="int", help="remove the oldest events while we run so that no more than this many remain if --gracedb-url is a path.")
+parser.add_option("", "--fakedb-max-bytes", default=None, type="int", help="remove the oldest events while we run so that --gracedb-url holds no more than this many bytes if it is a path.")
+parser.add_option("", "--fakedb-gc-interval", default=60., type="float", help="how often (in seconds) we remove whatever is beyond --fakedb-max-age, --fakedb-max-events or --fakedb-max-bytes. DEFAULT=60")
 
 ### options about simulation
 parser.add_option("",   "--distrib",    default="uniform", type="string", help="the distribution of events in time. Either \"poisson\" or \"uniform\"")
@@ -82,6 +94,17 @@ opts.verbose = opts.verbose or opts.Verbose
 if not os.path.exists(opts.output_dir):
     os.makedirs(opts.output_dir)
 
+### record how FakeDb should store data before any Action instantiates it
+if (opts.fakedb_storage or opts.fakedb_layout or opts.fakedb_dedup or opts.fakedb_durability or opts.fakedb_group_commit_window) and (opts.gracedb_url[:4]!='http'):
+    FakeDb(opts.gracedb_url, storage=opts.fakedb_storage, layout=opts.fakedb_layout, dedup=opts.fakedb_dedup, durability=opts.fakedb_durability, group_commit_window=opts.fakedb_group_commit_window)
+
+### remove old events in the background so long simulations do not fill the disk
+if (opts.fakedb_max_age is not None or opts.fakedb_max_events is not None or opts.fakedb_max_bytes is not None) and (opts.gracedb_url[:4]!='http'):
+    if opts.verbose:
+        print "removing old events from %s every %.1f sec"%(opts.gracedb_url, opts.fakedb_gc_interval)
+    retention = Retention(max_age=opts.fakedb_max_age, max_events=opts.fakedb_max_events, max_bytes=opts.fakedb_max_bytes)
+    Collector(FakeDb(opts.gracedb_url), retention, interval=opts.fakedb_gc_interval).start() ### a daemon thread, so it stops when we do
+
 ### safe uploads
 safe    = not opts.unsafe_uploads ### require only safe uploads
 execute = not opts.test ### actually do the actions
@@ -176,6 +199,7 @@ for ind, wait in enumerate(waits):
 #-------------------------------------------------
 
 ## actually perform the actions
+sched.coalesce() ### upload coincident log messages together
 sched.bump( opts.pause ) ### bump everything by 10 seconds 
 if opts.verbose:
     print """
@@ -0,0 +1,171 @@
+description = "a module that provides an asyncio interface to FakeDb, so event loops are never blocked by FakeDb's file I/O. Requires python3"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import asyncio
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ligoTest.gracedb.rest import FakeDb, FakeTTPResponse
+from ligoTest.gracedb.stats import Stats
+
+#-------------------------------------------------
+
+class AsyncFakeDb(object):
+    '''
+    awaitable versions of FakeDb's methods. Every call runs within a bounded pool of worker threads, each of which borrows one of
+    max_workers FakeDb instances for the duration of the call, so at most max_workers calls touch the disk at once and the rest wait their turn.
+
+    writeLog and writeLabel calls for the same graceid that arrive while an earlier write for that graceid is pending are batched
+    into a single FakeDb.writeLogs (or FakeDb.writeLabels) call. Writes to each graceid are applied in the order they were made.
+    kwargs (storage, layout, dedup, durability, group_commit_window, cache_entries, cache_bytes) are passed to each FakeDb instance.
+    if stats=True (or metrics_file is given), every instance shares a single ligoTest.gracedb.stats.Stats, reported by stats()
+
+    usage:
+        async with AsyncFakeDb(directory) as gdb:
+            graceid = (await gdb.createEvent(group, pipeline, filename)).json()['graceid']
+            await asyncio.gather(*[gdb.writeLog(graceid, message) for message in messages])
+            async for event in gdb.events('DQV'):
+                do stuff
+    '''
+
+    def __init__(self, directory='.', max_workers=8, **kwargs):
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers)
+
+        if kwargs.pop('stats', False) or kwargs.get('metrics_file'): ### one set of counters for every instance
+            kwargs['stats'] = Stats(path=kwargs.pop('metrics_file', None), interval=kwargs.pop('metrics_interval', 60.))
+
+        self.__instances__ = [FakeDb(directory, **kwargs) for _ in range(max_workers)] ### the first one checks (and records) settings
+        self.__pool__ = None ### made on first use so that it belongs to the running event loop
+        self.__batches__ = dict() ### graceid -> list of pending (kind, args, future)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        '''
+        what our FakeDb instances have counted (see FakeDb.stats). cache statistics belong to the first instance only
+        '''
+        return self.__instances__[0].stats()
+
+    #--- plumbing
+
+    async def __acquire__(self):
+        if self.__pool__ is None:
+            self.__pool__ = asyncio.Queue()
+            for gdb in self.__instances__:
+                self.__pool__.put_nowait(gdb)
+        return await self.__pool__.get()
+
+    def __release__(self, gdb):
+        self.__pool__.put_nowait(gdb)
+
+    async def __run__(self, func, *args):
+        '''
+        call func(gdb, *args) within the executor with a FakeDb instance nobody else is using
+        '''
+        gdb = await self.__acquire__()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, gdb, *args)
+        finally:
+            self.__release__(gdb)
+
+    def __batch__(self, graceid, kind, args):
+        '''
+        queue a write for graceid and return a future for its FakeTTPResponse. If nothing is pending for graceid, we start a task to flush its writes
+        '''
+        future = asyncio.get_event_loop().create_future()
+        if graceid in self.__batches__:
+            self.__batches__[graceid].append((kind, args, future))
+        else:
+            self.__batches__[graceid] = [(kind, args, future)]
+            asyncio.ensure_future(self.__flush__(graceid))
+        return future
+
+    async def __flush__(self, graceid):
+        '''
+        apply pending writes for graceid until there are none left. Writes queued while a batch is being applied go into the next batch
+        '''
+        await asyncio.sleep(0) ### let coroutines that are ready to run queue their writes before we take the first batch
+        while self.__batches__[graceid]:
+            ops = self.__batches__[graceid]
+            self.__batches__[graceid] = []
+            try:
+                responses = await self.__run__(self.__apply__, graceid, [(kind, args) for kind, args, _ in ops])
+            except Exception as e:
+                for _, _, future in ops:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, _, future), response in zip(ops, responses):
+                    if not future.done(): ### the caller may have given up on it
+                        future.set_result(response)
+        self.__batches__.pop(graceid)
+
+    @staticmethod
+    def __apply__(gdb, graceid, ops):
+        '''
+        apply ops, a list of ('log', (message, filename, tagname)) and ('label', label), with one FakeDb call per run of consecutive ops of the same kind.
+        returns a FakeTTPResponse for each op. This runs within the executor
+        '''
+        responses = []
+        for kind, group in itertools.groupby(ops, key=lambda op: op[0]):
+            args = [args for _, args in group]
+            if kind=='log':
+                responses += [FakeTTPResponse(jsonD) for jsonD in gdb.writeLogs(graceid, args).json()]
+            else:
+                responses += [FakeTTPResponse(jsonD) for jsonD in gdb.writeLabels(graceid, args).json()]
+        return responses
+
+    #--- writes
+
+    async def createEvent(self, group, pipeline, filename, search=None, filecontents=None, **kwargs):
+        return await self.__run__(lambda gdb: gdb.createEvent(group, pipeline, filename, search=search, filecontents=filecontents, **kwargs))
+
+    async def writeLog(self, graceid, message, filename=None, filecontents=None, tagname=[], displayName=None):
+        return await self.__batch__(graceid, 'log', (message, filename, tagname))
+
+    async def writeLabel(self, graceid, label):
+        self.__instances__[0].check_label(label) ### check this now so a bad label does not fail the rest of its batch
+        return await self.__batch__(graceid, 'label', label)
+
+    #--- reads
+
+    async def event(self, graceid):
+        return await self.__run__(lambda gdb: gdb.event(graceid))
+
+    async def logs(self, graceid):
+        return await self.__run__(lambda gdb: gdb.logs(graceid))
+
+    async def labels(self, graceid, label=''):
+        return await self.__run__(lambda gdb: gdb.labels(graceid, label))
+
+    async def files(self, graceid, filename=None, raw=False):
+        return await self.__run__(lambda gdb: gdb.files(graceid, filename=filename, raw=raw))
+
+    async def events(self, query=None, orderby=None, count=None, columns=None, chunk=100):
+        '''
+        an async iterator over FakeDb.events. We pull chunk events at a time within the executor.
+        NOTE: this holds onto one of our FakeDb instances until the iteration finishes (or is closed)
+        '''
+        gdb = await self.__acquire__()
+        try:
+            events = gdb.events(query, orderby=orderby, count=count, columns=columns)
+            loop = asyncio.get_event_loop()
+            while True:
+                batch = await loop.run_in_executor(self.executor, list, itertools.islice(events, chunk))
+                for event in batch:
+                    yield event
+                if len(batch) < chunk:
+                    break
+        finally:
+            self.__release__(gdb)
@@ -0,0 +1,151 @@
+description = "a module that provides a content-addressed store for files uploaded to FakeDb"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import errno
+import shutil
+import tempfile
+
+import fcntl
+
+import hashlib
+
+#-------------------------------------------------
+
+FICLONE = 0x40049409 ### ioctl request that asks the filesystem for a copy-on-write clone (linux)
+
+#-------------------------------------------------
+
+def sha1sum(filename, chunkSize=2**20):
+    '''
+    the sha1 of the contents of filename, read in chunks so large files never sit in memory
+    '''
+    sha1 = hashlib.sha1()
+    file_obj = open(filename, 'rb')
+    chunk = file_obj.read(chunkSize)
+    while chunk:
+        sha1.update(chunk)
+        chunk = file_obj.read(chunkSize)
+    file_obj.close()
+    return sha1.hexdigest()
+
+#-------------------------------------------------
+
+class BlobStore(object):
+    '''
+    stores each distinct file once, keyed by the sha1 of its contents (blobs/<ab>/<sha1>), and links it into event directories.
+    links are hardlinks where possible, so the number of events that reference a blob is just its link count minus one.
+    if we cannot hardlink (eg: the filesystem's link limit is reached) we try a copy-on-write clone and then fall back to a plain copy.
+
+    NOTE: linked files share their contents with the blob, so they must be replaced (unlink and re-link) rather than modified in place.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def digest(self, filename):
+        return sha1sum(filename)
+
+    def put(self, filename):
+        '''
+        add the contents of filename to the store (if they are not already there) and return their digest
+        '''
+        digest = self.digest(filename)
+        path = self.path(digest)
+        if os.path.exists(path): ### we already have these contents
+            return digest
+
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno!=errno.EEXIST: ### someone else may have just made it
+                    raise
+
+        ### copy into a temporary file next to the blob and then link it into place
+        ### linking fails if the blob already exists, so concurrent writers of the same contents agree on a single inode
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        os.close(fd)
+        shutil.copyfile(filename, tmp)
+        try:
+            os.link(tmp, path)
+        except OSError as e:
+            if e.errno!=errno.EEXIST:
+                raise
+        finally:
+            os.remove(tmp)
+
+        return digest
+
+    def link(self, digest, target):
+        '''
+        make target refer to the blob with this digest, replacing target if it already exists
+        '''
+        path = self.path(digest)
+        if os.path.exists(target):
+            os.remove(target) ### never write through an existing link, which could share an inode with a blob
+        try:
+            os.link(path, target)
+        except OSError as e:
+            if e.errno==errno.ENOENT: ### gc removed the blob, so there is nothing to copy either
+                raise
+            if not self.__clone__(path, target):
+                shutil.copyfile(path, target)
+
+    def __clone__(self, path, target):
+        '''
+        attempt a copy-on-write clone of path into target. Returns True if this succeeded
+        '''
+        src = open(path, 'rb')
+        dst = open(target, 'wb')
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            success = True
+        except (IOError, OSError): ### not supported by this filesystem
+            success = False
+        src.close()
+        dst.close()
+        return success
+
+    def store(self, filename, target):
+        '''
+        add filename to the store and link it into target
+        '''
+        while True:
+            try:
+                self.link(self.put(filename), target)
+                return
+            except OSError as e:
+                if e.errno!=errno.ENOENT: ### otherwise gc removed the blob between put and link, so we put it again
+                    raise
+
+    def refcount(self, digest):
+        '''
+        the number of hardlinks to this blob outside of the store
+        '''
+        return os.stat(self.path(digest)).st_nlink - 1
+
+    def digests(self):
+        if not os.path.exists(self.directory):
+            return []
+        return [digest for subdir in sorted(os.listdir(self.directory)) for digest in sorted(os.listdir(os.path.join(self.directory, subdir))) if not digest.startswith('.')] ### skip temporary files
+
+    def gc(self):
+        '''
+        remove blobs that are no longer linked into any event directory
+        returns the number of bytes freed.
+        this may run while other processes upload files: store puts a blob again if we remove it before it is linked
+        '''
+        freed = 0
+        for digest in self.digests():
+            path = self.path(digest)
+            stat = os.stat(path)
+            if stat.st_nlink==1:
+                os.remove(path)
+                freed += stat.st_size
+        return freed
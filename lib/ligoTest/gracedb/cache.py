@@ -0,0 +1,161 @@
+description = "a module that provides an in-process cache of decoded FakeDb data and an on-disk cache of results computed from uploaded files"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import errno
+import tempfile
+
+import json
+
+from collections import OrderedDict
+
+from ligoTest.gracedb.blobs import sha1sum
+from ligoTest.gracedb.compat import pickle
+
+#-------------------------------------------------
+
+class LRUCache(object):
+    '''
+    a least-recently-used cache of decoded data keyed by an identifier (eg: a path).
+    each entry carries a stamp (eg: (mtime, size) or a generation counter) and is only returned if the caller's stamp matches,
+    so stale entries are never served. entries are evicted once we hold more than maxEntries entries or more than maxBytes bytes.
+
+    values are stored pickled and every get unpickles a fresh copy, so callers (and whoever they hand values to) may modify what they get
+    without changing what anyone else reads. Unpickling is still much cheaper than reading and decoding the data again.
+    '''
+
+    def __init__(self, maxEntries=1024, maxBytes=2**26):
+        self.maxEntries = maxEntries
+        self.maxBytes   = maxBytes
+
+        self.entries = OrderedDict() ### key -> (stamp, size, value), ordered from least to most recently used
+        self.bytes  = 0
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, stamp):
+        '''
+        return the cached value if it was stored with this stamp. Otherwise, return None
+        '''
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry[0]==stamp:
+                self.entries[key] = entry ### re-insert so this is the most recently used entry
+                self.hits += 1
+                return pickle.loads(entry[2])
+            self.bytes -= entry[1] ### stale, so we forget it
+
+        self.misses += 1
+        return None
+
+    def put(self, key, stamp, value):
+        '''
+        cache a copy of value, so later changes to value do not change what we return
+        '''
+        self.invalidate(key)
+        if self.maxEntries < 1:
+            return
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL) ### never leaves this process, so any protocol will do
+        size = len(data)
+        if size > self.maxBytes: ### would never fit
+            return
+
+        self.entries[key] = (stamp, size, data)
+        self.bytes += size
+
+        while (len(self.entries) > self.maxEntries) or (self.bytes > self.maxBytes): ### evict least recently used entries
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'hits'       : self.hits,
+                'misses'     : self.misses,
+                'entries'    : len(self.entries),
+                'bytes'      : self.bytes,
+                'maxEntries' : self.maxEntries,
+                'maxBytes'   : self.maxBytes,
+               }
+
+#-------------------------------------------------
+
+class DigestCache(object):
+    '''
+    an on-disk cache of small JSON-serializable results computed from files (eg: the attributes FakeDb extracts from uploaded coinc.xml files),
+    keyed by the sha1 of the file's contents and the name of what we computed. Because it lives on disk, every process pointed at a directory shares it.
+    entries are written into a temporary file and renamed into place, so readers never see a partial entry.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def digest(self, filename):
+        return sha1sum(filename)
+
+    def path(self, name, digest):
+        return os.path.join(self.directory, digest[:2], '%s.%s.json'%(digest, name))
+
+    def get(self, name, digest):
+        '''
+        return what we cached for (name, digest) or None if there is nothing cached
+        '''
+        try:
+            file_obj = open(self.path(name, digest), 'r')
+        except IOError:
+            return None
+        try:
+            return json.load(file_obj)
+        except ValueError: ### should not happen given how we write entries, but a cache miss is always safe
+            return None
+        finally:
+            file_obj.close()
+
+    def put(self, name, digest, value):
+        path = self.path(name, digest)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno!=errno.EEXIST: ### someone else may have just made it
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        file_obj = os.fdopen(fd, 'w')
+        json.dump(value, file_obj)
+        file_obj.close()
+        os.rename(tmp, path)
+
+    def gc(self, before):
+        '''
+        remove entries written before this time (seconds since the epoch). Temporary files belong to writers that are not done yet, so we leave them alone.
+        returns the number of bytes freed
+        '''
+        freed = 0
+        if not os.path.exists(self.directory):
+            return freed
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            for name in os.listdir(subdir):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime < before:
+                        os.remove(path)
+                        freed += stat.st_size
+                except OSError: ### someone else removed (or replaced) it first
+                    pass
+        return freed
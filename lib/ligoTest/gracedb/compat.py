@@ -0,0 +1,42 @@
+description = "a module that papers over the differences between python2 and python3 that matter to FakeDb, so it can be driven from either (eg: by ligoTest.gracedb.aio)"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+try:
+    xrange = xrange
+    basestring = basestring
+    from itertools import ifilter
+
+except NameError: ### python3
+    xrange = range
+    basestring = str
+    ifilter = filter
+
+try:
+    import Queue as queue
+    import BaseHTTPServer as httpserver
+    from urlparse import urlparse, parse_qs
+    from urllib import quote, unquote, urlencode
+
+except ImportError: ### python3
+    import queue
+    import http.server as httpserver
+    from urllib.parse import urlparse, parse_qs, quote, unquote, urlencode
+
+try:
+    import cPickle as pickle ### python2's pickle is pure python, and much slower
+except ImportError: ### python3's pickle already uses its C implementation
+    import pickle
+
+#-------------------------------------------------
+
+PICKLE_PROTOCOL = 2 ### the highest protocol python2 can read, so processes running either version can share a directory
+
+def asbytes(text):
+    '''
+    what we write to sockets must be bytes, which python2's str already is
+    '''
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
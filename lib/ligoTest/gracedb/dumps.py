@@ -0,0 +1,86 @@
+description = "a module that reads dumps of GraceDb events (what GraceDb.event, GraceDb.logs, GraceDb.labels and GraceDb.files return) so FakeDb can import them"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import gzip
+
+import json
+
+import time
+import calendar
+
+from ligoTest.gracedb.compat import basestring
+
+#-------------------------------------------------
+
+### how GraceDb reports times (eg: "2017-05-01 12:00:00 UTC"), once any fractional second and time zone are stripped
+__timeFormats__ = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+
+#-------------------------------------------------
+
+def iterDumps(path):
+    '''
+    iterate over the events within a dump, which holds one JSON object per line:
+        {"event": GraceDb.event(graceid).json(), "logs": GraceDb.logs(graceid).json(), "labels": GraceDb.labels(graceid).json(), "files": GraceDb.files(graceid).json()}
+    logs, labels and files may be missing (nothing to import) or given as plain lists. Paths ending in ".gz" are decompressed as we go, and "-" is read from stdin.
+    lines are read one at a time, so dumps never have to fit in memory
+    '''
+    if path=='-':
+        import sys
+        file_obj = sys.stdin
+    elif path.endswith('.gz'):
+        file_obj = gzip.open(path, 'rt') if str is not bytes else gzip.open(path, 'r') ### python3 must be asked for text
+    else:
+        file_obj = open(path, 'r')
+
+    try:
+        for line in file_obj:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    finally:
+        if path!='-':
+            file_obj.close()
+
+def records(stuff, key):
+    '''
+    the list of records within what GraceDb returned (eg: key="log" for GraceDb.logs, key="labels" for GraceDb.labels)
+    '''
+    if stuff is None:
+        return []
+    if isinstance(stuff, dict):
+        return stuff.get(key, [])
+    return stuff
+
+def filenames(files):
+    '''
+    the names of the files within what GraceDb.files returned (a dictionary mapping filename -> url) or a plain list of names
+    '''
+    if files is None:
+        return []
+    if isinstance(files, dict):
+        return sorted(files.keys())
+    return list(files)
+
+def unixtime(created, default=None):
+    '''
+    a unix timestamp from what GraceDb reports as "created" (eg: "2017-05-01 12:00:00 UTC"). Numbers are returned as floats and None becomes default
+    '''
+    if created is None:
+        return default
+    if not isinstance(created, basestring):
+        return float(created)
+
+    created = created.strip()
+    for zone in [' UTC', 'Z', '+00:00']:
+        if created.endswith(zone):
+            created = created[:-len(zone)]
+            break
+    created, _, fraction = created.partition('.')
+    for form in __timeFormats__:
+        try:
+            return calendar.timegm(time.strptime(created, form)) + (float('0.'+fraction) if fraction else 0.0)
+        except ValueError:
+            pass
+    raise ValueError('could not interpret "%s" as a time'%created)
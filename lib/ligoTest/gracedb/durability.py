@@ -0,0 +1,176 @@
+description = "a module that decides when the files FakeDb writes are forced onto disk (fsync), trading durability for speed"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import errno
+
+import threading
+import time
+
+#-------------------------------------------------
+
+def fsyncPath(path):
+    '''
+    force the contents of path (a file or a directory) onto disk. Paths that no longer exist (eg: renamed temporary files) are ignored
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno==errno.ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+#-------------------------------------------------
+
+class Durability(object):
+    '''
+    callers hand sync() the paths (files and directories) they have modified at points where those modifications must survive a crash
+    before they go on (eg: a write journal must be on disk before the data it describes is touched).
+    this base class never forces anything onto disk, so a crash of the machine (rather than of a process) can lose or tear recent writes.
+    '''
+    name = 'none'
+
+    def __init__(self, window=None):
+        pass
+
+    @property
+    def enabled(self):
+        return False
+
+    def sync(self, *paths):
+        pass
+
+class FsyncDurability(Durability):
+    '''
+    fsync every path as soon as it is handed to sync()
+    '''
+    name = 'fsync'
+
+    @property
+    def enabled(self):
+        return True
+
+    def sync(self, *paths):
+        for path in set(paths):
+            fsyncPath(path)
+
+class GroupDurability(Durability):
+    '''
+    group commit: paths handed to sync() by every thread in this process are flushed together by a single background thread,
+    which starts a flush at most once every window seconds. Whatever arrives in the meantime joins the next flush, so each distinct path
+    is fsync-ed once per flush no matter how many writes touched it.
+    sync() returns once the flush that includes its paths has completed, so callers get the same guarantees as with FsyncDurability.
+    if any fsync within a flush fails, every sync() waiting on that flush raises the error, and the thread goes on to the next flush.
+    a lone writer may wait up to window seconds per sync(), but many concurrent writers (eg: ligoTest.gracedb.server) share each flush.
+    '''
+    name = 'group'
+
+    def __init__(self, window=0.005):
+        self.window = window
+        self.__pid__ = None
+        self.__startLock__ = threading.Lock()
+
+    def __start__(self):
+        '''
+        set up our state and start the flushing thread. We do this again after a fork, because threads do not survive it
+        '''
+        self.__cond__ = threading.Condition()
+        self.__pending__ = set()
+        self.__taken__ = 0 ### the number of batches the flushing thread has taken
+        self.__flushed__ = 0 ### the number of batches it has finished
+        self.__waiting__ = dict() ### batch -> the number of sync() calls waiting on it
+        self.__errors__ = dict() ### batch -> the error raised while flushing it
+
+        thread = threading.Thread(target=self.__flush__)
+        thread.daemon = True
+        thread.start()
+        self.__pid__ = os.getpid() ### last, so no other thread uses our state before it is ready
+
+    @property
+    def enabled(self):
+        return True
+
+    def sync(self, *paths):
+        if not paths:
+            return
+        if self.__pid__!=os.getpid():
+            with self.__startLock__:
+                if self.__pid__!=os.getpid(): ### another thread may have beaten us to it
+                    self.__start__()
+
+        with self.__cond__:
+            self.__pending__.update(paths)
+            target = self.__taken__ + 1 ### the batch our paths will be flushed with
+            self.__waiting__[target] = self.__waiting__.get(target, 0) + 1
+            self.__cond__.notify_all()
+            while self.__flushed__ < target:
+                self.__cond__.wait()
+
+            self.__waiting__[target] -= 1
+            if self.__waiting__[target]:
+                error = self.__errors__.get(target, None)
+            else: ### we're the last caller to hear about this batch
+                self.__waiting__.pop(target)
+                error = self.__errors__.pop(target, None)
+
+        if error is not None:
+            raise error
+
+    def __flush__(self):
+        cond = self.__cond__
+        last = 0.0 ### when we started the previous flush
+        while True:
+            with cond:
+                while not self.__pending__:
+                    cond.wait()
+            delay = last + self.window - time.time()
+            if delay > 0: ### we flushed recently, so let other writers join this batch
+                time.sleep(delay)
+            last = time.time()
+
+            with cond:
+                paths = self.__pending__
+                self.__pending__ = set()
+                self.__taken__ += 1
+                batch = self.__taken__
+
+            error = None
+            for path in paths:
+                try:
+                    fsyncPath(path)
+                except Exception as e: ### report this to everyone waiting on this batch, but keep flushing (this one and later ones)
+                    error = e
+
+            with cond:
+                if error is not None:
+                    self.__errors__[batch] = error
+                self.__flushed__ += 1
+                cond.notify_all()
+
+#-------------------------------------------------
+
+durabilities = dict( (durability.name, durability) for durability in [Durability, FsyncDurability, GroupDurability] )
+
+__shared__ = dict()
+__sharedLock__ = threading.Lock()
+
+def initDurability(name, window=None):
+    '''
+    instantiate the durability policy associated with name. Every FakeDb in a process that asks for group commit with the same window
+    shares a single instance, so their fsyncs are batched together
+    '''
+    if name not in durabilities:
+        raise ValueError('durability=%s not understood'%name)
+    if name!='group':
+        return durabilities[name]()
+
+    with __sharedLock__:
+        if window not in __shared__:
+            __shared__[window] = GroupDurability() if window is None else GroupDurability(window=window)
+        return __shared__[window]
@@ -0,0 +1,108 @@
+description = "a module that pulls single tables out of LIGO_LW documents (eg: coinc.xml) without building the whole document"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import re
+import gzip
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError: ### python3
+    from xml.etree import ElementTree
+
+#-------------------------------------------------
+
+### LIGO_LW types we convert. Everything else (lstring, ilwd:char, ...) is left as a string
+__floatTypes__ = ['real_4', 'real_8', 'float', 'double']
+__intTypes__ = ['int_2s', 'int_4s', 'int_8s', 'int_2u', 'int_4u', 'int_8u', 'int']
+
+### one field of a LIGO_LW Stream (quoted or bare) and the delimiter that follows it
+__field__ = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([^,"\s]*))\s*(?:,|\Z)', re.S)
+
+#-------------------------------------------------
+
+def openLIGOLW(filename):
+    '''
+    open filename, decompressing it on the fly if it is gzipped (which we detect from its contents rather than its name)
+    '''
+    file_obj = open(filename, 'rb')
+    magic = file_obj.read(2)
+    file_obj.seek(0, 0)
+    if magic==b'\x1f\x8b':
+        file_obj.close()
+        file_obj = gzip.open(filename, 'rb')
+    return file_obj
+
+def __stripName__(name, suffix=None):
+    '''
+    LIGO_LW names carry prefixes (eg: "coinc_inspiralgroup:coinc_inspiral:table" or "coinc_inspiral:ifos"), so we keep only the part we care about
+    '''
+    parts = name.split(':')
+    if suffix and (len(parts) > 1) and (parts[-1]==suffix):
+        parts = parts[:-1]
+    return parts[-1]
+
+def __convert__(value, kind):
+    if value is None:
+        return None
+    if kind in __floatTypes__:
+        return float(value)
+    if kind in __intTypes__:
+        return int(float(value)) ### some writers format integers as floats
+    return value
+
+def __parseStream__(text, columns):
+    '''
+    split the text of a LIGO_LW Stream into rows (dictionaries keyed by column name)
+    columns is a list of (name, type)
+    '''
+    text = text.strip()
+    fields = []
+    pos = 0
+    while pos < len(text):
+        match = __field__.match(text, pos)
+        if (match is None) or (match.end()==pos):
+            raise ValueError('could not parse Stream near "%s"'%text[pos:pos+32])
+        quoted, bare = match.groups()
+        if quoted is not None:
+            fields.append( re.sub(r'\\(.)', r'\1', quoted) )
+        else:
+            fields.append( bare if bare else None ) ### nothing between delimiters means null
+        pos = match.end()
+
+    N = len(columns)
+    if len(fields)%N:
+        raise ValueError('Stream has %d fields, which is not a multiple of the number of columns (%d)'%(len(fields), N))
+    return [dict((name, __convert__(value, kind)) for (name, kind), value in zip(columns, fields[i:i+N])) for i in range(0, len(fields), N)]
+
+def readTable(filename, tableName):
+    '''
+    return the rows of tableName (eg: "coinc_inspiral") as a list of dictionaries keyed by column name, or None if the table does not appear in filename.
+    we parse filename incrementally, discard every element we do not need as soon as we are done with it, and stop reading as soon as we reach the end of the table.
+    '''
+    tableName = __stripName__(tableName, suffix='table') ### older versions of glue include the suffix
+    file_obj = openLIGOLW(filename)
+    try:
+        inTable = False
+        columns = []
+        rows = []
+        for event, elem in ElementTree.iterparse(file_obj, events=('start', 'end')):
+            if event=='start':
+                if (elem.tag=='Table') and (__stripName__(elem.get('Name', ''), suffix='table')==tableName):
+                    inTable = True
+                continue
+
+            if inTable:
+                if elem.tag=='Column':
+                    columns.append( (__stripName__(elem.get('Name')), elem.get('Type')) )
+                elif elem.tag=='Stream':
+                    rows += __parseStream__(elem.text or '', columns)
+                elif elem.tag=='Table':
+                    return rows ### we have everything we need, so we stop reading here
+            elem.clear()
+
+        return None
+
+    finally:
+        file_obj.close()
@@ -0,0 +1,272 @@
+description = "a module that stores the footprints of EM observations as fixed-width numpy records, so they can be searched with vectorized box and time cuts"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import time
+import calendar
+
+import numpy as np
+
+from ligoTest.gracedb.locks import atomicAppend, lockedAppend, lockedReplace
+from ligoTest.gracedb.compat import basestring
+
+#-------------------------------------------------
+
+### the columns we keep for each footprint. N is the (1-based) number of the observation it belongs to, start is a gps time and duration is in seconds
+__columns__ = [('N', '<i4'), ('ra', '<f8'), ('dec', '<f8'), ('raWidth', '<f8'), ('decWidth', '<f8'), ('start', '<f8'), ('duration', '<f8')]
+
+### GPS time started at 1980-01-06 00:00:00 UTC (unix time 315964800) and does not stop for leap seconds
+__gpsEpoch__ = 315964800
+__leapSeconds__ = [calendar.timegm(time.strptime(date, '%Y-%m-%d')) for date in [
+    '1981-07-01', '1982-07-01', '1983-07-01', '1985-07-01', '1988-01-01', '1990-01-01', '1991-01-01', '1992-07-01', '1993-07-01',
+    '1994-07-01', '1996-01-01', '1997-07-01', '1999-01-01', '2006-01-01', '2009-01-01', '2012-07-01', '2015-07-01', '2017-01-01',
+]] ### unix times at which each leap second took effect
+
+__timeFormats__ = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']
+
+#-------------------------------------------------
+
+def utc2gps(utc):
+    '''
+    convert a UTC time ("YYYY-MM-DDTHH:MM:SS", as GraceDb reports start_time) into a gps time
+    '''
+    for form in __timeFormats__:
+        try:
+            unix = calendar.timegm(time.strptime(utc, form))
+            break
+        except ValueError:
+            pass
+    else:
+        raise ValueError('could not interpret "%s" as a UTC time'%utc)
+    return float(unix - __gpsEpoch__ + sum(1 for leap in __leapSeconds__ if leap <= unix))
+
+def gps2utc(gps):
+    '''
+    convert a gps time into a UTC time formatted as GraceDb reports start_time
+    '''
+    unix = gps + __gpsEpoch__
+    for leap in __leapSeconds__:
+        if leap <= unix - 1: ### unix has been shifted by every leap second before this one
+            unix -= 1
+    return time.strftime(__timeFormats__[0], time.gmtime(unix))
+
+def asFloats(values, times=False):
+    '''
+    interpret values as a list of floats. GraceDb's clients send lists, but form-encoded requests (see ligoTest.gracedb.server) may hand us
+    a single value or a comma-separated string. If times, strings that are not numbers are read as UTC times
+    '''
+    if isinstance(values, basestring):
+        values = values.split(',')
+    elif not isinstance(values, (list, tuple, np.ndarray)):
+        values = [values]
+
+    ans = []
+    for value in values:
+        if isinstance(value, basestring):
+            value = value.strip()
+            try:
+                value = float(value)
+            except ValueError:
+                if not times:
+                    raise
+                value = utc2gps(value)
+        ans.append( float(value) )
+    return ans
+
+#-------------------------------------------------
+
+class Footprints(object):
+    '''
+    the footprints of every EM observation reported for a single event, stored as fixed-width binary records (one per footprint) in path.
+    a whole observation is appended with a single write, and each column (ra, dec, ...) is available as a numpy array without copying.
+    the observations themselves live in the storage backend (the "emobservations" collection), which is the commit point:
+    footprints are only reported for observations that have been recorded there, so footprints left behind by a writer that died are ignored (and removed by truncate).
+    '''
+    dtype = np.dtype(__columns__)
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, count):
+        '''
+        return the footprints of the first count observations as a numpy structured array
+        '''
+        if (not count) or (not os.path.exists(self.path)):
+            return np.empty(0, dtype=self.dtype)
+        ans = np.fromfile(self.path, dtype=self.dtype, count=os.path.getsize(self.path)//self.dtype.itemsize) ### ignore any partial record at the end
+        return ans[ans['N'] <= count]
+
+    def truncate(self, num):
+        '''
+        keep only the first num footprints (those that belong to recorded observations). Callers must hold the event's lock
+        '''
+        if os.path.exists(self.path) and (os.path.getsize(self.path) > num*self.dtype.itemsize):
+            file_obj = open(self.path, 'r+b')
+            file_obj.truncate(num*self.dtype.itemsize)
+            file_obj.close()
+
+    def append(self, footprints):
+        '''
+        append footprints (a numpy structured array with our dtype) with a single write
+        '''
+        atomicAppend(self.path, footprints.astype(self.dtype).tobytes())
+
+class FootprintIndex(object):
+    '''
+    every footprint of every event in a single append-only file of fixed-width records (our columns along with the graceid), shared across processes.
+    like ligoTest.gracedb.index.AppendOnlyIndex, each instance only reads the records appended since it last looked, and
+    search applies box and time cuts to every footprint at once with numpy.
+    removed events are forgotten through a tombstone (a record with N=-1) and compact replaces the file with only the footprints we still need.
+    '''
+    dtype = np.dtype([('graceid', 'S16')] + __columns__)
+
+    def __init__(self, path):
+        self.path = path
+        self.pinned = None ### the version of self.path we've read, held open so no later version can reuse its inode
+        self.__reset__()
+
+    def __reset__(self):
+        self.offset = 0 ### how far into self.path we've read
+        if self.pinned is not None:
+            self.pinned.close()
+            self.pinned = None
+        self.records = 0 ### the number of records (including tombstones) we've read
+        self.chunks = [np.empty(0, dtype=self.dtype)]
+        self.counts = dict() ### graceid -> number of footprints
+
+    @staticmethod
+    def __encode__(graceid):
+        return graceid.encode('ascii') if not isinstance(graceid, bytes) else graceid
+
+    def extend(self, graceid, footprints):
+        '''
+        add footprints (a numpy structured array with Footprints.dtype) for graceid with a single write
+        '''
+        records = np.empty(len(footprints), dtype=self.dtype)
+        records['graceid'] = self.__encode__(graceid)
+        for name, _ in __columns__:
+            records[name] = footprints[name]
+        lockedAppend(self.path, records.tobytes())
+
+    def remove(self, graceids):
+        '''
+        forget the footprints of these graceids
+        '''
+        records = np.zeros(len(graceids), dtype=self.dtype)
+        records['graceid'] = [self.__encode__(graceid) for graceid in graceids]
+        records['N'] = -1
+        lockedAppend(self.path, records.tobytes())
+
+    def refresh(self):
+        '''
+        read any records appended since we last looked
+        '''
+        if not os.path.exists(self.path):
+            return
+        file_obj = open(self.path, 'rb')
+        stat = os.fstat(file_obj.fileno())
+        if (self.pinned is not None) and (stat.st_ino!=os.fstat(self.pinned.fileno()).st_ino): ### the file was compacted since we last looked, so we start over
+            self.__reset__()
+
+        num = (stat.st_size - self.offset)//self.dtype.itemsize ### only whole records
+        if num:
+            file_obj.seek(self.offset, 0)
+            chunk = np.fromfile(file_obj, dtype=self.dtype, count=num)
+            self.offset += num*self.dtype.itemsize
+            self.records += num
+
+            removed = chunk['graceid'][chunk['N'] < 0]
+            if len(removed):
+                chunk = chunk[chunk['N'] >= 0]
+            self.chunks.append( chunk )
+            for graceid, n in zip(*np.unique(chunk['graceid'], return_counts=True)):
+                graceid = graceid.decode('ascii')
+                self.counts[graceid] = self.counts.get(graceid, 0) + int(n)
+
+            if len(removed): ### tombstones follow every footprint of their events
+                footprints = np.concatenate(self.chunks)
+                self.chunks = [footprints[~np.isin(footprints['graceid'], removed)]]
+                for graceid in removed:
+                    self.counts.pop(graceid.decode('ascii'), None)
+
+        if self.pinned is None:
+            self.pinned = file_obj ### we never read from it again, so processes forked with it open never share its offset
+        else:
+            file_obj.close()
+
+    def graceids(self):
+        '''
+        the graceids that have footprints
+        '''
+        self.refresh()
+        return [graceid for graceid, n in self.counts.items() if n]
+
+    def compact(self, threshold=0.5, sync=None):
+        '''
+        replace the file with only the footprints we still need if at least threshold of its records no longer matter.
+        returns the number of bytes freed
+        '''
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+
+        def build():
+            footprints = self.array() ### also refreshes
+            if (not self.records) or (len(footprints) > (1-threshold)*self.records):
+                return None
+            return footprints.tobytes()
+
+        new = lockedReplace(self.path, build, sync=sync)
+        if new is None:
+            return 0
+        self.__reset__() ### we read what we wrote from the start next time
+        return size - new[1]
+
+    def array(self):
+        '''
+        every footprint we know about as a single numpy structured array
+        '''
+        self.refresh()
+        if len(self.chunks) > 1: ### concatenate once and remember the result
+            self.chunks = [np.concatenate(self.chunks)]
+        return self.chunks[0]
+
+    def count(self, graceid):
+        '''
+        the number of footprints recorded for graceid
+        '''
+        self.refresh()
+        return self.counts.get(graceid, 0)
+
+    def search(self, ra=None, dec=None, gpsstart=None, gpsstop=None):
+        '''
+        return the footprints (as a numpy structured array) that overlap
+            ra  = (ralo, rahi) : a range of right ascension in degrees, which wraps through 0 if ralo > rahi
+            dec = (declo, dechi) : a range of declination in degrees
+            gpsstart .. gpsstop : a window of gps times, either end of which may be None (unbounded)
+        each footprint covers ra +/- raWidth/2, dec +/- decWidth/2 from start to start+duration
+        '''
+        footprints = self.array()
+        keep = np.ones(len(footprints), dtype=bool)
+
+        if ra is not None:
+            ralo, rahi = ra
+            width = (rahi - ralo)%360.
+            if (width > 0) or (rahi==ralo):
+                center = ralo + 0.5*width
+                separation = np.abs((footprints['ra'] - center + 180.)%360. - 180.) ### the shortest way around
+                keep &= separation <= 0.5*(footprints['raWidth'] + width)
+            ### otherwise the range covers every right ascension
+
+        if dec is not None:
+            declo, dechi = dec
+            keep &= (footprints['dec'] + 0.5*footprints['decWidth'] >= declo) & (footprints['dec'] - 0.5*footprints['decWidth'] <= dechi)
+
+        if gpsstart is not None:
+            keep &= footprints['start'] + footprints['duration'] >= gpsstart
+        if gpsstop is not None:
+            keep &= footprints['start'] <= gpsstop
+
+        return footprints[keep]
@@ -0,0 +1,518 @@
+description = "a module that provides secondary indexes over FakeDb events, shared across processes through append-only files"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import json
+import tempfile
+
+from bisect import bisect_left, bisect_right, insort
+
+from ligoTest.gracedb.locks import FileLock, lockedAppend, lockedReplace
+from ligoTest.gracedb.compat import xrange
+
+#-------------------------------------------------
+
+def bisectValues(values, x, right=False):
+    '''
+    like bisect_left (bisect_right if right) for a sorted list of tuples, but only compares the first element of each tuple (not the graceids, etc that break ties)
+    '''
+    lo = 0
+    hi = len(values)
+    while lo < hi:
+        mid = (lo+hi)//2
+        if (values[mid][0] <= x) if right else (values[mid][0] < x):
+            lo = mid+1
+        else:
+            hi = mid
+    return lo
+
+#-------------------------------------------------
+
+class AppendOnlyIndex(object):
+    '''
+    an index backed by an append-only file of JSON records (one per line).
+    any number of processes can add records, and each instance keeps an in-memory view of the index
+    that it brings up to date by reading only the records appended since it last looked.
+
+    events that are removed (see ligoTest.gracedb.retention) are forgotten through a tombstone ({"removed": graceid}) appended like any other record.
+    once most of the file is records that no longer matter, compact replaces it with just the records needed to rebuild the view.
+    instances notice that the file was replaced (its inode changed) and read the new one from the start. Each instance keeps the version it has read open,
+    since the inode of a file no one holds open may be reused by a later version, which would then look unchanged.
+
+    children must define __reset__, which empties the in-memory view, __update__, which folds a single record into it,
+    __remove__, which forgets a graceid, and __records__, which lists the records that rebuild it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.pinned = None ### the version of self.path we've read, held open so no later version can reuse its inode
+        self.__reset__()
+
+    def __reset__(self):
+        self.offset = 0 ### how far into self.path we've read
+        if self.pinned is not None:
+            self.pinned.close()
+            self.pinned = None
+        self.lines = 0 ### the number of records we've read
+
+    def add(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        lockedAppend(self.path, "".join(json.dumps(record)+"\n" for record in records)) ### a single write, so concurrent writers never interleave records
+
+    def remove(self, graceids):
+        '''
+        forget everything we know about these graceids
+        '''
+        self.extend([{'removed':graceid} for graceid in graceids])
+
+    def refresh(self):
+        '''
+        read any records appended since we last looked and fold them into the in-memory view
+        '''
+        if not os.path.exists(self.path):
+            return
+
+        file_obj = open(self.path, 'r')
+        if (self.pinned is not None) and (os.fstat(file_obj.fileno()).st_ino!=os.fstat(self.pinned.fileno()).st_ino): ### the file was compacted since we last looked, so we start over
+            self.__reset__()
+
+        file_obj.seek(self.offset, 0)
+        for line in file_obj:
+            if not line.endswith("\n"): ### someone is still writing this record, so we stop here and pick it up next time
+                break
+            self.offset += len(line)
+            self.lines += 1
+            record = json.loads(line)
+            if isinstance(record, dict):
+                self.__remove__(record['removed'])
+            else:
+                self.__update__(record)
+
+        if self.pinned is None:
+            self.pinned = file_obj ### we never read from it again, so processes forked with it open never share its offset
+        else:
+            file_obj.close()
+
+    def compact(self, threshold=0.5, sync=None):
+        '''
+        replace the file with the records needed to rebuild our view if at least threshold of its records no longer matter.
+        returns the number of bytes freed
+        '''
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+
+        kept = [] ### the records we wrote
+        def build():
+            self.refresh()
+            kept[:] = self.__records__()
+            if (not self.lines) or (len(kept) > (1-threshold)*self.lines):
+                return None
+            return "".join(json.dumps(record)+"\n" for record in kept)
+
+        new = lockedReplace(self.path, build, sync=sync)
+        if new is None:
+            return 0
+        self.__reset__() ### we read what we wrote from the start next time
+        return size - new[1]
+
+    def __update__(self, record):
+        raise NotImplementedError
+
+    def __remove__(self, graceid):
+        raise NotImplementedError
+
+    def __records__(self):
+        raise NotImplementedError
+
+class LabelIndex(AppendOnlyIndex):
+    '''
+    maps label -> set of graceids. records are [graceid, label]
+    '''
+
+    def __reset__(self):
+        super(LabelIndex, self).__reset__()
+        self.label2graceids = dict()
+
+    def __update__(self, record):
+        graceid, label = record
+        if label in self.label2graceids:
+            self.label2graceids[label].add(graceid)
+        else:
+            self.label2graceids[label] = set([graceid])
+
+    def __remove__(self, graceid):
+        for graceids in self.label2graceids.values():
+            graceids.discard(graceid)
+
+    def __records__(self):
+        return [[graceid, label] for label, graceids in self.label2graceids.items() for graceid in sorted(graceids)]
+
+    def graceids(self, label):
+        self.refresh()
+        return set(self.label2graceids.get(label, []))
+
+    def size(self, label):
+        self.refresh()
+        return len(self.label2graceids.get(label, []))
+
+class GPSIndex(AppendOnlyIndex):
+    '''
+    a sorted array of gpstimes (and the associated graceids) which we search with bisect. records are [gpstime, graceid]
+    events are typically created in gps order, so keeping the array sorted usually just means appending to it.
+    '''
+
+    def __reset__(self):
+        super(GPSIndex, self).__reset__()
+        self.gpstimes = []
+        self.sortedGraceids = []
+        self.graceid2gpstime = dict()
+
+    def __update__(self, record):
+        gpstime, graceid = record
+        ind = bisect_right(self.gpstimes, gpstime)
+        self.gpstimes.insert(ind, gpstime)
+        self.sortedGraceids.insert(ind, graceid)
+        self.graceid2gpstime[graceid] = gpstime
+
+    def __remove__(self, graceid):
+        gpstime = self.graceid2gpstime.pop(graceid, None)
+        if gpstime is None:
+            return
+        ind = bisect_left(self.gpstimes, gpstime)
+        while (ind < len(self.gpstimes)) and (self.gpstimes[ind]==gpstime):
+            if self.sortedGraceids[ind]==graceid:
+                del self.gpstimes[ind]
+                del self.sortedGraceids[ind]
+            else:
+                ind += 1
+
+    def __records__(self):
+        return [[gpstime, graceid] for gpstime, graceid in zip(self.gpstimes, self.sortedGraceids)]
+
+    def graceids(self, gpsstart, gpsstop):
+        '''
+        return the set of graceids with gpsstart <= gpstime <= gpsstop
+        '''
+        self.refresh()
+        return set(self.sortedGraceids[bisect_left(self.gpstimes, gpsstart):bisect_right(self.gpstimes, gpsstop)])
+
+class NodeIndex(AppendOnlyIndex):
+    '''
+    maps graceid -> lvalert node. records are [graceid, node]
+    nodes never change once an event is created, so we only go back to disk for graceids we have not seen yet.
+    '''
+
+    def __reset__(self):
+        super(NodeIndex, self).__reset__()
+        self.graceid2node = dict()
+
+    def __update__(self, record):
+        graceid, node = record
+        self.graceid2node[graceid] = node
+
+    def __remove__(self, graceid):
+        self.graceid2node.pop(graceid, None)
+
+    def __records__(self):
+        return [[graceid, node] for graceid, node in sorted(self.graceid2node.items())]
+
+    def node(self, graceid):
+        '''
+        return the node associated with graceid or None if we do not know it
+        '''
+        if graceid not in self.graceid2node:
+            self.refresh()
+        return self.graceid2node.get(graceid, None)
+
+class AttributeIndex(AppendOnlyIndex):
+    '''
+    maps graceid -> a few top-level attributes (eg: gpstime, far, created) and keeps a sorted array of (value, graceid) for each of sortKeys.
+    this lets us iterate over events in order, select ranges of values, or pull out these attributes without reading any events.
+    we also partition graceids by the value of each of partitionKeys (eg: pipeline). records are [graceid, attributes]
+    value(attributes, key) extracts the value we sort on.
+    events without a value for a key are kept in a separate sorted list of graceids (self.missing) and are ordered before everything else,
+    which is where python2 sorts None. This keeps None out of the comparisons, which python3 does not allow.
+    '''
+
+    def __init__(self, path, sortKeys, value, partitionKeys=[]):
+        self.sortKeys = sortKeys
+        self.partitionKeys = partitionKeys
+        self.value = value
+        super(AttributeIndex, self).__init__(path)
+
+    def __reset__(self):
+        super(AttributeIndex, self).__reset__()
+        self.graceid2attributes = dict()
+        self.sorted = dict((key, []) for key in self.sortKeys)
+        self.missing = dict((key, []) for key in self.sortKeys)
+        self.partitions = dict((key, dict()) for key in self.partitionKeys) ### key -> value -> set of graceids
+
+    def __update__(self, record):
+        graceid, attributes = record
+        if graceid in self.graceid2attributes: ### attributes never change, so repeated records (eg: from a backfill) are ignored
+            return
+        self.graceid2attributes[graceid] = attributes
+        for key, values in self.sorted.items():
+            value = self.value(attributes, key)
+            if value is None:
+                insort(self.missing[key], graceid)
+            else:
+                insort(values, (value, graceid))
+        for key, partition in self.partitions.items():
+            value = attributes.get(key)
+            if value in partition:
+                partition[value].add(graceid)
+            else:
+                partition[value] = set([graceid])
+
+    def __remove__(self, graceid):
+        attributes = self.graceid2attributes.pop(graceid, None)
+        if attributes is None:
+            return
+        for key, values in self.sorted.items():
+            value = self.value(attributes, key)
+            if value is None:
+                values = self.missing[key]
+                entry = graceid
+            else:
+                entry = (value, graceid)
+            ind = bisect_left(values, entry)
+            if (ind < len(values)) and (values[ind]==entry):
+                del values[ind]
+        for key, partition in self.partitions.items():
+            partition.get(attributes.get(key), set()).discard(graceid)
+
+    def __records__(self):
+        return [[graceid, attributes] for graceid, attributes in sorted(self.graceid2attributes.items())]
+
+    def __len__(self):
+        return len(self.graceid2attributes)
+
+    def attributes(self, graceid):
+        '''
+        return the attributes associated with graceid or None if we do not know them
+        '''
+        if graceid not in self.graceid2attributes:
+            self.refresh()
+        ans = self.graceid2attributes.get(graceid, None)
+        if ans is not None:
+            ans = dict(ans) ### callers may modify what we return
+        return ans
+
+    def ordered(self, key, reverse=False):
+        '''
+        iterate over graceids sorted by key (largest first if reverse)
+        NOTE: we only refresh before we start. Refreshing while we iterate (eg: through attributes for an unknown graceid) may shift what we yield
+        '''
+        self.refresh()
+        values = self.sorted[key]
+        missing = self.missing[key]
+        N = len(values)
+        M = len(missing)
+        if reverse:
+            for ind in xrange(N-1, -1, -1):
+                yield values[ind][1]
+            for ind in xrange(M-1, -1, -1):
+                yield missing[ind]
+        else:
+            for ind in xrange(M):
+                yield missing[ind]
+            for ind in xrange(N):
+                yield values[ind][1]
+
+    def __slice__(self, key, start, stop):
+        '''
+        the indecies bounding start <= value <= stop within the sorted array for key. Either end may be None (unbounded)
+        '''
+        self.refresh()
+        values = self.sorted[key]
+        if start is None:
+            lo = 0
+        else:
+            lo = bisectValues(values, start)
+        if stop is None:
+            hi = len(values)
+        else:
+            hi = bisectValues(values, stop, right=True)
+        return values, lo, max(lo, hi)
+
+    def range(self, key, start=None, stop=None):
+        '''
+        return the set of graceids with start <= value <= stop
+        '''
+        values, lo, hi = self.__slice__(key, start, stop)
+        return set(graceid for _, graceid in values[lo:hi])
+
+    def rangeSize(self, key, start=None, stop=None):
+        _, lo, hi = self.__slice__(key, start, stop)
+        return hi-lo
+
+    def partition(self, key, value):
+        '''
+        return the set of graceids for which attributes[key]==value
+        '''
+        self.refresh()
+        return set(self.partitions[key].get(value, []))
+
+    def partitionSize(self, key, value):
+        self.refresh()
+        return len(self.partitions[key].get(value, []))
+
+class EELIndex(AppendOnlyIndex):
+    '''
+    EELs sorted by when they were created, both for each EM group and for each waveband, so we can find (eg) every radio EEL from the last hour without visiting any events.
+    records are [created, graceid, N, group, waveband]
+    '''
+
+    def __reset__(self):
+        super(EELIndex, self).__reset__()
+        self.groups = dict() ### group -> sorted list of (created, graceid, N)
+        self.wavebands = dict() ### waveband -> sorted list of (created, graceid, N, group)
+        self.graceid2records = dict() ### graceid -> the records of every EEL we've seen for it
+
+    def __update__(self, record):
+        created, graceid, N, group, waveband = record
+        records = self.graceid2records.setdefault(graceid, [])
+        if any(n==N for _, _, n, _, _ in records): ### repeated records (eg: from recovering an interrupted write) are ignored
+            return
+        records.append( record )
+        insort(self.groups.setdefault(group, []), (created, graceid, N))
+        insort(self.wavebands.setdefault(waveband, []), (created, graceid, N, group))
+
+    def __remove__(self, graceid):
+        for created, _, N, group, waveband in self.graceid2records.pop(graceid, []):
+            for values, entry in [(self.groups[group], (created, graceid, N)), (self.wavebands[waveband], (created, graceid, N, group))]:
+                ind = bisect_left(values, entry)
+                if (ind < len(values)) and (values[ind]==entry):
+                    del values[ind]
+
+    def __records__(self):
+        return [record for graceid, records in sorted(self.graceid2records.items()) for record in records]
+
+    def __slice__(self, values, start, stop):
+        '''
+        the entries of values (sorted by created) with start <= created <= stop. Either end may be None (unbounded)
+        '''
+        lo = 0 if start is None else bisectValues(values, start)
+        hi = len(values) if stop is None else bisectValues(values, stop, right=True)
+        return values[lo:hi]
+
+    def find(self, group=None, waveband=None, start=None, stop=None):
+        '''
+        return (graceid, N) for the EELs from group in waveband created between start and stop, oldest first. Any of these may be None (no constraint).
+        a waveband includes every narrower waveband, eg: "em.radio" includes "em.radio.3-6GHz"
+        '''
+        self.refresh()
+        if waveband is None:
+            if group is None:
+                matches = [self.__slice__(values, start, stop) for values in self.groups.values()]
+            else:
+                matches = [self.__slice__(self.groups.get(group, []), start, stop)]
+            return [(graceid, N) for _, graceid, N in sorted(match for values in matches for match in values)]
+
+        matches = [self.__slice__(values, start, stop) for band, values in self.wavebands.items() if (band==waveband) or band.startswith(waveband+'.')]
+        return [(graceid, N) for _, graceid, N, grp in sorted(match for values in matches for match in values) if (group is None) or (grp==group)]
+
+class TagIndex(AppendOnlyIndex):
+    '''
+    maps tag name -> set of (graceid, N) for the log messages that currently carry that tag.
+    records are [graceid, N, name, applied] and are folded in the order they were written, so a tag that was deleted (applied=False) and created again is tagged.
+    writers append records for an event while they hold its lock, so records for each log message are in the order they happened
+    '''
+
+    def __reset__(self):
+        super(TagIndex, self).__reset__()
+        self.tag2keys = dict()
+        self.graceid2tags = dict() ### graceid -> (N, name) for every tag ever applied to its log messages
+
+    def __update__(self, record):
+        graceid, N, name, applied = record
+        if applied:
+            self.tag2keys.setdefault(name, set()).add( (graceid, N) )
+            self.graceid2tags.setdefault(graceid, set()).add( (N, name) )
+        elif name in self.tag2keys:
+            self.tag2keys[name].discard( (graceid, N) )
+
+    def __remove__(self, graceid):
+        for N, name in self.graceid2tags.pop(graceid, []):
+            self.tag2keys[name].discard( (graceid, N) )
+
+    def __records__(self):
+        return [[graceid, N, name, True] for name, keys in sorted(self.tag2keys.items()) for graceid, N in sorted(keys)]
+
+    def keys(self, name):
+        self.refresh()
+        return set(self.tag2keys.get(name, []))
+
+#-------------------------------------------------
+
+class Counters(object):
+    '''
+    a small JSON file of named counters (eg: the number of events with each label) shared across processes.
+    increments are a read-modify-write under an exclusive lock, and the file is replaced atomically so readers never need the lock.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return dict()
+        file_obj = open(self.path, 'r')
+        ans = json.load(file_obj)
+        file_obj.close()
+        return ans
+
+    def get(self, key):
+        return self.read().get(key, 0)
+
+    def lock(self):
+        '''
+        the lock held while counters are updated. Callers may hold it to update something else (eg: a LabelIndex) along with the counters
+        '''
+        return FileLock(self.path+'.lock')
+
+    def increment(self, deltas):
+        '''
+        deltas is a dictionary mapping key -> amount
+        '''
+        with self.lock():
+            counts = self.read()
+            for key, delta in deltas.items():
+                counts[key] = counts.get(key, 0) + delta
+            os.rename(self.__dump__(counts), self.path)
+
+    def assign(self, values):
+        '''
+        values is a dictionary mapping key -> count, which replaces whatever we had for those keys
+        '''
+        with self.lock():
+            counts = self.read()
+            counts.update(values)
+            os.rename(self.__dump__(counts), self.path)
+
+    def publish(self, counts):
+        '''
+        write counts if the file does not exist yet. If another process beat us to it, we keep theirs
+        '''
+        tmp = self.__dump__(counts)
+        try:
+            os.link(tmp, self.path)
+        except OSError:
+            pass
+        os.remove(tmp)
+
+    def __dump__(self, counts):
+        '''
+        write counts into a temporary file next to self.path and return its name
+        '''
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.tmp')
+        file_obj = os.fdopen(fd, 'w')
+        json.dump(counts, file_obj)
+        file_obj.close()
+        return tmp
@@ -0,0 +1,121 @@
+description = "a module that provides append-only record journals used to store FakeDb collections"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import json
+
+import time
+
+#-------------------------------------------------
+
+class Journal(object):
+    '''
+    an append-only file of JSON records (one per line) preceeded by a fixed-width header that records how many records are stored.
+    appending a record only touches the end of the file and the header, so it costs the same regardless of how many records already exist.
+    the header is a cached count, so we can report the number of records without deserializing anything.
+    it is also the commit point: records are written before the header is updated and readers only ever look at as many records as the header reports,
+    so a writer that dies part way through an append leaves behind (at worst) trailing garbage that no one reads and truncate removes.
+    if stats (see ligoTest.gracedb.stats) is not None, we count the bytes we read and write and the time we spend encoding and decoding JSON.
+    '''
+    __headerFormat__ = "%015d\n"
+    __headerSize__   = 16
+
+    def __init__(self, path, stats=None):
+        self.path = path
+        self.stats = stats
+
+    def create(self, records=[]):
+        '''
+        write a new journal holding only records (by default, just the header) with a single write
+        '''
+        lines = self.__encode__(records) if records else ""
+        file_obj = open(self.path, 'w')
+        file_obj.write(self.__headerFormat__%len(records) + lines)
+        file_obj.close()
+
+    def __encode__(self, records):
+        if self.stats is None:
+            return "".join(json.dumps(record)+"\n" for record in records)
+        t0 = time.time()
+        lines = "".join(json.dumps(record)+"\n" for record in records)
+        self.stats.serialization('json', time.time()-t0)
+        self.stats.write(len(lines))
+        return lines
+
+    def __readHeader__(self, file_obj):
+        file_obj.seek(0, 0)
+        return int(file_obj.read(self.__headerSize__))
+
+    def __len__(self):
+        file_obj = open(self.path, 'r')
+        N = self.__readHeader__(file_obj)
+        file_obj.close()
+
+        return N
+
+    def append(self, record):
+        '''
+        append a single record to the end of the journal and update the header
+        returns the index of the new record
+        '''
+        return self.extend([record])
+
+    def extend(self, records):
+        '''
+        append several records with a single write and a single update of the header
+        returns the index of the first new record
+        '''
+        lines = self.__encode__(records)
+
+        file_obj = open(self.path, 'r+')
+        file_obj.seek(0, 2) ### go to end of file
+        file_obj.write(lines)
+
+        N = self.__readHeader__(file_obj)
+        file_obj.seek(0, 0)
+        file_obj.write(self.__headerFormat__%(N+len(records)))
+        file_obj.close()
+
+        return N
+
+    def __iter__(self):
+        '''
+        iterate over the records stored in the journal without loading all of them into memory at once
+        '''
+        file_obj = open(self.path, 'r')
+        N = self.__readHeader__(file_obj) ### anything beyond this was never committed
+        for _ in range(N):
+            yield json.loads(file_obj.readline())
+        file_obj.close()
+
+    def truncate(self, N):
+        '''
+        keep only the first N records, discarding everything after them (including records that were never committed)
+        '''
+        file_obj = open(self.path, 'r+')
+        self.__readHeader__(file_obj)
+        for _ in range(N):
+            file_obj.readline()
+        file_obj.truncate(file_obj.tell())
+        file_obj.seek(0, 0)
+        file_obj.write(self.__headerFormat__%N)
+        file_obj.close()
+
+    def extract(self):
+        '''
+        return a list of all the records in the journal
+        '''
+        if self.stats is None:
+            return list(self)
+
+        file_obj = open(self.path, 'r')
+        N = self.__readHeader__(file_obj)
+        lines = [file_obj.readline() for _ in range(N)]
+        file_obj.close()
+        self.stats.read(self.__headerSize__+sum(len(line) for line in lines))
+
+        t0 = time.time()
+        ans = [json.loads(line) for line in lines]
+        self.stats.serialization('json', time.time()-t0)
+        return ans
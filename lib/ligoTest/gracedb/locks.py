@@ -0,0 +1,122 @@
+description = "a module that provides the locking and appending primitives that let many processes write to the same FakeDb"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import fcntl
+import tempfile
+
+import threading
+
+#-------------------------------------------------
+
+class FileLock(object):
+    '''
+    an exclusive advisory lock (fcntl.flock) on a file, which excludes other processes and other threads.
+    the lock is re-entrant within a thread, so methods that hold it may call other methods that grab it as well.
+
+    usage:
+        with FileLock(path):
+            do stuff
+    '''
+    __held__ = threading.local() ### path -> [depth, file_obj] for the locks held by this thread
+
+    def __init__(self, path):
+        self.path = path
+
+    def __state__(self):
+        if not hasattr(self.__held__, 'locks'):
+            self.__held__.locks = dict()
+        return self.__held__.locks
+
+    def acquire(self):
+        locks = self.__state__()
+        if self.path in locks: ### we already hold this lock
+            locks[self.path][0] += 1
+        else:
+            file_obj = open(self.path, 'a') ### creates the lock file if needed
+            fcntl.flock(file_obj, fcntl.LOCK_EX)
+            locks[self.path] = [1, file_obj]
+
+    def release(self):
+        locks = self.__state__()
+        locks[self.path][0] -= 1
+        if locks[self.path][0]==0:
+            _, file_obj = locks.pop(self.path)
+            fcntl.flock(file_obj, fcntl.LOCK_UN)
+            file_obj.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+#-------------------------------------------------
+
+def atomicAppend(path, data):
+    '''
+    append data to path with a single write to a file descriptor opened with O_APPEND.
+    the kernel positions each such write at the end of the file, so concurrent appends from different processes never interleave.
+    '''
+    if not isinstance(data, bytes): ### python3 strings must be encoded before we hand them to os.write
+        data = data.encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def lockedAppend(path, data):
+    '''
+    like atomicAppend, but for files that are occasionally rewritten and replaced (eg: when an index is compacted, see ligoTest.gracedb.index).
+    we hold a shared lock on path while we write and make sure path still refers to the file we locked. Whoever replaces path holds the
+    exclusive lock until the new file is in place, so nothing we append is left behind in the old one.
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                current = os.stat(path).st_ino
+            except OSError: ### replaced and not yet put back, so we try again
+                current = None
+            if current==os.fstat(fd).st_ino:
+                os.write(fd, data)
+                return
+        finally:
+            os.close(fd) ### also releases the lock
+
+def lockedReplace(path, build, sync=None):
+    '''
+    replace path with the data returned by build(), which is called while we hold the exclusive lock lockedAppend waits for, so no appends are lost.
+    build may return None to leave path as it is. sync (eg: Durability.sync) is handed the new file before it is moved into place.
+    returns the inode and size of the new file, or None if we did not replace path
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.stat(path).st_ino!=os.fstat(fd).st_ino: ### someone else replaced it while we waited
+            return None
+        data = build()
+        if data is None:
+            return None
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        tmpfd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            os.write(tmpfd, data)
+        finally:
+            os.close(tmpfd)
+        if sync is not None:
+            sync(tmp)
+        stat = os.stat(tmp)
+        os.rename(tmp, path)
+        return stat.st_ino, stat.st_size
+    finally:
+        os.close(fd)
@@ -0,0 +1,505 @@
+description = "a module that compiles FakeDb.events queries into plans that use the storage backend's indexes"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import re
+
+import time
+import calendar
+
+from ligoTest.gracedb.compat import xrange
+
+#-------------------------------------------------
+
+class QueryError(ValueError):
+    '''
+    raised when we cannot compile a query
+    '''
+
+#-------------------------------------------------
+
+class Clause(object):
+    '''
+    a node within a compiled query.
+    every clause can test a single graceid (match). Some can also look up the graceids they match through one of
+    the storage backend's indexes (graceids), in which case size estimates how many graceids that returns.
+    size returns None when a clause cannot be answered with an index.
+    '''
+
+    def size(self, storage):
+        return None
+
+    def count(self, storage):
+        '''
+        the exact number of events this clause matches if we can get it without visiting them. Otherwise, None
+        '''
+        return None
+
+    def graceids(self, storage):
+        raise NotImplementedError
+
+    def match(self, storage, graceid):
+        raise NotImplementedError
+
+class Label(Clause):
+
+    def __init__(self, label):
+        self.label = label
+        self.__graceids__ = None
+
+    def size(self, storage):
+        return storage.labelSize(self.label)
+
+    def count(self, storage):
+        return storage.count('label', self.label)
+
+    def graceids(self, storage):
+        return storage.label2graceids(self.label)
+
+    def match(self, storage, graceid):
+        if self.__graceids__ is None: ### look this up once and test membership for every graceid
+            self.__graceids__ = self.graceids(storage)
+        return graceid in self.__graceids__
+
+class Range(Clause):
+    '''
+    start <= value <= stop for one of the storage backend's rangeKeys. Either end may be None (unbounded) or excluded (strict inequalities)
+    '''
+
+    def __init__(self, key, start=None, stop=None, startOpen=False, stopOpen=False):
+        self.key = key
+        self.start = start
+        self.stop = stop
+        self.startOpen = startOpen
+        self.stopOpen = stopOpen
+
+    def size(self, storage):
+        return storage.rangeSize(self.key, self.start, self.stop)
+
+    def count(self, storage):
+        if self.startOpen or self.stopOpen: ### we have to check the end points
+            return None
+        return self.size(storage)
+
+    def graceids(self, storage):
+        ans = storage.range2graceids(self.key, self.start, self.stop)
+        if self.startOpen or self.stopOpen: ### the index is inclusive, so we remove the end points
+            ans = set(graceid for graceid in ans if self.match(storage, graceid))
+        return ans
+
+    def match(self, storage, graceid):
+        value = storage.queryAttributes(graceid).get(self.key)
+        if value is None:
+            return False
+        if self.start is not None:
+            if (value < self.start) or (self.startOpen and value==self.start):
+                return False
+        if self.stop is not None:
+            if (value > self.stop) or (self.stopOpen and value==self.stop):
+                return False
+        return True
+
+class Equals(Clause):
+    '''
+    value == x for one of the storage backend's valueKeys (eg: pipeline)
+    '''
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def size(self, storage):
+        return storage.valueSize(self.key, self.value)
+
+    def count(self, storage):
+        return storage.count(self.key, self.value)
+
+    def graceids(self, storage):
+        return storage.value2graceids(self.key, self.value)
+
+    def match(self, storage, graceid):
+        return storage.queryAttributes(graceid).get(self.key)==self.value
+
+class GraceidRange(Clause):
+    '''
+    graceids with the same letter as start and stop whose numbers fall between them (inclusive)
+    '''
+
+    def __init__(self, start, stop):
+        if start[0]!=stop[0]:
+            raise QueryError('graceid range %s .. %s spans more than one letter'%(start, stop))
+        self.letter = start[0]
+        self.start = int(start[1:])
+        self.stop = int(stop[1:])
+        self.width = len(start)-1
+
+    def size(self, storage):
+        return max(0, self.stop-self.start+1)
+
+    def graceids(self, storage):
+        graceids = ["%s%0*d"%(self.letter, self.width, num) for num in xrange(self.start, self.stop+1)]
+        return set(graceid for graceid in graceids if storage.exists(graceid))
+
+    def match(self, storage, graceid):
+        return (graceid[0]==self.letter) and (self.start <= int(graceid[1:]) <= self.stop)
+
+class Not(Clause):
+
+    def __init__(self, clause):
+        self.clause = clause
+
+    def match(self, storage, graceid):
+        return not self.clause.match(storage, graceid)
+
+class And(Clause):
+
+    def __init__(self, clauses):
+        self.clauses = clauses
+
+    def size(self, storage):
+        sizes = [size for size in [clause.size(storage) for clause in self.clauses] if size is not None]
+        if sizes:
+            return min(sizes)
+        return None
+
+    def plan(self, storage):
+        '''
+        pick the clause backed by the most selective index and return (graceids, residual), where graceids is what that index matches
+        (None if no clause uses an index, meaning every event) and residual lists the clauses we still have to test
+        '''
+        best = None
+        for clause in self.clauses:
+            size = clause.size(storage)
+            if (size is not None) and ((best is None) or (size < best[0])):
+                best = (size, clause)
+
+        if best is None:
+            return None, list(self.clauses)
+        return best[1].graceids(storage), [clause for clause in self.clauses if clause is not best[1]]
+
+    def graceids(self, storage):
+        graceids, residual = self.plan(storage)
+        return set(graceid for graceid in graceids if all(clause.match(storage, graceid) for clause in residual))
+
+    def match(self, storage, graceid):
+        return all(clause.match(storage, graceid) for clause in self.clauses)
+
+class Or(Clause):
+
+    def __init__(self, clauses):
+        self.clauses = clauses
+
+    def size(self, storage):
+        sizes = [clause.size(storage) for clause in self.clauses]
+        if None in sizes: ### we have to visit every event for at least one of these
+            return None
+        return sum(sizes)
+
+    def graceids(self, storage):
+        ans = set()
+        for clause in self.clauses:
+            ans.update( clause.graceids(storage) )
+        return ans
+
+    def match(self, storage, graceid):
+        return any(clause.match(storage, graceid) for clause in self.clauses)
+
+#-------------------------------------------------
+
+class Query(object):
+    '''
+    a compiled query, which is the conjunction of several clauses
+    '''
+
+    def __init__(self, clauses):
+        self.root = And(clauses)
+
+    def plan(self, storage):
+        '''
+        returns (graceids, match). graceids is the set of candidates drawn from the most selective index (or None for every event)
+        and match tests the remaining clauses for a single graceid. Callers should apply match lazily as they stream through candidates
+        '''
+        graceids, residual = self.root.plan(storage)
+        if residual:
+            match = lambda graceid: all(clause.match(storage, graceid) for clause in residual)
+        else:
+            match = None
+        return graceids, match
+
+    def count(self, storage):
+        '''
+        the number of events matching this query.
+        a single clause is answered with the storage backend's counters when possible. Otherwise we intersect what each index matches,
+        smallest first, and only visit events to test clauses that cannot use an index
+        '''
+        clauses = self.root.clauses
+        if not clauses:
+            return storage.count()
+        if len(clauses)==1:
+            ans = clauses[0].count(storage)
+            if ans is not None:
+                return ans
+
+        indexed = []
+        residual = []
+        for clause in clauses:
+            size = clause.size(storage)
+            if size is None:
+                residual.append( clause )
+            else:
+                indexed.append( (size, clause) )
+
+        if not indexed:
+            return sum(1 for graceid in storage.iterGraceids() if self.root.match(storage, graceid))
+
+        indexed.sort(key=lambda pair: pair[0])
+        graceids = indexed[0][1].graceids(storage)
+        for size, clause in indexed[1:]:
+            if not graceids:
+                return 0
+            if size <= len(graceids): ### cheap enough to look up the whole set
+                graceids = graceids.intersection(clause.graceids(storage))
+            else: ### cheaper to test each of the graceids we still have
+                residual.append( clause )
+
+        return sum(1 for graceid in graceids if all(clause.match(storage, graceid) for clause in residual))
+
+#-------------------------------------------------
+
+__tokenize__ = re.compile(r'"[^"]*"|\.\.|<=|>=|==|[<>=:&|~()]|(?:[^\s"<>=:&|~().]|\.(?!\.))+')
+
+__rangeKeys__ = ['gpstime', 'far', 'created']
+__valueKeys__ = ['group', 'pipeline', 'search']
+__comparisons__ = ['<', '<=', '>', '>=', '=', '==', ':']
+
+class Compiler(object):
+    '''
+    a recursive-descent compiler for the query language understood by FakeDb.events. Terms are
+
+        far < 1e-7                            (also <=, >, >=, = and "far: 1e-8 .. 1e-6", for far, gpstime and created)
+        gpstime: 1177672330 .. 1177672360     (or just "1177672330 .. 1177672360")
+        created: "2017-05-01" .. "2017-05-02" (dates are UTC; unix timestamps work too)
+        group: CBC, pipeline: gstlal, search: LowMass (or just the name)
+        T000010 .. T000020                    (or a single graceid)
+        EM_READY                              (a label)
+
+    terms can be combined with & (AND), | (OR), ~ (NOT) and parentheses. Juxtaposed terms are ANDed together,
+    except for consecutive labels and consecutive gps ranges, which are ORed together (as FakeDb.events always did).
+    '''
+
+    def __init__(self, is_label, is_graceid, groups=[], pipelines=[], searches=[]):
+        self.is_label = is_label
+        self.is_graceid = is_graceid
+        self.names = dict()
+        for key, names in [('search', searches), ('pipeline', pipelines), ('group', groups)]: ### later keys win if a name is ambiguous
+            for name in names:
+                self.names[name.lower()] = key
+
+    def compile(self, query):
+        self.tokens = __tokenize__.findall(query)
+        self.ind = 0
+        clauses = self.__sequence__()
+        if self.ind < len(self.tokens):
+            raise QueryError('unexpected "%s"'%self.tokens[self.ind])
+        return Query(clauses)
+
+    ### token handling
+
+    def __peek__(self):
+        if self.ind < len(self.tokens):
+            return self.tokens[self.ind]
+        return None
+
+    def __pop__(self):
+        token = self.__peek__()
+        if token is None:
+            raise QueryError('unexpected end of query')
+        self.ind += 1
+        return token
+
+    def __expect__(self, tokens):
+        token = self.__pop__()
+        if token not in tokens:
+            raise QueryError('expected one of %s but found "%s"'%(", ".join(tokens), token))
+        return token
+
+    ### grammar
+
+    def __sequence__(self):
+        '''
+        juxtaposed expressions, which we AND together (except for runs of label expressions and runs of gps ranges, which are ORed)
+        '''
+        clauses = []
+        kind = None
+        while (self.__peek__() is not None) and (self.__peek__()!=')'):
+            clause = self.__disjunction__()
+            if self.__isLabelExpression__(clause):
+                clauseKind = 'label'
+            elif self.__isGpsRange__(clause):
+                clauseKind = 'gpstime'
+            else:
+                clauseKind = None
+            if (clauseKind is not None) and (clauseKind==kind):
+                clauses[-1] = Or([clauses[-1], clause])
+            else:
+                clauses.append( clause )
+            kind = clauseKind
+        return clauses
+
+    def __isLabelExpression__(self, clause):
+        if isinstance(clause, Label):
+            return True
+        if isinstance(clause, Not):
+            return self.__isLabelExpression__(clause.clause)
+        if isinstance(clause, (And, Or)):
+            return all(self.__isLabelExpression__(c) for c in clause.clauses)
+        return False
+
+    def __isGpsRange__(self, clause):
+        '''
+        "gpsstart .. gpsstop" (or "gpstime: gpsstart .. gpsstop"). One-sided thresholds like "gpstime > gpsstart" are not ranges, so they are still ANDed
+        '''
+        if isinstance(clause, Range):
+            return (clause.key=='gpstime') and (clause.start is not None) and (clause.stop is not None)
+        if isinstance(clause, Or):
+            return all(self.__isGpsRange__(c) for c in clause.clauses)
+        return False
+
+    def __disjunction__(self):
+        clauses = [self.__conjunction__()]
+        while self.__peek__() in ['|', 'OR']:
+            self.__pop__()
+            clauses.append( self.__conjunction__() )
+        if len(clauses)==1:
+            return clauses[0]
+        return Or(clauses)
+
+    def __conjunction__(self):
+        clauses = [self.__negation__()]
+        while self.__peek__() in ['&', 'AND']:
+            self.__pop__()
+            clauses.append( self.__negation__() )
+        if len(clauses)==1:
+            return clauses[0]
+        return And(clauses)
+
+    def __negation__(self):
+        token = self.__peek__()
+        if token in ['~', 'NOT']:
+            self.__pop__()
+            return Not(self.__negation__())
+
+        elif token=='(':
+            self.__pop__()
+            clauses = self.__sequence__()
+            self.__expect__([')'])
+            if len(clauses)==1:
+                return clauses[0]
+            return And(clauses)
+
+        return self.__term__()
+
+    def __term__(self):
+        token = self.__pop__()
+        key = token.lower()
+
+        if key in __rangeKeys__:
+            return self.__range__(key)
+
+        elif (key in __valueKeys__) and (self.__peek__() in [':', '=', '==']):
+            self.__pop__()
+            return Equals(key, self.__string__(self.__pop__()).lower())
+
+        elif (key in ['gid', 'graceid']) and (self.__peek__() in [':', '=', '==']):
+            self.__pop__()
+            return self.__graceid__(self.__pop__())
+
+        elif (key=='label') and (self.__peek__() in [':', '=', '==']):
+            self.__pop__()
+            label = self.__pop__()
+            if not self.is_label(label):
+                raise QueryError('%s is not a known label'%label)
+            return Label(label)
+
+        elif self.__isNumber__(token): ### a gps range
+            self.__expect__(['..'])
+            return Range('gpstime', float(token), self.__number__(self.__pop__()))
+
+        elif self.is_graceid(token):
+            return self.__graceid__(token)
+
+        elif self.is_label(token):
+            return Label(token)
+
+        elif key in self.names:
+            return Equals(self.names[key], key)
+
+        raise QueryError('could not understand "%s"'%token)
+
+    def __range__(self, key):
+        if key=='created':
+            convert = self.__created__
+        else:
+            convert = self.__number__
+
+        op = self.__expect__(__comparisons__)
+        value = convert(self.__pop__())
+        if op==':':
+            if self.__peek__()=='..':
+                self.__pop__()
+                return Range(key, value, convert(self.__pop__()))
+            return Range(key, value, value)
+        elif op in ['=', '==']:
+            return Range(key, value, value)
+        elif op=='<':
+            return Range(key, stop=value, stopOpen=True)
+        elif op=='<=':
+            return Range(key, stop=value)
+        elif op=='>':
+            return Range(key, start=value, startOpen=True)
+        else: ### op=='>='
+            return Range(key, start=value)
+
+    def __graceid__(self, token):
+        if not self.is_graceid(token):
+            raise QueryError('%s is not a graceid'%token)
+        if self.__peek__()=='..':
+            self.__pop__()
+            stop = self.__pop__()
+            if not self.is_graceid(stop):
+                raise QueryError('%s is not a graceid'%stop)
+            return GraceidRange(token, stop)
+        return GraceidRange(token, token)
+
+    ### values
+
+    def __string__(self, token):
+        return token.strip('"')
+
+    def __isNumber__(self, token):
+        try:
+            float(token)
+            return True
+        except ValueError:
+            return False
+
+    def __number__(self, token):
+        try:
+            return float(token)
+        except ValueError:
+            raise QueryError('could not interpret "%s" as a number'%token)
+
+    def __created__(self, token):
+        '''
+        a unix timestamp or a UTC date (YYYY-MM-DD, optionally with HH:MM:SS if quoted)
+        '''
+        token = self.__string__(token)
+        if self.__isNumber__(token):
+            return float(token)
+        for form in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+            try:
+                return float(calendar.timegm(time.strptime(token, form)))
+            except ValueError:
+                pass
+        raise QueryError('could not interpret "%s" as a time'%token)
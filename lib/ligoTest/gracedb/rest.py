@@ -9,11 +9,13 @@ import shutil
 
 import getpass
 
-import pickle
 import json
 
 import time
 
+import heapq
+import itertools
+
 import numpy as np
 
 from glue.ligolw import utils as ligolw_utils
@@ -22,24 +24,49 @@ from glue.ligolw import table
 from glue.ligolw import lsctables
 
 from ligoTest.lvalert import lvalertTestUtils as lvutils
+from ligoTest.gracedb.storage import initStorage, storages
+from ligoTest.gracedb.cache import LRUCache, DigestCache
+from ligoTest.gracedb.locks import lockedAppend
+from ligoTest.gracedb.durability import initDurability, durabilities
+from ligoTest.gracedb.stats import Stats
+from ligoTest.gracedb.blobs import BlobStore
+from ligoTest.gracedb.query import Compiler, QueryError
+from ligoTest.gracedb.extract import readTable
+from ligoTest.gracedb.footprints import Footprints, FootprintIndex, asFloats, gps2utc
+from ligoTest.gracedb.retention import Retention
+from ligoTest.gracedb import voevent as voe
+from ligoTest.gracedb import dumps as dmp
+from ligoTest.gracedb.compat import xrange, basestring, ifilter
 
 #-------------------------------------------------
 
 class FakeTTPResponse():
     """
     a "fake" httpResponse that provides some basic functionality
+    we hold onto data and only serialize it if someone calls read(), so json() just hands data back.
+    like an httpResponse, the body can only be consumed once: after read() or json(), read() returns '' and json() raises ValueError.
+    FakeDb never shares data with its in-process cache (see ligoTest.gracedb.cache.LRUCache), so callers may modify what json() returns.
     """
 
     def __init__(self, data):
-        self.data = json.dumps( data )
+        self.data = data
+        self.consumed = False
+
+    def __consume__(self):
+        if self.consumed:
+            raise ValueError('No JSON object could be decoded') ### what json.loads('') raised when we stored the serialized data
+        self.consumed = True
+        data = self.data
+        self.data = None
+        return data
 
     def read(self):
-        ans = self.data
-        self.data = ''
-        return ans
+        if self.consumed:
+            return ''
+        return json.dumps( self.__consume__() )
 
     def json(self):
-        return json.loads( self.read() )
+        return self.__consume__()
 
 class FakeTTPError(Exception):
     """
@@ -269,7 +296,7 @@ class FakeDb():
 
     @property
     def groups(self):
-        return self.__allowedGroupPipelineSearch__.keys()
+        return list(self.__allowedGroupPipelineSearch__.keys())
 
     @property
     def pipelines(self):
@@ -284,7 +311,7 @@ class FakeDb():
         for key, val in self.__allowedGroupPipelineSearch__.items():
             for v in val.values():
                 ans += v
-        return [_ for _ in sorted(set(ans)) if _!=None]
+        return sorted(set(_ for _ in ans if _!=None))
 
     @property
     def em_groups(self):
@@ -300,53 +327,227 @@ class FakeDb():
 
     @property
     def eel_statuses(self):
-        return __allowedEELStatuses__
+        return self.__allowedEELStatuses__
 
     @property
     def obs_statuses(self):
-        return __allowedOBSStatuses__
+        return self.__allowedOBSStatuses__
 
     ### basic instantiation ###
 
-    def __init__(self, directory='.'):
+    def __init__(self, directory='.', storage=None, layout=None, dedup=None, durability=None, group_commit_window=None, cache_entries=1024, cache_bytes=2**26, stats=False, metrics_file=None, metrics_interval=60.):
         if not os.path.exists(directory):
             os.makedirs(directory)
         self.service_url = directory
         self.lvalert = os.path.join(directory, 'lvalert.out') ### file into which we write lvalert messages
+        self.config = os.path.join(directory, 'fakedb.json') ### file into which we record how data is stored
+
+        ### an in-process cache of decoded per-event data, validated against what's on disk before it is used
+        ### this means repeated reads (eg: long-running listeners polling FakeDb.logs) do not touch the disk unless something changed
+        if cache_entries and cache_bytes:
+            self.cache = LRUCache(maxEntries=cache_entries, maxBytes=cache_bytes)
+        else:
+            self.cache = None
+
+        ### attributes extracted from the files that create events, keyed by the files' contents
+        self.parsed = DigestCache(os.path.join(directory, 'parsed'))
+
+        ### every footprint of every EM observation, so we can search them all at once
+        self.footprints = FootprintIndex(os.path.join(directory, 'footprints.dat'))
+
+        ### counters of calls, latencies, bytes and lvalert messages (see FakeDb.stats). These cost nothing unless asked for
+        ### stats may be a ligoTest.gracedb.stats.Stats instance shared by several FakeDb instances (eg: the workers of ligoTest.gracedb.server)
+        if isinstance(stats, Stats):
+            self.metrics = stats
+        elif stats or metrics_file:
+            self.metrics = Stats(path=metrics_file, interval=metrics_interval) ### periodically dumped into metrics_file as JSON
+        else:
+            self.metrics = None
+
+        ### when what we write is forced onto disk: never ("none"), after every write ("fsync"), or batched across writers every group_commit_window seconds ("group")
+        config = self.__loadConfig__(storage=storage, layout=layout, dedup=dedup, durability=durability, group_commit_window=group_commit_window)
+        self.durability = initDurability(config['durability'], window=config.get('group_commit_window'))
+        self.storage = initStorage(config['storage'], directory, is_graceid=self.__is_graceid__, cache=self.cache, layout=config['layout'], durability=self.durability, stats=self.metrics) ### delegate all persistence to this object
+
+        ### uploaded files are either copied into each event's directory or stored once by content and linked into place
+        if config['dedup']:
+            self.blobs = BlobStore(os.path.join(directory, 'blobs'))
+        else:
+            self.blobs = None
+
+        if self.metrics is not None: ### time every public method of this instance
+            self.metrics.instrument(self, exclude=['stats', 'cacheStats'])
+
+    def __loadConfig__(self, **kwargs):
+        '''
+        reads in the settings recorded within self.config and reconciles them with kwargs.
+        settings that are specified (not None) and not yet recorded are written into self.config, along with 
+        defaults the first time we see a directory, so that every FakeDb instance pointed at this directory (eg: one per Action via schedule.initGraceDb) agrees on them.
+        '''
+        if os.path.exists(self.config):
+            file_obj = open(self.config, 'r')
+            config = json.load(file_obj)
+            file_obj.close()
+            update = False
+
+        else: ### first time we've seen this directory, so we record the settings
+            if [path for path in os.listdir(self.service_url) if self.__is_graceid__(path)]: ### data written before we recorded settings, so it must be the default
+                config = {'storage':'pickle'}
+            else:
+                config = {}
+            update = True
+
+        for key, val in kwargs.items():
+            if val is None: ### not specified, so we use whatever is recorded
+                continue
+            if key in config:
+                if config[key]!=val:
+                    raise ValueError('%s=%s conflicts with %s=%s recorded in %s'%(key, val, key, config[key], self.config))
+            else:
+                config[key] = val
+                update = True
+
+        if 'storage' not in config: ### nothing specified or recorded, so we fall back to the default
+            config['storage'] = 'pickle'
+        if config['storage'] not in storages:
+            raise ValueError('storage=%s not understood'%config['storage'])
+        if 'layout' not in config:
+            config['layout'] = 'flat'
+        if config['layout'] not in storages[config['storage']].layouts:
+            raise ValueError('layout=%s not understood'%config['layout'])
+        if 'dedup' not in config:
+            config['dedup'] = False
+        if 'durability' not in config:
+            config['durability'] = 'none'
+        if config['durability'] not in durabilities:
+            raise ValueError('durability=%s not understood'%config['durability'])
+
+        if update:
+            file_obj = open(self.config, 'w')
+            json.dump(config, file_obj)
+            file_obj.close()
+            initDurability(config['durability']).sync(self.config, self.service_url)
+
+        return config
+
+    def cacheStats(self):
+        '''
+        report how well the in-process cache is doing (hits, misses, entries, bytes)
+        '''
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    def stats(self):
+        '''
+        report what we've counted since this instance was created (see ligoTest.gracedb.stats.Stats.snapshot) along with cacheStats.
+        returns an empty dictionary unless we were instantiated with stats=True (or metrics_file)
+        '''
+        if self.metrics is None:
+            return {}
+        ans = self.metrics.snapshot()
+        ans['cache'] = self.cacheStats()
+        return ans
 
     ### write lvalert messages into a file ###
 
     def sendlvalert(self, message, node ):
-        file_obj = open(self.lvalert, 'a')
-        print >> file_obj, lvutils.alert2line(node, json.dumps(message))
-        file_obj.close()
+        self.sendlvalerts( [(message, node)] )
+
+    def sendlvalerts(self, alerts):
+        '''
+        write several (message, node) pairs with a single write
+        this is done with O_APPEND so that alerts from concurrent writers are never interleaved,
+        and under a shared lock so that none are lost when gc starts a new file (see ligoTest.gracedb.retention)
+        '''
+        if self.metrics is None:
+            lines = "".join(lvutils.alert2line(node, json.dumps(message))+"\n" for message, node in alerts)
+        else:
+            t0 = time.time()
+            lines = "".join(lvutils.alert2line(node, json.dumps(message))+"\n" for message, node in alerts)
+            self.metrics.serialization('json', time.time()-t0)
+            self.metrics.write(len(lines))
+            self.metrics.lvalerts(len(alerts))
+        lockedAppend( self.lvalert, lines )
+        self.durability.sync(self.lvalert)
 
     def __node__(self, graceid):
         '''
         figures out the node name given a graceid
+        nodes are recorded when events are created, so this usually does not need to read the event
         '''
-        event = self.event(graceid).json() ### load in the parameters
+        node = self.storage.node(graceid)
+        if node is None: ### event was created before we recorded nodes, so we figure it out and record it
+            node = self.__event2node__(self.event(graceid).json()) ### load in the parameters
+            self.storage.setNode(graceid, node)
+
+        return node
 
-        return "%s_%s_%s"%(event['group'], event['pipeline'], event['search']) if event.has_key('search') else "%s_%s"%(event['group'], event['pipeline'])
+    def __event2node__(self, event):
+        '''
+        figures out the node name given an event's top-level data
+        '''
+        return "%s_%s_%s"%(event['group'], event['pipeline'], event['search']) if 'search' in event else "%s_%s"%(event['group'], event['pipeline'])
                 
     ### conditionals on allowed actions ###
 
     def check_group_pipeline_search(self, group, pipeline, search):
-        if not self.__allowedGroupPipelineSearch__.has_key(group):
+        if group not in self.__allowedGroupPipelineSearch__:
             raise FakeTTPError('bad group : %s'%group)
 
-        if not self.__allowedGroupPipelineSearch__[group].has_key(pipeline):
+        if pipeline not in self.__allowedGroupPipelineSearch__[group]:
             raise FakeTTPError('bad group, pipeline : %s, %s'%(group, pipeline))
 
         if search not in self.__allowedGroupPipelineSearch__[group][pipeline]:
             raise FakeTTPError('bad group, pipeline, search : %s, %s, %s'%(group, pipeline, search))
 
+    def __allowedNames__(self, group, pipeline, search):
+        '''
+        the names group, pipeline and search are allowed under, ignoring case (we store them in lower case while GraceDb reports them as they are listed)
+        '''
+        def match(name, names):
+            for allowed in names:
+                if (allowed is not None) and (name is not None) and (allowed.lower()==name.lower()):
+                    return allowed
+            return name ### check_group_pipeline_search rejects it
+        group = match(group, self.__allowedGroupPipelineSearch__)
+        pipeline = match(pipeline, self.__allowedGroupPipelineSearch__.get(group, {}))
+        search = match(search, self.__allowedGroupPipelineSearch__.get(group, {}).get(pipeline, []))
+        return group, pipeline, search
+
     def check_label(self, label):
         if label not in self.__allowedLabels__:
             raise FakeTTPError('label=%s not allowed'%label)
 
+    def check_emgroup(self, group):
+        if group not in self.__allowedEMGroups__:
+            raise FakeTTPError('bad EM group : %s'%group)
+
+    def check_voevent_type(self, voevent_type):
+        '''
+        GraceDb's clients accept either the code (eg: "PR") or the name (eg: "preliminary") of a VOEvent type. We return the code
+        '''
+        if voevent_type in self.__allowedVOEventTypes__:
+            return voevent_type
+        for code, name in self.__allowedVOEventTypes__.items():
+            if name==('%s'%voevent_type).lower():
+                return code
+        raise FakeTTPError('bad voevent_type : %s'%voevent_type)
+
+    def check_waveband(self, waveband):
+        if waveband not in self.__allowedWavebands__:
+            raise FakeTTPError('bad waveband : %s'%waveband)
+
+    def check_eel_status(self, eel_status):
+        if eel_status not in self.__allowedEELStatuses__:
+            raise FakeTTPError('bad eel_status : %s'%eel_status)
+
+    def check_obs_status(self, obs_status):
+        if obs_status not in self.__allowedOBSStatuses__:
+            raise FakeTTPError('bad obs_status : %s'%obs_status)
+
     def check_graceid(self, graceid):
-        if not os.path.exists(self.__directory__(graceid)):
+        if not self.storage.exists(graceid):
             raise FakeTTPError('could not find graceid=%s'%graceid)
 
 
@@ -369,96 +570,73 @@ class FakeDb():
             return False
 
     def __get_all_graceids__(self):
-        graceids = []
-        for path in os.listdir(self.service_url):
-            path = os.path.basename(path)
-            if self.__is_graceid__(path):
-                graceids.append( path )
-        return graceids
+        return self.storage.graceids()
 
     def __genGraceID__(self, group):
         '''
-        looks up the known GraceIDs within the directory.
-        returns the biggest one +1
-        if none exist, starts at 000000
+        draws the next index for this group's letter from a persistent counter managed by self.storage.
+        the counter is lock-protected, so concurrent processes never receive the same GraceID.
+        if no counter exists yet, it starts from the biggest known GraceID with this letter +1 (or 000000)
         '''
-        existing = [int(graceid[1:]) for graceid in self.__get_all_graceids__()]
-        if existing:
-            ind = max(existing)+1
-        else:
-            ind = 0
+        return self.reserveGraceIDs(group)[0]
 
-        return "%s%06d"%(self.__group2letter__[group], ind)
+    def reserveGraceIDs(self, group, num=1):
+        '''
+        reserves a block of num consecutive GraceIDs for this group with a single update of the persistent counter.
+        intended for bulk creators, which can then assign these GraceIDs without re-visiting the counter.
+        '''
+        letter = self.__group2letter__[group.lower()]
+        start = self.storage.reserve(letter, num=num)
+        return ["%s%06d"%(letter, ind) for ind in xrange(start, start+num)]
             
     def __directory__(self, graceid):
         '''
         generates the directory associated with this graceid
         '''
-        return os.path.join(self.service_url, graceid)
+        return self.storage.directory(graceid)
 
     def __topLevelPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'toplevel.pkl')
+        return self.storage.path(graceid, 'toplevel')
 
     def __filesPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'files.pkl')
+        return self.storage.path(graceid, 'files')
 
     def __labelsPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'labels.pkl')
+        return self.storage.path(graceid, 'labels')
 
     def __logsPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'logs.pkl')
-
-    def __path2len__(self, path):
-        return len(self.__extract__(path))
+        return self.storage.path(graceid, 'logs')
 
-    def __append__(self, stuff, path):
-        '''append to pkl file'''
-        ans = self.__extract__(path)
-        ans.append(stuff)
-        self.__write__(ans, path)
+    def __emobservationsPath__(self, graceid):
+        return self.storage.path(graceid, 'emobservations')
 
-        return len(ans)-1
+    def __voeventsPath__(self, graceid):
+        return self.storage.path(graceid, 'voevents')
 
-    def __write__(self, stuff, path):
-        '''write stuff into pkl file'''
-        file_obj = open(path, 'w')
-        pickle.dump(stuff, file_obj)
-        file_obj.close()
+    def __eelsPath__(self, graceid):
+        return self.storage.path(graceid, 'eels')
 
-    def __extract__(self, path):
-        '''read from pkl file'''
-        file_obj = open(path, 'r')
-        ans = pickle.load(file_obj)
-        file_obj.close()
-
-        return ans
+    def __footprints__(self, graceid):
+        return Footprints(os.path.join(self.__directory__(graceid), 'footprints.dat'))
 
     def __createDirectory__(self, graceid):
         '''
         generate local data structure for this graceid
         '''
-        d = self.__directory__(graceid)
-        if os.path.exists(d):
-            raise ValueError('graceid=%s already exists!'%graceid)
-        else:
-            os.makedirs(d) ### make directory
-            ### touch a bunch of files to make sure they exist
-            paths = [self.__filesPath__(graceid), 
-                     self.__labelsPath__(graceid), 
-                     self.__logsPath__(graceid),
-                    ]
-            for path in paths:
-                file_obj = open(path, 'w')
-                pickle.dump([], file_obj)
-                file_obj.close()
+        self.storage.create(graceid)
 
     def __newfilename__(self, graceid, filename):
-        return os.path.join(self.service_url, graceid, os.path.basename(filename))
+        return os.path.join(self.__directory__(graceid), os.path.basename(filename))
 
     def __copyFile__(self, graceid, filename):
         newFilename = self.__newfilename__(graceid, filename)
-        shutil.copyfile(filename, newFilename)
-        self.__append__( newFilename, self.__filesPath__(graceid) )
+        if self.blobs is None:
+            shutil.copyfile(filename, newFilename)
+        else:
+            self.blobs.store(filename, newFilename) ### identical uploads share a single copy on disk
+        if self.metrics is not None:
+            self.metrics.write(os.path.getsize(newFilename))
+        return newFilename
 
     ### insertion ###
 
@@ -469,16 +647,8 @@ class FakeDb():
                  'pipeline':pipeline,
                  'created':time.time(),
                  'submitter':getpass.getuser()+'@ligo.org',
-                 'labels' : dict((label, labelsPath) for label in self.__extract__(self.__labelsPath__(graceid))), ### NOTE: this is overkill for now, but we may want to support labeling during event creation, at which point we will want to perform this query.
-                 'links': {'neighbors':'',
-                           'files':self.__filesPath__(graceid),
-                           'log':self.__logsPath__(graceid),
-                           'tags':'',
-                           'self':self.__directory__(graceid),
-                           'labels':labelsPath,
-                           'filemeta':self.__topLevelPath__(graceid),
-                           'emobservations':'',
-                          },
+                 'labels' : dict((label['name'], labelsPath) for label in self.storage.extract(graceid, 'labels')), ### NOTE: this is overkill for now, but we may want to support labeling during event creation, at which point we will want to perform this query.
+                 'links': self.__links__(graceid),
                 }
         if search!=None:
             jsonD['search'] = search
@@ -487,7 +657,8 @@ class FakeDb():
         jsonD.update( self.__file2extraattributes__(pipeline, filename) )
          
         ### write top level data to file 
-        self.__write__( jsonD, self.__topLevelPath__(graceid) )
+        self.storage.write( graceid, jsonD )
+        self.storage.setNode( graceid, self.__event2node__(jsonD) ) ### record this once so we never have to read the event to send alerts
 
         lvalert = {"alert_type": "new",
                    "description": "",
@@ -498,34 +669,59 @@ class FakeDb():
 
         return jsonD, lvalert
 
+    def __links__(self, graceid):
+        return {'neighbors':'',
+                'files':self.__filesPath__(graceid),
+                'log':self.__logsPath__(graceid),
+                'tags':'',
+                'self':self.__directory__(graceid),
+                'labels':self.__labelsPath__(graceid),
+                'filemeta':self.__topLevelPath__(graceid),
+                'emobservations':self.__emobservationsPath__(graceid),
+                'embb':self.__eelsPath__(graceid),
+                'voevents':self.__voeventsPath__(graceid),
+               }
+
     def __file2extraattributes__(self, pipeline, filename):
+        '''
+        extract the top-level attributes for an event from the file that created it.
+        results are cached by the sha1 of the file's contents, so re-uploaded (or replayed) files are never parsed twice
+        '''
+        digest = self.parsed.digest(filename)
+        ans = self.parsed.get(pipeline, digest)
+        if ans is None:
+            ans = self.__parse__(pipeline, filename)
+            self.parsed.put(pipeline, digest, ans)
+        return ans
+
+    def __parse__(self, pipeline, filename):
         if pipeline == 'cwb':
-            file_obj = open(filename, 'r')
             ans = {'extra_attributes':{
                                       },
                   }
 
-            far = np.infty
-
+            ### cWB writes "key: value" pairs followed by a line containing "significance based on " and then a line whose second field is the FAR
+            file_obj = open(filename, 'r')
             readme = False
             for line in file_obj:
-                try:
-                    key, val = line.split(':')
-                    key = key.strip()
-                    if key == "likelihood":
-                        ans['likelihood'] = float(val.strip())
-                    elif key == 'time':
-                        ans['gpstime'] = float(val.split()[0].strip())
-                    elif key == 'ifo':
-                        ans['instruments'] = ",".join(val.split())
-                except:
-                    if readme:
-                        fields = [float(_) for _ in line.strip().split()]
-                        ans['far'] = fields[1]
-                        break
-                    
-                    readme = "significance based on " in line ### next line is a FAR statement
-                        
+                if readme:
+                    ans['far'] = float(line.split()[1])
+                    break
+
+                key, sep, val = line.partition(':')
+                key = key.strip()
+                if not sep:
+                    pass
+                elif key == "likelihood":
+                    ans['likelihood'] = float(val.strip())
+                elif key == 'time':
+                    ans['gpstime'] = float(val.split()[0].strip())
+                elif key == 'ifo':
+                    ans['instruments'] = ",".join(val.split())
+
+                readme = "significance based on " in line
+            file_obj.close()
+
         elif pipeline == 'lib':
             file_obj = open(filename, 'r')
             a = json.loads( file_obj.read() )
@@ -572,16 +768,21 @@ class FakeDb():
                   }
 
         elif pipeline in ['gstlal', 'gstlal-spiir', 'mbtaonline', 'pycbc']:
-            xmldoc = ligolw_utils.load_filename(filename, contenthandler=lsctables.use_in(ligolw.LIGOLWContentHandler))
+            ### stream through the document and stop once we have the CoincInspiralTable
+            try:
+                coinc = readTable(filename, lsctables.CoincInspiralTable.tableName)
+            except (ValueError, SyntaxError): ### something readTable does not understand, so we let glue have a go
+                coinc = None
 
-            ### extract table
-            coinc = table.get_table(xmldoc, lsctables.CoincInspiralTable.tableName)
+            if coinc is None:
+                xmldoc = ligolw_utils.load_filename(filename, contenthandler=lsctables.use_in(ligolw.LIGOLWContentHandler))
+                coinc = [dict((key, getattr(row, key)) for key in ['false_alarm_rate', 'ifos', 'end_time', 'end_time_ns']) for row in table.get_table(xmldoc, lsctables.CoincInspiralTable.tableName)]
 
             ### fill in ans with
             for row in coinc:
-                ans = {'far' : row.false_alarm_rate,
-                       'instruments' : row.ifos,
-                       'gpstime'     : row.end_time + 1e-9*row.end_time_ns,
+                ans = {'far' : row['false_alarm_rate'],
+                       'instruments' : row['ifos'],
+                       'gpstime'     : row['end_time'] + 1e-9*row['end_time_ns'],
                        'extra_attributes': {
                                            },
                       }
@@ -614,201 +815,781 @@ class FakeDb():
     ### annotation ###
 
     def __log__(self, graceid, message, filename=None, tagname=[]):
+        jsonDs, updates, lvalerts = self.__logs__(graceid, [(message, filename, tagname)])
+        self.storage.extend( graceid, updates )
+        return jsonDs[0], lvalerts[0]
+
+    def __logs__(self, graceid, logs):
+        '''
+        logs is a list of (message, filename, tagname) tuples. 
+        returns the new log entries, the updates that record them (and all uploaded files) and the lvalert messages.
+        nothing is recorded here: callers pass the updates (along with anything else that must be recorded alongside them) to a single self.storage.extend
+        NOTE: callers should hold self.storage.lock(graceid) so that concurrent writers do not claim the same N
+        '''
         username = getpass.getuser()
+        logs = [(message, filename, [tagname] if isinstance(tagname, basestring) else list(tagname or [])) for message, filename, tagname in logs] ### GraceDb accepts a single tag name or a list of them
+
+        ind = self.storage.length(graceid, 'logs')
+        jsonDs = []
+        newFilenames = []
+        shortFilenames = []
+        for i, (message, filename, tagname) in enumerate(logs):
+            if filename:
+                shortFilename = os.path.basename(filename)
+                newFilenames.append( self.__copyFile__(graceid, filename) )
+            else:
+                shortFilename = ''
+            shortFilenames.append( shortFilename )
+
+            jsonDs.append( {'comment': message,
+                            'created': time.time(),
+                            'self': self.__logsPath__(graceid),
+                            'file_version': 0,  
+                            'filename': shortFilename,
+                            'tag_names': tagname,
+                            'file': '',
+                            'N': ind+i+1,  
+                            'tags': '',
+                            'issuer': {'username': username+'@LIGO.ORG',
+                                       'display_name': username,
+                                      },
+                           }
+                         )
 
-        if filename:
-            shortFilename = os.path.basename(filename)
-        else:
-            shortFilename = ''
-
-        ind = self.__path2len__(self.__logsPath__(graceid))
-        jsonD = {'comment': message,
-                 'created': time.time(),
-                 'self': self.__logsPath__(graceid),
-                 'file_version': 0,  
-                 'filename': shortFilename,
-                 'tag_names': tagname,
-                 'file': '',
-                 'N': ind+1,  
-                 'tags': '',
-                 'issuer': {'username': username+'@LIGO.ORG',
-                            'display_name': username,
-                           },
-                }
+        if newFilenames:
+            self.durability.sync(*newFilenames) ### uploads must be on disk before the logs that refer to them
 
-        ind = self.__append__( jsonD, self.__logsPath__(graceid)) ### should give the same number as self.__path2len__(self.__logsPath(graceid))+1
-        if filename:
-            self.__copyFile__(graceid, filename)
-
-        lvalert = {'uid':graceid, 
-                   "alert_type": "update",
-                   "description": message,
-                   "file": shortFilename,
-                   "object": {
-                              "N": ind,
-                              "comment": message,
-                              "created": time.time(),
+        lvalerts = []
+        for jsonD, (message, filename, tagname), shortFilename in zip(jsonDs, logs, shortFilenames):
+            lvalerts.append( {'uid':graceid, 
+                              "alert_type": "update",
+                              "description": message,
                               "file": shortFilename,
-                              "file_version": 0,
-                              "filename": shortFilename,
-                              "issuer": {
-                                         "display_name": username,
-                                         "username": username+"@ligo.org"
+                              "object": {
+                                         "N": jsonD['N'],
+                                         "comment": message,
+                                         "created": time.time(),
+                                         "file": shortFilename,
+                                         "file_version": 0,
+                                         "filename": shortFilename,
+                                         "issuer": {
+                                                    "display_name": username,
+                                                    "username": username+"@ligo.org"
+                                                   },
+                                         "self": "",
+                                         "tag_names": tagname,
+                                         "tags": "",
                                         },
-                              "self": "",
-                              "tag_names": tagname,
-                              "tags": "",
-                             },
-                  } 
+                             }
+                           )
 
-        return jsonD, lvalert
+        return jsonDs, [('logs', jsonDs), ('files', newFilenames)], lvalerts
 
     def writeLog(self, graceid, message, filename=None, filecontents=None, tagname=[], displayName=None):
         self.check_graceid(graceid)
 
-        jsonD, lvalert = self.__log__(graceid, message, filename=filename, tagname=tagname )
+        with self.storage.lock(graceid): ### hold the lock so the N we assign match what is stored and alerts are sent in that order
+            jsonD, lvalert = self.__log__(graceid, message, filename=filename, tagname=tagname )
+            self.sendlvalert( lvalert, self.__node__(graceid) )
 
-        self.sendlvalert( lvalert, self.__node__(graceid) )
         return FakeTTPResponse( jsonD )
+
+    def writeLogs(self, graceid, logs):
+        '''
+        write several log messages (and upload any associated files) at once.
+        logs is a list of (message, filename, tagname) tuples; filename and tagname may be None.
+        everything is recorded with a single update to storage and all lvalert messages are sent with a single write.
+
+        NOTE: this is not part of ligo.gracedb.rest.GraceDb. Actions should fall back to writeLog if it is not available.
+        '''
+        self.check_graceid(graceid)
+
+        with self.storage.lock(graceid):
+            jsonDs, updates, lvalerts = self.__logs__(graceid, [(message, filename, tagname if tagname is not None else []) for message, filename, tagname in logs])
+            self.storage.extend( graceid, updates )
+            node = self.__node__(graceid)
+            self.sendlvalerts( [(lvalert, node) for lvalert in lvalerts] )
+
+        return FakeTTPResponse( jsonDs )
  
     def writeFile(self, graceid, filename, filecontents=None):
         self.check_graceid(graceid)
 
         return self.writeLog( graceid, '', filename=filename, filecontents=filecontents)
 
-    def __label__(self, graceid, label ):
-        jsonD = {'self':self.__labelsPath__(graceid), 
-                 'creator':getpass.getuser(), 
-                 'name':label, 
-                 'created':time.time(),
-                }
-        lvalert = {'uid':graceid, 
-                   'alert_type':'label', 
-                   'description':label, 
-                   'file':'',
-                  }
+    def __labels__(self, graceid, labels):
+        '''
+        records a log message for each label and all labels with a single update to self.storage, so we never keep the log messages without the labels.
+        returns the new label entries and the lvalert messages (alternating between log messages and labels)
+        '''
+        jsonDs = []
+        labelAlerts = []
+        for label in labels:
+            jsonDs.append( {'self':self.__labelsPath__(graceid), 
+                            'creator':getpass.getuser(), 
+                            'name':label, 
+                            'created':time.time(),
+                           }
+                         )
+            labelAlerts.append( {'uid':graceid, 
+                                 'alert_type':'label', 
+                                 'description':label, 
+                                 'file':'',
+                                }
+                              )
 
-        self.writeLog( graceid, 'applying label : %s'%label )
-        self.__append__( jsonD, self.__labelsPath__(graceid) )
+        _, updates, logAlerts = self.__logs__( graceid, [('applying label : %s'%label, None, []) for label in labels] )
+        self.storage.extend( graceid, updates+[('labels', jsonDs)] )
 
-        return jsonD, lvalert
+        lvalerts = []
+        for logAlert, labelAlert in zip(logAlerts, labelAlerts):
+            lvalerts += [logAlert, labelAlert]
+
+        return jsonDs, lvalerts
 
     def writeLabel(self, graceid, label):
         self.check_graceid(graceid)
         self.check_label( label )
 
-        jsonD, lvalert = self.__label__( graceid, label )
+        with self.storage.lock(graceid):
+            jsonDs, lvalerts = self.__labels__( graceid, [label] )
+            node = self.__node__(graceid)
+            self.sendlvalerts( [(lvalert, node) for lvalert in lvalerts] )
 
-        self.sendlvalert( lvalert, self.__node__(graceid) )
-        return FakeTTPResponse( jsonD )
+        return FakeTTPResponse( jsonDs[0] )
+
+    def writeLabels(self, graceid, labels):
+        '''
+        apply several labels at once. Each label still produces a log message.
+        everything is recorded with a single update to storage and all lvalert messages are sent with a single write.
+
+        NOTE: this is not part of ligo.gracedb.rest.GraceDb. Actions should fall back to writeLabel if it is not available.
+        '''
+        self.check_graceid(graceid)
+        for label in labels:
+            self.check_label( label )
+
+        with self.storage.lock(graceid):
+            jsonDs, lvalerts = self.__labels__( graceid, labels )
+            node = self.__node__(graceid)
+            self.sendlvalerts( [(lvalert, node) for lvalert in lvalerts] )
+
+        return FakeTTPResponse( jsonDs )
 
     def removeLabel(self, graceid, label):
         self.check_graceid(graceid)
 
         raise NotImplementedError('this is not implemented in the real GraceDb, so we do not implement it here. At least, not yet.')
 
+    ### tags ###
+
+    def __checkLog__(self, graceid, n):
+        if not (1 <= n <= self.storage.length(graceid, 'logs')):
+            raise FakeTTPError('could not find log message N=%s for graceid=%s'%(n, graceid))
+
+    def __tag__(self, graceid, n, tagname, applied, displayName=None):
+        '''
+        record that tagname was created (applied) or deleted on log message n. Log messages are never rewritten; instead we append the change to the "tags" collection
+        '''
+        self.check_graceid(graceid)
+        with self.storage.lock(graceid): ### hold the lock so checking the current tags and changing them happen together
+            self.__checkLog__(graceid, n)
+            tagged = tagname in self.storage.logTags(graceid).get(n, [])
+            if applied and tagged:
+                raise FakeTTPError('log message N=%d for graceid=%s is already tagged with %s'%(n, graceid, tagname))
+            if (not applied) and (not tagged):
+                raise FakeTTPError('log message N=%d for graceid=%s is not tagged with %s'%(n, graceid, tagname))
+
+            jsonD = {'log_N':n,
+                     'name':tagname,
+                     'displayName':displayName if displayName is not None else tagname,
+                     'applied':applied,
+                     'submitter':getpass.getuser()+'@ligo.org',
+                     'created':time.time(),
+                    }
+            self.storage.extend( graceid, [('tags', [jsonD])] )
+
+        return FakeTTPResponse( {'name':tagname, 'displayName':jsonD['displayName']} )
+
+    def __displayNames__(self, graceid):
+        '''
+        the displayName most recently given to each tag for graceid. Tags that were never given one are displayed by name
+        '''
+        return dict( (tag['name'], tag['displayName']) for tag in self.storage.extract(graceid, 'tags') if tag['applied'] )
+
+    def tags(self, graceid, n):
+        self.check_graceid(graceid)
+        self.__checkLog__(graceid, n)
+
+        displayNames = self.__displayNames__(graceid)
+        tags = [{'name':name, 'displayName':displayNames.get(name, name)} for name in self.storage.logTags(graceid).get(n, [])]
+        return FakeTTPResponse( {'numRows':len(tags),
+                                 'start':0,
+                                 'tags':tags,
+                                 'links':{'self'  : self.__logsPath__(graceid),
+                                          'first' : self.__logsPath__(graceid),
+                                          'last'  : self.__logsPath__(graceid),
+                                         },
+                                }
+                              )
+
+    def createTag(self, graceid, n, tagname, displayName=None):
+        return self.__tag__(graceid, n, tagname, True, displayName=displayName)
+
+    def deleteTag(self, graceid, n, tagname):
+        return self.__tag__(graceid, n, tagname, False)
+
+    def searchTags(self, tagnames, graceid=None):
+        """
+        find the log messages currently tagged with every one of tagnames (a single tag name or a list of them), only considering graceid's log messages if it is not None.
+        the storage backend keeps an index of tag name -> log messages, so we only read the events whose log messages match. Eg: every log message tagged with both sky_loc and lvem is
+            searchTags(['sky_loc', 'lvem'])
+        returns a list of log messages (each with the graceid it belongs to and its current tag_names), ordered by graceid and N
+
+        NOTE: this is not part of ligo.gracedb.rest.GraceDb.
+        """
+        if isinstance(tagnames, basestring):
+            tagnames = [tagnames]
+        if not tagnames:
+            return []
+
+        keys = self.storage.tag2keys(tagnames[0], graceid=graceid)
+        for tagname in tagnames[1:]:
+            if not keys:
+                break
+            keys &= self.storage.tag2keys(tagname, graceid=graceid)
+
+        ans = []
+        for graceid, group in itertools.groupby(sorted(keys), key=lambda key: key[0]):
+            logs = self.__currentTags__(graceid, self.storage.extract(graceid, 'logs'))
+            for _, N in group:
+                log = dict(logs[N-1])
+                log['graceid'] = graceid
+                ans.append( log )
+        return ans
+
+    def __currentTags__(self, graceid, logs):
+        '''
+        report the tags log messages carry now rather than those they were written with. logs are updated in place
+        '''
+        if not self.storage.length(graceid, 'tags'): ### no tag was ever created or deleted, so nothing changed
+            return logs
+        logTags = self.storage.logTags(graceid)
+        for log in logs:
+            names = logTags.get(log['N'], [])
+            if names!=self.storage.tagNames(log):
+                log['tag_names'] = names
+        return logs
+
+    ### EM follow-up ###
+
+    def writeEMObservation(self, graceid, group, raList, raWidthList, decList, decWidthList, startTimeList, durationList, comment=None):
+        """
+        record an EM observation with one footprint (a box of raWidth x decWidth degrees centered on ra, dec observed for duration seconds from startTime) per entry of the lists.
+        startTimeList may hold gps times or UTC times ("YYYY-MM-DDTHH:MM:SS").
+        footprints are stored as numpy records within the event's directory (see ligoTest.gracedb.footprints) and added to an index of every footprint, 
+        which FakeDb.searchEMObservations searches. The observation itself is then recorded in the storage backend, which is what makes the footprints visible.
+        """
+        self.check_graceid(graceid)
+        self.check_emgroup(group)
+
+        columns = [asFloats(raList), asFloats(raWidthList), asFloats(decList), asFloats(decWidthList), asFloats(startTimeList, times=True), asFloats(durationList)]
+        num = len(columns[0])
+        if (not num) or [column for column in columns if len(column)!=num]:
+            raise FakeTTPError('raList, raWidthList, decList, decWidthList, startTimeList and durationList must all have the same (non-zero) length')
+
+        with self.storage.lock(graceid):
+            footprints = self.__footprints__(graceid)
+            observations = self.storage.extract(graceid, 'emobservations')
+            self.__reconcileFootprints__(graceid, footprints, observations)
+
+            N = len(observations)+1
+            records = np.empty(num, dtype=Footprints.dtype)
+            records['N'] = N
+            for name, column in zip(['ra', 'raWidth', 'dec', 'decWidth', 'start', 'duration'], columns):
+                records[name] = column
+
+            ralo = np.min(records['ra']-0.5*records['raWidth'])
+            rahi = np.max(records['ra']+0.5*records['raWidth'])
+            declo = np.min(records['dec']-0.5*records['decWidth'])
+            dechi = np.max(records['dec']+0.5*records['decWidth'])
+            jsonD = {'N':N,
+                     'group':group,
+                     'comment':comment if comment is not None else '',
+                     'submitter':getpass.getuser()+'@ligo.org',
+                     'created':time.time(),
+                     'footprint_count':num,
+                     'ra':0.5*(ralo+rahi), 'raWidth':rahi-ralo, ### the box that bounds every footprint
+                     'dec':0.5*(declo+dechi), 'decWidth':dechi-declo,
+                    }
+
+            footprints.append( records )
+            self.durability.sync(footprints.path) ### footprints must be on disk before the observation that refers to them
+            self.storage.extend( graceid, [('emobservations', [jsonD])] )
+            self.footprints.extend( graceid, records )
+            self.durability.sync(self.footprints.path)
+
+            jsonD = self.__emobservation__(jsonD, records)
+            self.sendlvalert( {'uid':graceid,
+                               'alert_type':'emobservation',
+                               'description':'',
+                               'file':'',
+                               'object':jsonD,
+                              },
+                              self.__node__(graceid)
+                            )
+
+        return FakeTTPResponse( jsonD )
+
+    def __reconcileFootprints__(self, graceid, footprints, observations):
+        '''
+        make sure graceid has exactly the footprints its recorded observations account for, both in its own file and in self.footprints.
+        a writer that died part way through writeEMObservation may have left extra footprints in the former or too few in the latter.
+        callers must hold the lock for graceid
+        '''
+        num = sum(observation['footprint_count'] for observation in observations)
+        footprints.truncate(num)
+        indexed = self.footprints.count(graceid)
+        if indexed < num:
+            self.footprints.extend( graceid, footprints.read(len(observations))[indexed:] ) ### footprints are appended in the same order to both
+
+    def __emobservation__(self, jsonD, records):
+        '''
+        add the footprints (a numpy structured array of the observation's records) to an observation as GraceDb reports them
+        '''
+        jsonD = dict(jsonD)
+        jsonD['footprints'] = [{'N':i+1,
+                                'ra':float(record['ra']),
+                                'dec':float(record['dec']),
+                                'raWidth':float(record['raWidth']),
+                                'decWidth':float(record['decWidth']),
+                                'start_time':gps2utc(record['start']),
+                                'exposure_time':float(record['duration']),
+                               } for i, record in enumerate(records)
+                              ]
+        return jsonD
+
+    def emobservations(self, graceid):
+        self.check_graceid(graceid)
+
+        observations = self.storage.extract(graceid, 'emobservations')
+        records = self.__footprints__(graceid).read(len(observations))
+        start = 0
+        for i, observation in enumerate(observations): ### footprints are stored in the same order as observations
+            stop = start + observation['footprint_count']
+            observations[i] = self.__emobservation__(observation, records[start:stop])
+            start = stop
+
+        emobservationsPath = self.__emobservationsPath__(graceid)
+        return FakeTTPResponse( {'numRows':len(observations),
+                                 'start':0,
+                                 'observations':observations,
+                                 'links':{'self'  : emobservationsPath,
+                                          'first' : emobservationsPath,
+                                          'last'  : emobservationsPath,
+                                         },
+                                }
+                              )
+
+    def searchEMObservations(self, ra=None, dec=None, gpsstart=None, gpsstop=None, asarray=False):
+        """
+        find the footprints of every event's EM observations that overlap a box on the sky and/or a window of time
+            ra       = (ralo, rahi) in degrees, which wraps through 0 if ralo > rahi
+            dec      = (declo, dechi) in degrees
+            gpsstart, gpsstop bound the window of time (either may be None)
+        the cuts are applied to every footprint at once with numpy. If asarray, we return the matching footprints as a numpy structured array
+        (see ligoTest.gracedb.footprints.FootprintIndex). Otherwise we return a list of dictionaries with the graceid and number (N) of the observation each footprint belongs to.
+
+        NOTE: this is not part of ligo.gracedb.rest.GraceDb.
+        """
+        records = self.footprints.search(ra=ra, dec=dec, gpsstart=gpsstart, gpsstop=gpsstop)
+        if asarray:
+            return records
+        return [{'graceid':record['graceid'].decode('ascii'),
+                 'N':int(record['N']),
+                 'ra':float(record['ra']),
+                 'dec':float(record['dec']),
+                 'raWidth':float(record['raWidth']),
+                 'decWidth':float(record['decWidth']),
+                 'gpsstart':float(record['start']),
+                 'duration':float(record['duration']),
+                } for record in records
+               ]
+
+    def writeEel(self, graceid, group, waveband, eel_status, obs_status, **kwargs):
+        """
+        record an EM Bulletin Board entry (EEL). kwargs are the optional fields GraceDb accepts (ra, dec, raWidth, decWidth, gpstime, duration, comment, extra_info_dict, ...),
+        which are stored as they are given. EELs are appended to the event's "eels" collection and indexed by EM group, waveband and creation time (see FakeDb.searchEels)
+        """
+        self.check_graceid(graceid)
+        self.check_emgroup(group)
+        self.check_waveband(waveband)
+        self.check_eel_status(eel_status)
+        self.check_obs_status(obs_status)
+
+        with self.storage.lock(graceid): ### hold the lock so the N we assign match what is stored and alerts are sent in that order
+            jsonD = dict(kwargs)
+            jsonD.update( {'N':self.storage.length(graceid, 'eels')+1,
+                           'group':group,
+                           'waveband':waveband,
+                           'eel_status':eel_status,
+                           'obs_status':obs_status,
+                           'submitter':getpass.getuser()+'@ligo.org',
+                           'created':time.time(),
+                          }
+                        )
+            self.storage.extend( graceid, [('eels', [jsonD])] )
+
+            self.sendlvalert( {'uid':graceid,
+                               'alert_type':'embb_event_log',
+                               'description':'',
+                               'file':'',
+                               'object':jsonD,
+                              },
+                              self.__node__(graceid)
+                            )
+
+        return FakeTTPResponse( jsonD )
+
+    def eels(self, graceid):
+        self.check_graceid(graceid)
+
+        eels = self.storage.extract(graceid, 'eels')
+        eelsPath = self.__eelsPath__(graceid)
+        return FakeTTPResponse( {'numRows':len(eels),
+                                 'start':0,
+                                 'log':eels,
+                                 'links':{'self'  : eelsPath,
+                                          'first' : eelsPath,
+                                          'last'  : eelsPath,
+                                         },
+                                }
+                              )
+
+    def searchEels(self, group=None, waveband=None, start=None, stop=None):
+        """
+        find every event's EELs from an EM group within a waveband (or any narrower waveband, so "em.radio" includes "em.radio.3-6GHz") that were created between start and stop (unix times).
+        any of these may be None (no constraint), so the radio EELs from the last hour are
+            searchEels(waveband='em.radio', start=time.time()-3600)
+        the storage backend answers this from its indexes, so we only read the events that have matching EELs.
+        returns a list of EELs (each with the graceid it belongs to), oldest first
+
+        NOTE: this is not part of ligo.gracedb.rest.GraceDb.
+        """
+        if group is not None:
+            self.check_emgroup(group)
+        if waveband is not None:
+            self.check_waveband(waveband)
+
+        ans = []
+        eels = dict()
+        for graceid, N in self.storage.eel2keys(group=group, waveband=waveband, start=start, stop=stop):
+            if graceid not in eels:
+                eels[graceid] = self.storage.extract(graceid, 'eels')
+            eel = dict(eels[graceid][N-1])
+            eel['graceid'] = graceid
+            ans.append( eel )
+        return ans
+
+    ### VOEvents ###
+
+    def createVOEvent(self, graceid, voevent_type, **kwargs):
+        """
+        record a VOEvent of voevent_type (a code like "PR" or a name like "preliminary", see FakeDb.voevent_types). VOEvents are numbered sequentially for each event.
+        kwargs are the optional fields GraceDb accepts (skymap_type, skymap_filename, internal, hardware_inj, open_alert, ProbHasNS, BNS, ...), which are stored as they are given
+        and reported within the XML (see ligoTest.gracedb.voevent). The XML is built from a template of everything that depends only on the event, which we make once per event
+        and keep within the in-process cache.
+        """
+        self.check_graceid(graceid)
+        voevent_type = self.check_voevent_type(voevent_type)
+
+        template = self.__voeventTemplate__(graceid)
+        with self.storage.lock(graceid): ### hold the lock so the N we assign match what is stored and alerts are sent in that order
+            N = self.storage.length(graceid, 'voevents')+1
+            ivorn, text = voe.render(template, graceid, N, voevent_type, **kwargs)
+
+            jsonD = dict(kwargs)
+            jsonD.update( {'N':N,
+                           'voevent_type':voevent_type,
+                           'ivorn':ivorn,
+                           'filename':'%s-%d-%s.xml'%(graceid, N, voe.alertType(voevent_type)[0]),
+                           'file_version':0,
+                           'submitter':getpass.getuser()+'@ligo.org',
+                           'created':time.time(),
+                           'text':text,
+                          }
+                        )
+            self.storage.extend( graceid, [('voevents', [jsonD])] )
+
+            self.sendlvalert( {'uid':graceid,
+                               'alert_type':'voevent',
+                               'description':'VOEvent %s'%jsonD['filename'],
+                               'file':jsonD['filename'],
+                               'object':jsonD,
+                              },
+                              self.__node__(graceid)
+                            )
+
+        return FakeTTPResponse( jsonD )
+
+    def __voeventTemplate__(self, graceid):
+        '''
+        the XML template for graceid's VOEvents. Events' top-level data never changes once it is written, so cached templates never go stale
+        '''
+        key = ('voevent', graceid)
+        if self.cache is not None:
+            template = self.cache.get(key, 0)
+            if template is not None:
+                return template
+
+        template = voe.eventTemplate(graceid, self.storage.read(graceid), self.__directory__(graceid))
+        if self.cache is not None:
+            self.cache.put(key, 0, template)
+        return template
+
+    def voevents(self, graceid):
+        self.check_graceid(graceid)
+
+        voevents = self.storage.extract(graceid, 'voevents')
+        voeventsPath = self.__voeventsPath__(graceid)
+        return FakeTTPResponse( {'numRows':len(voevents),
+                                 'start':0,
+                                 'voevents':voevents,
+                                 'links':{'self'  : voeventsPath,
+                                          'first' : voeventsPath,
+                                          'last'  : voeventsPath,
+                                         },
+                                }
+                              )
+
+    ### bulk import ###
+
+    def importEvents(self, dumps, batch=1000, files_dir=None):
+        '''
+        import events from dumps of GraceDb, an iterable of dictionaries (eg: ligoTest.gracedb.dumps.iterDumps) with keys
+            event  : what GraceDb.event returned
+            logs   : what GraceDb.logs returned (optional)
+            labels : what GraceDb.labels returned (optional)
+            files  : what GraceDb.files returned (optional)
+        we read batch events at a time, reserve a block of new graceids for each group within it and store the whole batch at once (see Storage.load).
+        uploaded files are copied from files_dir/<original graceid>/<filename> if they exist there and are otherwise left out.
+        no lvalert messages are sent. Returns a dictionary mapping the original graceids to the new ones.
+
+        NOTE: this is not part of ligo.gracedb.rest.GraceDb
+        '''
+        mapping = dict()
+        chunk = []
+        for dump in dumps:
+            chunk.append( dump )
+            if len(chunk)==batch:
+                self.__importEvents__(chunk, files_dir, mapping)
+                chunk = []
+        if chunk:
+            self.__importEvents__(chunk, files_dir, mapping)
+
+        return mapping
+
+    def __importEvents__(self, dumps, files_dir, mapping):
+        groups = dict()
+        for dump in dumps: ### check everything before we touch anything
+            event = dump['event']
+            self.check_group_pipeline_search(*self.__allowedNames__(event['group'], event['pipeline'], event.get('search')))
+            groups.setdefault(event['group'].lower(), []).append( dump )
+
+        events = []
+        for group, chunk in groups.items():
+            for graceid, dump in zip(self.reserveGraceIDs(group, num=len(chunk)), chunk):
+                events.append( self.__importEvent__(graceid, dump, files_dir) )
+                mapping[dump['event']['graceid']] = graceid
+        self.storage.load( events )
+
+    def __importEvent__(self, graceid, dump, files_dir):
+        '''
+        convert a single dump into what we store for graceid: (graceid, toplevel, updates, node)
+        '''
+        event = dump['event']
+        now = time.time()
+
+        jsonD = dict(event)
+        jsonD.update( {'graceid':graceid,
+                       'group':event['group'].lower(),
+                       'pipeline':event['pipeline'].lower(),
+                       'created':dmp.unixtime(event.get('created'), default=now),
+                       'labels':dict(),  ### reported from the labels collection (see event)
+                       'links':self.__links__(graceid),
+                      }
+                    )
+        if event.get('search'):
+            jsonD['search'] = event['search'].lower()
+        else:
+            jsonD.pop('search', None)
+
+        logsPath = self.__logsPath__(graceid)
+        logs = []
+        for i, log in enumerate(sorted(dmp.records(dump.get('logs'), 'log'), key=lambda log: log.get('N', 0))):
+            log = dict(log)
+            log.update( {'self':logsPath, 'N':i+1, 'tag_names':self.storage.tagNames(log), 'created':dmp.unixtime(log.get('created'), default=now)} )
+            logs.append( log )
+
+        labelsPath = self.__labelsPath__(graceid)
+        labels = []
+        for label in dmp.records(dump.get('labels'), 'labels'):
+            label = dict(label)
+            label.update( {'self':labelsPath, 'created':dmp.unixtime(label.get('created'), default=now)} )
+            labels.append( label )
+
+        files = []
+        if files_dir is not None:
+            for filename in dmp.filenames(dump.get('files')):
+                path = os.path.join(files_dir, event['graceid'], filename)
+                if os.path.isfile(path):
+                    if not files: ### storage.load keeps whatever is already in this directory
+                        d = self.__directory__(graceid)
+                        if not os.path.exists(d):
+                            os.makedirs(d)
+                    files.append( self.__copyFile__(graceid, path) )
+            if files:
+                self.durability.sync(*files) ### uploads must be on disk before the event that refers to them
+
+        return graceid, jsonD, [('logs', logs), ('labels', labels), ('files', files)], self.__event2node__(jsonD)
+
+    ### retention ###
+
+    def gc(self, max_age=None, max_events=None, max_bytes=None, segment_bytes=2**26, grace=60., batch=100):
+        '''
+        remove the oldest events (along with lvalert.out segments, uploaded files and cached attributes that only they refer to) until none was created
+        more than max_age seconds ago, there are no more than max_events events and the directory holds no more than max_bytes.
+        see ligoTest.gracedb.retention.Retention, which also describes the summary we return.
+        other processes may keep reading and writing while we do this, but anything that refers to a removed event fails as it would for any unknown graceid
+        '''
+        return Retention(max_age=max_age, max_events=max_events, max_bytes=max_bytes, segment_bytes=segment_bytes, grace=grace, batch=batch).collect(self)
+
     ### queries ###
 
     def events(self, query=None, orderby=None, count=None, columns=None):
         """
-        WARNING: we only support limitted syntax for these queries at this time. Specifically, we support three types of clauses that can be supplied in any order
-            graceid's
-            labels
-            gpsstart .. gpsstop
+        queries are compiled by ligoTest.gracedb.query, which supports
+            labels combined with & (AND), | (OR), ~ (NOT) and parentheses
+            graceids and graceid ranges (T000010 .. T000020)
+            gps ranges (gpsstart .. gpsstop or gpstime: gpsstart .. gpsstop)
+            far, gpstime and created thresholds (far < 1e-7, created >= "2017-05-01")
+            group, pipeline and search (pipeline: gstlal or just gstlal)
+        juxtaposed clauses are ANDed together, except for consecutive labels and consecutive gps ranges which are ORed
 
         eg: "ADVNO 1177672330 .. 1177672360"
+            "EM_READY & ~ADVNO far < 1e-7 gstlal"
 
-        NOTE: we only support query!=None at this time (we require orderby=count=columns=None but keep these kwargs present for consistency with ligo.gracedb.rest.GraceDb)
+        the query is answered starting from whichever index (labels, gpstime, far, created, group/pipeline/search) matches the fewest events,
+        and the remaining clauses are tested lazily as we stream through results.
 
-        more complete syntatic coverage may be available via sqlparse (https://sqlparse.readthedocs.io/en/latest/)
+        orderby is a top-level key (eg: "created", "gpstime", "far"), prefixed with "-" to return the largest values first.
+        count limits the number of events returned and columns (a comma-separated string or a list) limits the top-level keys reported for each event.
         """
-        assert (orderby==None) and (count==None) and (columns==None), 'FakeDb.events only supports orderby=None, count=None, columns=None at this time!'
-
         if query: ### downselect events
-            labels = []
-            graceids = []
-            gpstimes = []
-            bits = query.split()
-            N = len(bits)
-            i = 0
-            while i < N:
-                bit = bits[i]
-                try: ### interpret as the first part of a "gps .. gps" clause
-                    gpsstart = float(bit)
-                    if (i<N-2) and (bits[i+1]=='..'):
-                        gpsstop = float(bits[i+2])
-                    else:
-                        raise FakeTTPError('Invalid query: could not parse "gps .. gps" clause')
-                    gpstimes.append( (gpsstart, gpsstop) )
-                    i += 3
+            events, match = self.__compile__(query).plan(self.storage)
+        else: ### return all events
+            events, match = None, None
 
-                except ValueError as e: ### check to see if this is a label or a GraceId
-                    if self.__is_label__(bit): ### this is a known label
-                        labels.append( bit )
+        if orderby:
+            events = self.__orderby__(events, orderby.lstrip('-'), orderby.startswith('-'), count, match)
+        else:
+            if events is None:
+                events = self.storage.ordered('graceid') ### streamed when the backend can, so we never hold the full listing for large (sharded) directories
+            else:
+                events = sorted(events)
+            if match is not None:
+                events = ifilter(match, events) ### test the remaining clauses lazily
+                
+        if count is not None:
+            events = itertools.islice(events, count)
 
-                    elif self.__is_graceid__(bit): ### is a graceid
-                        graceids.append(bit)
+        if columns:
+            if isinstance(columns, basestring): ### GraceDb takes a comma-separated list
+                columns = columns.split(',')
+            columns = [column.strip() for column in columns]
+            indexed = all((column in self.storage.attributeKeys) or (column=='labels') for column in columns) ### the backend can report these without reading events
 
+        for graceid in events:
+            try:
+                if columns:
+                    if indexed:
+                        topLevel = self.storage.attributes(graceid)
                     else:
-                        raise FakeTTPError('Invalid query: query contained an invalid label or graceid')
-                    i += 1
-
-            if graceids: ### check if users sepecified graceids
-                if len(graceids)==1:
-                    try:
-                        self.check_graceid(graceids[0])
-                        events = graceids
-                    except FakeTTPError as e: ### could not find this event
-                        events = [] 
+                        topLevel = self.storage.read(graceid)
+                    if 'labels' in columns:
+                        topLevel['labels'] = dict( (label['name'], label['self']) for label in self.storage.extract(graceid, 'labels') )
+                    ans = dict( (column, topLevel[column]) for column in columns if column in topLevel )
+
                 else:
-                    events = [] ### more than one graceid, must return an empty list
-            else:
-                events = self.__get_all_graceids__() ### just grab all events
-                                                     ### FIXME: downselecting based on this may not scale well
-
-            if labels: ### check if users specified labels
-                retained = []
-                for label in labels:
-                    for graceid in events:
-                        these_labels = [d['name'] for d in self.labels(graceid).json()['labels']]
-                        if label in these_labels:
-                            retained.append( graceid )
-                events = retained
-
-            if gpstimes: ### check if users specified gpstimes
-                retained = []
-                for gpsstart, gpsstop in gpstimes:
-                    for graceid in events:
-                        gpstime = self.__extract__(self.__topLevelPath__(graceid))['gpstime']
-                        if (gpsstart<=gpstime) and (gpstime<=gpsstop):
-                            retained.append( graceid )
-                events = retained
-                
-        else: ### return all events
-            events = self.__get_all_graceids__()
+                    ans = self.event(graceid).json()
 
-        ### FIXME: we should modify events to account for orderby, count here
+            except Exception:
+                if self.storage.exists(graceid):
+                    raise
+                continue ### removed (see FakeDb.gc) after we found it, so we skip it
 
-        for graceid in events:
-            topLevel = self.event(graceid).json()
+            yield ans
 
-            ### FIXME: incorporate columns here
+    def __compile__(self, query):
+        try:
+            return Compiler(self.__is_label__, self.__is_graceid__, groups=self.groups, pipelines=self.pipelines, searches=self.searches).compile(query)
+        except QueryError as e:
+            raise FakeTTPError('Invalid query: %s'%e)
 
-            yield topLevel
+    def __orderby__(self, events, key, reverse, count, match=None):
+        '''
+        order graceids by the top-level key (largest first if reverse), keeping only the first count of them if count is not None.
+        events is a list of candidate graceids, or None for all events, and match (if not None) tests whether we keep each graceid.
+        we stream through the ordering maintained by the storage backend when we can, so the cost scales with count rather than the number of events.
+        otherwise, we keep the first count graceids in a bounded heap.
+        '''
+        if match is not None:
+            if events is None:
+                if key in self.storage.sortKeys:
+                    return ifilter(match, self.storage.ordered(key, reverse=reverse))
+                events = self.storage.iterGraceids()
+            events = [graceid for graceid in events if match(graceid)]
+
+        if key in self.storage.sortKeys:
+            if events is None:
+                return self.storage.ordered(key, reverse=reverse)
+            elif key=='graceid':
+                value = lambda graceid: graceid
+            else:
+                values = self.storage.sortValues(events, key)
+                value = lambda graceid: self.__sortKey__(values[graceid], graceid)
+
+        else: ### we have to read every event to find this value
+            if events is None:
+                events = self.storage.iterGraceids()
+            value = lambda graceid: self.__sortKey__(self.storage.read(graceid).get(key), graceid)
+
+        if count is None:
+            return sorted(events, key=value, reverse=reverse)
+        elif reverse:
+            return heapq.nlargest(count, events, key=value)
+        else:
+            return heapq.nsmallest(count, events, key=value)
 
+    @staticmethod
+    def __sortKey__(value, graceid):
+        '''
+        events without a value come first (where python2 sorts None) without ever comparing None to anything, which python3 does not allow
+        '''
+        return (value is not None, value, graceid)
 
     def event(self, graceid):
         self.check_graceid(graceid)
 
-        topLevel = self.__extract__( self.__topLevelPath__(graceid) )
-        topLevel.update( {'labels':dict( (label['name'], label['self']) for label in self.__extract__( self.__labelsPath__(graceid) ) )} )
+        topLevel = self.storage.read(graceid)
+        topLevel.update( {'labels':dict( (label['name'], label['self']) for label in self.storage.extract(graceid, 'labels') )} )
 
         return FakeTTPResponse( topLevel )
 
     def logs(self, graceid):
         self.check_graceid(graceid)
 
-        logs = self.__extract__( self.__logsPath__(graceid) )
+        logs = self.__currentTags__(graceid, self.storage.extract(graceid, 'logs'))
         logsPath = self.__logsPath__(graceid)
         return FakeTTPResponse( {'numRows':len(logs),
                                  'start':0,
@@ -823,7 +1604,7 @@ class FakeDb():
     def labels(self, graceid, label=''):
         self.check_graceid(graceid)
 
-        return FakeTTPResponse( {'labels':self.__extract__( self.__labelsPath__(graceid) ),
+        return FakeTTPResponse( {'labels':self.storage.extract(graceid, 'labels'),
                                  'links': [{'self':self.__labelsPath__(graceid),
                                            'event':self.__directory__(graceid),
                                            }
@@ -834,23 +1615,10 @@ class FakeDb():
     def files(self, graceid, filename=None, raw=False):
         self.check_graceid(graceid)
 
-        return FakeTTPResponse( dict( (os.path.basename(filename), filename) for filename in self.__extract__( self.__filesPath__(graceid) ) ) )
+        return FakeTTPResponse( dict( (os.path.basename(filename), filename) for filename in self.storage.extract(graceid, 'files') ) )
 
     #--- methods that aren't really supported yet in any meaningful way
 
-    def createVOEvent(self, *args, **kwargs):
-        """
-        WARNING: this is not actually implemented and is only present for syntactic completion.
-        If users actually need to reference the VOEvents that they create, then we'll have to actually implement somthing.
-        """
-        pass
-
-    def voevents(self, graceid):
-        """
-        WARNING: not implemented yet. Should return some sort of list of VOEvents that have been created for this GraceId
-        """
-        raise NotImplementedError, 'need to implement FakeDb.createVOEvent and then reference the results within FakeDb.voevents'
-
     def replaceEvent(self, graceid, filename, filecontents=None):
         """
         WARNING: not implemented
@@ -859,51 +1627,14 @@ class FakeDb():
 
     def numEvents(self, query=None):
         """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
-
-    def eels(self, graceid):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
-
-    def writeEel(self, graceid, group, waveband, eel_status, obs_status, **kwargs):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
-
-    def emobservations(self, graceid):
+        the number of events matching query (see FakeDb.events).
+        counts with no query or a single label, group, pipeline or search clause come from counters the storage backend maintains as events are created and labeled.
+        other queries are counted by intersecting the storage backend's indexes, so we only read events for clauses that cannot use one
         """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
-
-    def writeEMObservation(self, graceid, group, raList, raWidthList, decList, decWidthList, startTimeList, durationList, comment=None):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        if not query:
+            return self.storage.count()
 
-    def tags(self, graceid, n):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
-
-    def createTag(self, graceid, n, tagname, displayName=None):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
-
-    def deleteTag(self, graceid, n, tagname):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        return self.__compile__(query).count(self.storage)
 
     def ping(self):
     
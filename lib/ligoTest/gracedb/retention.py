@@ -0,0 +1,198 @@
+description = "a module that removes old events (and whatever only they refer to) from FakeDb directories so long-running simulations stop growing without bound"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import re
+
+import time
+import heapq
+import threading
+import traceback
+
+from ligoTest.gracedb.locks import FileLock, lockedReplace
+from ligoTest.gracedb.compat import xrange
+
+#-------------------------------------------------
+
+def du(directory):
+    '''
+    the number of bytes held by files within directory, counting files that are hardlinked more than once (eg: blobs) only once
+    '''
+    seen = set()
+    ans = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, filename))
+            except OSError: ### removed while we were looking
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add( (stat.st_dev, stat.st_ino) )
+                ans += stat.st_size
+    return ans
+
+#-------------------------------------------------
+
+class Retention(object):
+    '''
+    limits on what a FakeDb directory holds: events created no more than max_age seconds ago, at most max_events events and at most max_bytes on disk.
+    any limit may be None (no limit).
+
+    collect removes events oldest first (by "created") until every limit is met, along with segments of lvalert.out that are too old or that we need the space of.
+    lvalert.out is rotated into numbered segments (lvalert.out.1, lvalert.out.2, ...) once it grows beyond segment_bytes, so old alerts can be removed
+    without rewriting the file listeners are reading. Nothing written within the last grace seconds is ever removed.
+    events are removed batch at a time (see ligoTest.gracedb.storage.Storage.remove), after which we remove whatever only they referred to
+    (footprints, uploaded files stored once by content, cached attributes of uploaded files) and compact indexes that mostly describe removed events.
+
+    only one process collects garbage within a directory at a time (we hold gc.lock), but everyone else may keep reading and writing while we do.
+    '''
+
+    def __init__(self, max_age=None, max_events=None, max_bytes=None, segment_bytes=2**26, grace=60., batch=100):
+        self.max_age = max_age
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.grace = grace
+        self.batch = batch
+
+    def collect(self, gdb):
+        '''
+        remove whatever gdb (a FakeDb) holds beyond our limits. Returns a summary of what we removed:
+            events   : the number of events
+            segments : the number of lvalert.out segments
+            blobs    : bytes freed by removing uploaded files no event refers to any more
+            parsed   : bytes freed by removing cached attributes of uploaded files
+            indexes  : bytes freed by compacting indexes
+            bytes    : roughly how many bytes we freed in total. Uploaded files that only one event referred to are counted with that event rather than within blobs
+        '''
+        with FileLock(os.path.join(gdb.service_url, 'gc.lock')):
+            return self.__collect__(gdb)
+
+    def __collect__(self, gdb):
+        now = time.time()
+        storage = gdb.storage
+        storage.finishRemovals() ### a previous collection may have died part way through
+
+        summary = {'events':0, 'segments':0, 'blobs':0, 'parsed':0, 'indexes':0, 'bytes':0}
+        self.__rotate__(gdb.lvalert)
+
+        ### decide what to remove, oldest first
+        numEvents = storage.count()
+        used = du(gdb.service_url) - storage.reclaimable() if self.max_bytes is not None else 0
+        expired = [] ### graceids
+        segments = [] ### paths
+        horizon = now - self.grace ### everything cached before this refers only to what we removed
+        for timestamp, kind, name in heapq.merge(self.__events__(storage), self.__segments__(gdb.lvalert)):
+            if (timestamp > now - self.grace) or not (((self.max_age is not None) and (timestamp < now - self.max_age)) \
+              or ((self.max_bytes is not None) and (used > self.max_bytes)) \
+              or ((kind=='event') and (self.max_events is not None) and (numEvents > self.max_events))):
+                if kind=='event': ### every later event is newer and our limits are only closer to being met
+                    horizon = timestamp
+                    break
+                continue ### we only keep segments because they are new enough, but later events may still be removed
+
+            if kind=='event':
+                size = storage.size(name)
+                expired.append( name )
+                numEvents -= 1
+            else:
+                size = os.path.getsize(name)
+                segments.append( name )
+            used -= size
+            summary['bytes'] += size
+
+        ### remove them
+        for i in xrange(0, len(expired), self.batch):
+            storage.remove( expired[i:i+self.batch] )
+        summary['events'] = len(expired)
+
+        for path in segments:
+            os.remove(path)
+        summary['segments'] = len(segments)
+
+        ### remove what only they referred to
+        orphans = [graceid for graceid in gdb.footprints.graceids() if not storage.exists(graceid)] ### also catches removals that died before we got here
+        if orphans:
+            gdb.footprints.remove( orphans )
+        if gdb.blobs is not None:
+            summary['blobs'] = gdb.blobs.gc()
+        summary['parsed'] = gdb.parsed.gc(horizon)
+
+        sync = gdb.durability.sync if gdb.durability.enabled else None
+        summary['indexes'] = storage.compact() + gdb.footprints.compact(sync=sync)
+
+        summary['bytes'] += summary['parsed'] + summary['indexes']
+        return summary
+
+    def __events__(self, storage):
+        '''
+        iterate over (created, "event", graceid) oldest first. Events still being created have no "created" yet, so we skip them
+        '''
+        for graceid in storage.ordered('created'):
+            created = storage.attributes(graceid).get('created')
+            if created is not None:
+                yield created, 'event', graceid
+
+    def __segments__(self, lvalert):
+        '''
+        list (mtime, "segment", path) for every segment of lvalert, oldest first
+        '''
+        return sorted((os.path.getmtime(path), 'segment', path) for _, path in self.__numbered__(lvalert))
+
+    def __numbered__(self, lvalert):
+        '''
+        list (number, path) for every segment of lvalert
+        '''
+        dirname, basename = os.path.split(lvalert)
+        match = re.compile(r'^%s\.(\d+)$'%re.escape(basename)).match
+        return [(int(m.group(1)), os.path.join(dirname, m.group(0))) for m in [match(name) for name in os.listdir(dirname)] if m]
+
+    def __rotate__(self, lvalert):
+        '''
+        if lvalert has grown beyond segment_bytes, move what it holds into the next segment and start it over.
+        writers hold a shared lock while they append (see ligoTest.gracedb.locks.lockedAppend), so nothing is written into the old file after we replace it
+        '''
+        if (not os.path.exists(lvalert)) or (os.path.getsize(lvalert) <= self.segment_bytes):
+            return
+        segment = '%s.%d'%(lvalert, max([num for num, _ in self.__numbered__(lvalert)] or [0])+1)
+        def build():
+            os.link(lvalert, segment) ### the segment keeps the old file, so listeners holding it open finish reading what it holds
+            return ''
+        lockedReplace(lvalert, build)
+
+#-------------------------------------------------
+
+class Collector(object):
+    '''
+    runs retention.collect(gdb) every interval seconds within a background (daemon) thread.
+    gdb must be a FakeDb that nothing else uses (eg: instantiated just for us), since a SQLite connection must never be used from two threads at once
+    '''
+
+    def __init__(self, gdb, retention, interval=60.):
+        self.gdb = gdb
+        self.retention = retention
+        self.interval = interval
+        self.summary = None ### what the most recent collection removed
+        self.__stop__ = threading.Event()
+        self.__thread__ = None
+
+    def start(self):
+        self.__thread__ = threading.Thread(target=self.__run__)
+        self.__thread__.daemon = True
+        self.__thread__.start()
+
+    def stop(self):
+        self.__stop__.set()
+        if self.__thread__ is not None:
+            self.__thread__.join()
+            self.__thread__ = None
+
+    def __run__(self):
+        while not self.__stop__.is_set():
+            try:
+                self.summary = self.retention.collect(self.gdb)
+            except Exception: ### keep going, the next collection finishes whatever this one left behind
+                traceback.print_exc()
+            self.__stop__.wait(self.interval)
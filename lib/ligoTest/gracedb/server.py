@@ -0,0 +1,521 @@
+description = "a module that serves FakeDb over HTTP at the routes used by ligo.gracedb.rest.GraceDb, so code that only speaks HTTP can use FakeDb"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import re
+import shutil
+import tempfile
+
+import json
+
+import cgi
+
+import threading
+
+import traceback
+
+import itertools
+
+from ligoTest.gracedb.rest import FakeDb, FakeTTPError
+from ligoTest.gracedb.stats import Stats
+from ligoTest.gracedb.compat import xrange, queue, httpserver, urlparse, parse_qs, quote, unquote, urlencode, asbytes
+
+#-------------------------------------------------
+
+class HTTPError(Exception):
+    '''
+    raised within request handlers to send a status code other than 200
+    '''
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+#-------------------------------------------------
+
+class FakeDbRequestHandler(httpserver.BaseHTTPRequestHandler):
+    '''
+    maps the GraceDb REST routes onto a FakeDb instance (self.server.fakedb()).
+    we speak HTTP/1.1, so every response carries a Content-Length (or is chunked) and clients can keep connections alive.
+    '''
+    protocol_version = 'HTTP/1.1'
+    timeout = 5 ### seconds an idle keep-alive connection may hold onto a worker thread
+    wbufsize = -1 ### buffer responses (flushed after each request) so headers and body go out together instead of as many small packets
+    disable_nagle_algorithm = True
+
+    __chunkSize__ = 2**16
+
+    ### (method, path regex, name of the method that handles it)
+    __routes__ = [(method, re.compile('^/api/%s/?$'%path), name) for method, path, name in [
+        ('GET',    '',                                              'serviceInfo'),
+        ('GET',    'stats',                                         'stats'),
+        ('GET',    'events',                                        'events'),
+        ('POST',   'events',                                        'createEvent'),
+        ('GET',    'events/(?P<graceid>\w+)',                       'event'),
+        ('GET',    'events/(?P<graceid>\w+)/log',                   'logs'),
+        ('POST',   'events/(?P<graceid>\w+)/log',                   'writeLog'),
+        ('GET',    'events/(?P<graceid>\w+)/log/(?P<N>\d+)',        'log'),
+        ('GET',    'events/(?P<graceid>\w+)/log/(?P<N>\d+)/tag',    'tags'),
+        ('PUT',    'events/(?P<graceid>\w+)/log/(?P<N>\d+)/tag/(?P<tagname>[^/]+)', 'createTag'),
+        ('DELETE', 'events/(?P<graceid>\w+)/log/(?P<N>\d+)/tag/(?P<tagname>[^/]+)', 'deleteTag'),
+        ('GET',    'events/(?P<graceid>\w+)/labels',                'labels'),
+        ('GET',    'events/(?P<graceid>\w+)/labels/(?P<label>[^/]+)', 'label'),
+        ('PUT',    'events/(?P<graceid>\w+)/labels/(?P<label>[^/]+)', 'writeLabel'),
+        ('DELETE', 'events/(?P<graceid>\w+)/labels/(?P<label>[^/]+)', 'removeLabel'),
+        ('GET',    'events/(?P<graceid>\w+)/files',                 'files'),
+        ('GET',    'events/(?P<graceid>\w+)/files/(?P<filename>.+?)', 'file'),
+        ('GET',    'events/(?P<graceid>\w+)/voevent',               'voevents'),
+        ('POST',   'events/(?P<graceid>\w+)/voevent',               'createVOEvent'),
+        ('GET',    'events/(?P<graceid>\w+)/emobservation',         'emobservations'),
+        ('POST',   'events/(?P<graceid>\w+)/emobservation',         'writeEMObservation'),
+        ('GET',    'events/(?P<graceid>\w+)/embb',                  'eels'),
+        ('POST',   'events/(?P<graceid>\w+)/embb',                  'writeEel'),
+      ]
+    ]
+
+    def do_GET(self):
+        self.__dispatch__('GET')
+
+    def do_POST(self):
+        self.__dispatch__('POST')
+
+    def do_PUT(self):
+        self.__dispatch__('PUT')
+
+    def do_DELETE(self):
+        self.__dispatch__('DELETE')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            httpserver.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    #--- plumbing
+
+    def __dispatch__(self, method):
+        '''
+        find the route matching this request, call the associated method and translate any errors into status codes
+        '''
+        url = urlparse(self.path)
+        self.params = parse_qs(url.query)
+        self.uploads = dict()
+        self.fields = None
+        self.headersSent = False
+        try:
+            self.form, self.uploads = self.__body__() ### always consume the body so the connection can be reused
+
+            for meth, regex, name in self.__routes__:
+                match = regex.match(url.path)
+                if match:
+                    if meth==method:
+                        break
+            else:
+                raise HTTPError(405 if any(regex.match(url.path) for _, regex, _ in self.__routes__) else 404, '%s %s not understood'%(method, url.path))
+
+            kwargs = dict((key, unquote(val)) for key, val in match.groupdict().items())
+            gdb = self.server.fakedb()
+            if 'graceid' in kwargs and not gdb.storage.exists(kwargs['graceid']):
+                raise HTTPError(404, 'could not find graceid=%s'%kwargs['graceid'])
+            getattr(self, '__%s__'%name)(gdb, **kwargs)
+
+        except HTTPError as e:
+            self.__error__(e.code, str(e))
+        except FakeTTPError as e:
+            self.__error__(400, str(e))
+        except NotImplementedError as e:
+            self.__error__(501, str(e) or '%s %s is not implemented by FakeDb'%(method, url.path))
+        except Exception:
+            self.__error__(500, traceback.format_exc())
+
+        finally:
+            for filename, file_obj in self.uploads.values():
+                file_obj.close()
+            self.fields = None
+
+    def __body__(self):
+        '''
+        read the request body. returns a dictionary of form fields (name -> list of values) and uploaded files (name -> (filename, file_obj))
+        '''
+        form = dict()
+        uploads = dict()
+
+        contentType = self.headers.get('Content-Type', '')
+        if contentType.startswith('multipart/form-data') or contentType.startswith('application/x-www-form-urlencoded'):
+            fields = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={'REQUEST_METHOD':self.command, 'CONTENT_TYPE':contentType})
+            self.fields = fields ### python3 closes uploaded files once their FieldStorage is garbage collected, so we hold onto it until the request is done
+            for key in fields.keys():
+                items = fields[key]
+                if not isinstance(items, list):
+                    items = [items]
+                for item in items:
+                    if item.filename:
+                        uploads[key] = (os.path.basename(item.filename), item.file)
+                    else:
+                        form.setdefault(key, []).append(item.value)
+
+        else:
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length else ''
+            if body and contentType.startswith('application/json'):
+                form = dict((key, val if isinstance(val, list) else [val]) for key, val in json.loads(body).items())
+
+        return form, uploads
+
+    def __field__(self, key, default=None):
+        return self.form.get(key, [default])[0]
+
+    def __param__(self, key, default=None):
+        return self.params.get(key, [default])[0]
+
+    def __url__(self, path=''):
+        return 'http://%s/api/%s'%(self.headers.get('Host', '%s:%d'%self.server.server_address), path)
+
+    def __headers__(self, code, contentType, headers={}):
+        self.headersSent = True
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        for key, val in headers.items():
+            self.send_header(key, val)
+
+    def __send__(self, code, body, contentType='application/json', headers={}):
+        body = asbytes(body)
+        self.__headers__(code, contentType, headers=headers)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command!='HEAD':
+            self.wfile.write(body)
+
+    def __sendJSON__(self, obj, code=200, headers={}):
+        self.__send__(code, json.dumps(obj), headers=headers)
+
+    def __sendChunks__(self, chunks, code=200, contentType='application/json'):
+        '''
+        stream an iterable of strings with chunked transfer-encoding, so we never build the whole body in memory
+        '''
+        self.__headers__(code, contentType, headers={'Transfer-Encoding':'chunked'})
+        self.end_headers()
+        for chunk in chunks:
+            if chunk:
+                chunk = asbytes(chunk)
+                self.wfile.write(asbytes('%x\r\n'%len(chunk)) + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def __error__(self, code, message):
+        if self.headersSent: ### we failed part way through a response, so all we can do is drop the connection
+            self.close_connection = 1
+            return
+        self.__send__(code, message, contentType='text/plain')
+
+    def __upload__(self, key, method, *args, **kwargs):
+        '''
+        FakeDb reads uploads from disk, so we write the uploaded file (if any) into a temporary directory under its own name and
+        call method(*args, filename=path, **kwargs). Returns whatever method returns
+        '''
+        if key not in self.uploads:
+            return method(*args, **kwargs)
+
+        filename, file_obj = self.uploads[key]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, filename)
+            tmp_obj = open(path, 'wb')
+            shutil.copyfileobj(file_obj, tmp_obj, self.__chunkSize__)
+            tmp_obj.close()
+            return method(*args, filename=path, **kwargs)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def __links__(self, event):
+        '''
+        point an event's links (and the links to its labels) at this server rather than at FakeDb's directories
+        '''
+        graceid = event.get('graceid')
+        if 'links' in event:
+            event['links'] = {'neighbors'      : self.__url__('events/%s/neighbors/'%graceid),
+                              'files'          : self.__url__('events/%s/files/'%graceid),
+                              'log'            : self.__url__('events/%s/log/'%graceid),
+                              'tags'           : self.__url__('events/%s/tag/'%graceid),
+                              'self'           : self.__url__('events/%s'%graceid),
+                              'labels'         : self.__url__('events/%s/labels/'%graceid),
+                              'filemeta'       : self.__url__('events/%s/filemeta/'%graceid),
+                              'emobservations' : self.__url__('events/%s/emobservation/'%graceid),
+                              'embb'           : self.__url__('events/%s/embb/'%graceid),
+                              'voevents'       : self.__url__('events/%s/voevent/'%graceid),
+                             }
+        if 'labels' in event:
+            event['labels'] = dict((label, self.__url__('events/%s/labels/%s'%(graceid, quote(label)))) for label in event['labels'])
+        return event
+
+    def __logLinks__(self, log, graceid):
+        log['self'] = self.__url__('events/%s/log/%d'%(graceid, log['N']))
+        return log
+
+    def __labelLinks__(self, label, graceid):
+        label['self'] = self.__url__('events/%s/labels/%s'%(graceid, quote(label['name'])))
+        return label
+
+    def __pageLinks__(self, page, path):
+        '''
+        point the links of a (single) page of results at this server
+        '''
+        url = self.__url__(path)
+        page['links'] = {'self':url, 'first':url, 'last':url}
+        return page
+
+    #--- routes
+
+    def __stats__(self, gdb):
+        self.__sendJSON__(gdb.stats())
+
+    def __serviceInfo__(self, gdb):
+        self.__sendJSON__({'links': {'self'   : self.__url__(),
+                                     'events' : self.__url__('events/'),
+                                    },
+                           'templates': {'event-detail-template'          : self.__url__('events/{graceid}'),
+                                         'event-log-template'             : self.__url__('events/{graceid}/log/'),
+                                         'event-log-detail-template'      : self.__url__('events/{graceid}/log/{N}'),
+                                         'event-label-template'           : self.__url__('events/{graceid}/labels/{label}'),
+                                         'files-template'                 : self.__url__('events/{graceid}/files/{filename}'),
+                                         'taglist-template'               : self.__url__('events/{graceid}/log/{N}/tag/'),
+                                         'tag-template'                   : self.__url__('events/{graceid}/log/{N}/tag/{tag_name}'),
+                                         'voevent-list-template'          : self.__url__('events/{graceid}/voevent/'),
+                                         'emobservation-list-template'    : self.__url__('events/{graceid}/emobservation/'),
+                                         'embb-event-log-template'        : self.__url__('events/{graceid}/embb/'),
+                                        },
+                           'groups'        : gdb.groups,
+                           'pipelines'     : gdb.pipelines,
+                           'searches'      : gdb.searches,
+                           'labels'        : sorted(gdb.__allowedLabels__),
+                           'em-groups'     : gdb.__allowedEMGroups__,
+                           'wavebands'     : gdb.__allowedWavebands__,
+                           'voevent-types' : gdb.__allowedVOEventTypes__,
+                           'eel-statuses'  : gdb.__allowedEELStatuses__,
+                           'obs-statuses'  : gdb.__allowedOBSStatuses__,
+                          })
+
+    def __events__(self, gdb):
+        '''
+        events are streamed as they come out of FakeDb.events. count (the page size) and start select a page, and we link to the next page if there is one.
+        '''
+        query = self.__param__('query')
+        orderby = self.__param__('sort', self.__param__('orderby'))
+        columns = self.__param__('columns')
+        start = int(self.__param__('start', 0))
+        count = self.__param__('count')
+
+        numRows = gdb.numEvents(query) ### raises FakeTTPError for bad queries before we send anything
+
+        if count is None:
+            stop = None
+            nxt = None
+        else:
+            stop = start+int(count)
+            nxt = stop if stop < numRows else None
+        events = itertools.islice(gdb.events(query, orderby=orderby, columns=columns), start, stop)
+
+        links = {'self' : self.__url__('events/?'+urlencode(dict((key, val[0]) for key, val in self.params.items())))}
+        if nxt is not None:
+            params = dict((key, val[0]) for key, val in self.params.items())
+            params['start'] = nxt
+            links['next'] = self.__url__('events/?'+urlencode(params))
+
+        self.__sendChunks__(self.__stream__(events, numRows, start, links))
+
+    def __stream__(self, events, numRows, start, links):
+        yield '{"numRows": %d, "start": %d, "links": %s, "events": ['%(numRows, start, json.dumps(links))
+        buf = []
+        size = 0
+        for i, event in enumerate(events):
+            buf.append( (', ' if i else '') + json.dumps(self.__links__(event)) )
+            size += len(buf[-1])
+            if size > self.__chunkSize__:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        yield ''.join(buf) + ']}'
+
+    def __createEvent__(self, gdb):
+        group = self.__field__('group')
+        pipeline = self.__field__('pipeline')
+        if (group is None) or (pipeline is None) or ('eventFile' not in self.uploads):
+            raise HTTPError(400, 'group, pipeline and eventFile are required')
+
+        event = self.__upload__('eventFile', gdb.createEvent, group, pipeline, search=self.__field__('search')).json()
+        url = self.__url__('events/%s'%event['graceid'])
+        self.__sendJSON__(self.__links__(event), code=201, headers={'Location':url})
+
+    def __event__(self, gdb, graceid):
+        self.__sendJSON__(self.__links__(gdb.event(graceid).json()))
+
+    def __logs__(self, gdb, graceid):
+        logs = gdb.logs(graceid).json()
+        logs['log'] = [self.__logLinks__(log, graceid) for log in logs['log']]
+        self.__sendJSON__(self.__pageLinks__(logs, 'events/%s/log/'%graceid))
+
+    def __log__(self, gdb, graceid, N):
+        N = int(N)
+        for log in gdb.logs(graceid).json()['log']:
+            if log['N']==N:
+                return self.__sendJSON__(self.__logLinks__(log, graceid))
+        raise HTTPError(404, 'could not find N=%d for graceid=%s'%(N, graceid))
+
+    def __writeLog__(self, gdb, graceid):
+        log = self.__upload__('upload', gdb.writeLog, graceid, self.__field__('message', self.__field__('comment', '')), tagname=self.form.get('tagname', []), displayName=self.__field__('displayName')).json()
+        self.__sendJSON__(self.__logLinks__(log, graceid), code=201, headers={'Location':self.__url__('events/%s/log/%d'%(graceid, log['N']))})
+
+    def __tags__(self, gdb, graceid, N):
+        self.__sendJSON__(self.__pageLinks__(gdb.tags(graceid, int(N)).json(), 'events/%s/log/%d/tag/'%(graceid, int(N))))
+
+    def __createTag__(self, gdb, graceid, N, tagname):
+        self.__sendJSON__(gdb.createTag(graceid, int(N), tagname, displayName=self.__field__('displayName')).json(), code=201)
+
+    def __deleteTag__(self, gdb, graceid, N, tagname):
+        self.__sendJSON__(gdb.deleteTag(graceid, int(N), tagname).json())
+
+    def __labels__(self, gdb, graceid):
+        labels = gdb.labels(graceid).json()
+        labels['labels'] = [self.__labelLinks__(label, graceid) for label in labels['labels']]
+        labels['links'] = [{'self':self.__url__('events/%s/labels/'%graceid), 'event':self.__url__('events/%s'%graceid)}]
+        self.__sendJSON__(labels)
+
+    def __label__(self, gdb, graceid, label):
+        for entry in gdb.labels(graceid, label).json()['labels']:
+            if entry['name']==label:
+                return self.__sendJSON__(self.__labelLinks__(entry, graceid))
+        raise HTTPError(404, 'could not find label=%s for graceid=%s'%(label, graceid))
+
+    def __writeLabel__(self, gdb, graceid, label):
+        self.__sendJSON__(self.__labelLinks__(gdb.writeLabel(graceid, label).json(), graceid), code=201, headers={'Location':self.__url__('events/%s/labels/%s'%(graceid, label))})
+
+    def __removeLabel__(self, gdb, graceid, label):
+        gdb.removeLabel(graceid, label)
+        self.__send__(204, '')
+
+    def __files__(self, gdb, graceid):
+        self.__sendJSON__(dict((filename, self.__url__('events/%s/files/%s'%(graceid, quote(filename)))) for filename in gdb.files(graceid).json().keys()))
+
+    def __file__(self, gdb, graceid, filename):
+        '''
+        stream the contents of an uploaded file. GraceDb refers to versions as "filename,N", but FakeDb only keeps the latest version
+        '''
+        filename = re.sub(',\d+$', '', filename)
+        paths = [path for path in gdb.storage.extract(graceid, 'files') if os.path.basename(path)==filename] ### only serve files that were actually uploaded
+        if not paths:
+            raise HTTPError(404, 'could not find filename=%s for graceid=%s'%(filename, graceid))
+
+        file_obj = open(paths[-1], 'rb')
+        try:
+            self.__headers__(200, 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(file_obj.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(file_obj, self.wfile, self.__chunkSize__)
+        finally:
+            file_obj.close()
+
+    def __voevents__(self, gdb, graceid):
+        self.__sendJSON__(self.__pageLinks__(gdb.voevents(graceid).json(), 'events/%s/voevent/'%graceid))
+
+    def __createVOEvent__(self, gdb, graceid):
+        kwargs = dict((key, val[0]) for key, val in self.form.items())
+        self.__sendJSON__(gdb.createVOEvent(graceid, kwargs.pop('voevent_type', None), **kwargs).json(), code=201)
+
+    def __emobservations__(self, gdb, graceid):
+        self.__sendJSON__(self.__pageLinks__(gdb.emobservations(graceid).json(), 'events/%s/emobservation/'%graceid))
+
+    def __writeEMObservation__(self, gdb, graceid):
+        '''
+        the client posts one list per footprint column. These stay lists even when there is only a single footprint
+        '''
+        keys = ['ra_list', 'ra_width_list', 'dec_list', 'dec_width_list', 'start_time_list', 'duration_list']
+        missing = [key for key in ['group']+keys if key not in self.form]
+        if missing:
+            raise HTTPError(400, '%s required'%(', '.join(missing)))
+        if len(set(len(self.form[key]) for key in keys))>1:
+            raise HTTPError(400, '%s must all have the same length'%(', '.join(keys)))
+
+        self.__sendJSON__(gdb.writeEMObservation(graceid,
+                                                 self.__field__('group'),
+                                                 raList=self.form['ra_list'],
+                                                 raWidthList=self.form['ra_width_list'],
+                                                 decList=self.form['dec_list'],
+                                                 decWidthList=self.form['dec_width_list'],
+                                                 startTimeList=self.form['start_time_list'],
+                                                 durationList=self.form['duration_list'],
+                                                 comment=self.__field__('comment'),
+                                                ).json(), code=201)
+
+    def __eels__(self, gdb, graceid):
+        self.__sendJSON__(self.__pageLinks__(gdb.eels(graceid).json(), 'events/%s/embb/'%graceid))
+
+    def __writeEel__(self, gdb, graceid):
+        kwargs = dict((key, val[0]) for key, val in self.form.items())
+        self.__sendJSON__(gdb.writeEel(graceid, **kwargs).json(), code=201)
+
+#-------------------------------------------------
+
+class PooledMixIn:
+    '''
+    like SocketServer.ThreadingMixIn, but connections are handed to a fixed pool of worker threads.
+    each worker keeps its own FakeDb instance, so indexes and caches are loaded once per worker rather than once per connection.
+    '''
+    threads = 16
+
+    def __startWorkers__(self):
+        self.__connections__ = queue.Queue()
+        self.__local__ = threading.local()
+        for _ in xrange(self.threads):
+            thread = threading.Thread(target=self.__work__)
+            thread.daemon = True
+            thread.start()
+
+    def __work__(self):
+        while True:
+            request, client_address = self.__connections__.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.__connections__.put((request, client_address))
+
+class FakeDbServer(PooledMixIn, httpserver.HTTPServer):
+    '''
+    serves the FakeDb in directory at http://host:port/api/ so that ligo.gracedb.rest.GraceDb (and schedule.initGraceDb) can talk to it.
+    kwargs (storage, layout, dedup, durability, group_commit_window, cache_entries, cache_bytes) are passed to each worker's FakeDb.
+    if stats=True (or metrics_file is given), the workers share a single ligoTest.gracedb.stats.Stats, which is reported at /api/stats/
+
+    usage:
+        server = FakeDbServer(('localhost', 8000), directory)
+        server.serve_forever()
+    '''
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, directory, threads=16, verbose=False, **kwargs):
+        self.directory = directory
+        self.kwargs = kwargs
+        self.threads = threads
+        self.verbose = verbose
+
+        if kwargs.pop('stats', False) or kwargs.get('metrics_file'): ### one set of counters for every worker
+            kwargs['stats'] = Stats(path=kwargs.pop('metrics_file', None), interval=kwargs.pop('metrics_interval', 60.))
+
+        FakeDb(directory, **kwargs) ### check (and record) settings now so mistakes surface here instead of within a worker
+
+        httpserver.HTTPServer.__init__(self, address, FakeDbRequestHandler)
+        self.__startWorkers__()
+
+    @property
+    def url(self):
+        return 'http://%s:%d/api/'%self.server_address
+
+    def fakedb(self):
+        '''
+        the FakeDb instance belonging to the calling worker thread
+        '''
+        if not hasattr(self.__local__, 'gdb'):
+            self.__local__.gdb = FakeDb(self.directory, **self.kwargs)
+        return self.__local__.gdb
@@ -0,0 +1,187 @@
+description = "a module that provides low-overhead counters of what FakeDb does (calls, latencies, bytes, serialization time, lvalert messages)"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import math
+import tempfile
+
+import json
+
+import time
+import threading
+import types
+
+#-------------------------------------------------
+
+class Stats(object):
+    '''
+    counters shared by everything that touches a FakeDb directory on behalf of one (or several) FakeDb instances.
+        calls         : the number of calls to (and errors raised by) each public method, the total time spent in them and a histogram of their latencies
+        bytes         : how many bytes were read and written
+        serialization : how many times and for how long we pickled/unpickled ("pickle") or encoded/decoded JSON ("json")
+        lvalert_lines : how many lvalert messages were written
+    latencies are binned by powers of 2 from 1 microsecond up, so recording one costs the same regardless of how many we've recorded.
+
+    if path is given, a snapshot is written there (atomically, as JSON) at most once every interval seconds, by whichever call finishes after a dump is due.
+    nothing is counted unless FakeDb is asked to, and then only the methods wrapped by instrument (and the code paths handed this object) pay for it.
+    '''
+    __numBins__ = 32 ### the last bin holds everything longer than ~35 minutes
+
+    def __init__(self, path=None, interval=60.):
+        self.path = path
+        self.interval = interval
+        self.__lock__ = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock__:
+            self.calls = dict() ### name -> [calls, errors, seconds, histogram]
+            self.bytes = {'read':0, 'written':0}
+            self.serializations = dict() ### kind -> [count, seconds]
+            self.lvalertLines = 0
+            self.start = time.time()
+            self.__nextDump__ = self.start + self.interval
+
+    #--- recording
+
+    def call(self, name, seconds, error=False):
+        '''
+        record a call to name that took seconds
+        '''
+        ### frexp(x)[1] is e such that 2**(e-1) <= x < 2**e, so this is the bin whose upper edge is 2**e microseconds
+        ind = min(max(math.frexp(seconds*1e6)[1], 0), self.__numBins__-1)
+        with self.__lock__:
+            if name not in self.calls:
+                self.calls[name] = [0, 0, 0.0, [0]*self.__numBins__]
+            counts = self.calls[name]
+            counts[0] += 1
+            if error:
+                counts[1] += 1
+            counts[2] += seconds
+            counts[3][ind] += 1
+
+            dump = (self.path is not None) and (time.time() >= self.__nextDump__)
+            if dump: ### only one thread dumps each time it is due
+                self.__nextDump__ = time.time() + self.interval
+        if dump:
+            self.dump()
+
+    def read(self, nbytes):
+        with self.__lock__:
+            self.bytes['read'] += nbytes
+
+    def write(self, nbytes):
+        with self.__lock__:
+            self.bytes['written'] += nbytes
+
+    def serialization(self, kind, seconds):
+        '''
+        record time spent serializing or deserializing with kind ("pickle" or "json")
+        '''
+        with self.__lock__:
+            if kind not in self.serializations:
+                self.serializations[kind] = [0, 0.0]
+            self.serializations[kind][0] += 1
+            self.serializations[kind][1] += seconds
+
+    def lvalerts(self, num):
+        with self.__lock__:
+            self.lvalertLines += num
+
+    #--- instrumentation
+
+    def instrument(self, obj, exclude=[]):
+        '''
+        replace every public method of obj (except those in exclude) with a version that records each call.
+        this only touches obj, so other instances of its class are unaffected. Public methods that call each other are counted once for each
+        '''
+        cls = obj.__class__ ### type(obj) is not the class of old-style (python2) instances
+        for name in dir(cls):
+            if name.startswith('_') or (name in exclude):
+                continue
+            if isinstance(getattr(cls, name), property): ### do not evaluate properties
+                continue
+            method = getattr(obj, name)
+            if callable(method):
+                setattr(obj, name, self.wrap(name, method))
+
+    def wrap(self, name, func):
+        '''
+        a version of func that records how long each call takes. Generators (eg: FakeDb.events) are timed until they are exhausted or closed
+        '''
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            try:
+                ans = func(*args, **kwargs)
+            except Exception:
+                self.call(name, time.time()-t0, error=True)
+                raise
+            if isinstance(ans, types.GeneratorType):
+                return self.__iterate__(name, ans, time.time()-t0)
+            self.call(name, time.time()-t0)
+            return ans
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def __iterate__(self, name, generator, seconds):
+        '''
+        yield from generator, adding up the time spent within it
+        '''
+        error = False
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    seconds += time.time()-t0
+                    break
+                except Exception:
+                    seconds += time.time()-t0
+                    error = True
+                    raise
+                seconds += time.time()-t0
+                yield item
+        finally: ### also reached if the caller stops iterating early
+            self.call(name, seconds, error=error)
+
+    #--- reporting
+
+    def snapshot(self):
+        '''
+        everything we've counted as a JSON-serializable dictionary. Histograms only list the bins that are not empty,
+        as a list of [upper edge in seconds, count]
+        '''
+        with self.__lock__:
+            now = time.time()
+            calls = dict()
+            for name, (num, errors, seconds, histogram) in self.calls.items():
+                calls[name] = {'calls'     : num,
+                               'errors'    : errors,
+                               'seconds'   : seconds,
+                               'mean'      : seconds/num,
+                               'histogram' : [[2.**ind*1e-6, count] for ind, count in enumerate(histogram) if count],
+                              }
+
+            return {'start'         : self.start,
+                    'elapsed'       : now - self.start,
+                    'calls'         : calls,
+                    'bytes'         : dict(self.bytes),
+                    'serialization' : dict((kind, {'count':num, 'seconds':seconds}) for kind, (num, seconds) in self.serializations.items()),
+                    'lvalert_lines' : self.lvalertLines,
+                   }
+
+    def dump(self, path=None):
+        '''
+        write a snapshot into path (self.path by default) via a temporary file, so readers never see a partial snapshot
+        '''
+        path = path if path is not None else self.path
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp')
+        file_obj = os.fdopen(fd, 'w')
+        json.dump(self.snapshot(), file_obj)
+        file_obj.close()
+        os.rename(tmp, path)
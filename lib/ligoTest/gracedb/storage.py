@@ -0,0 +1,1595 @@
+description = "a module that defines the storage backends FakeDb uses to persist events"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import shutil
+import tempfile
+
+import fcntl
+
+import json
+
+import time
+
+import sqlite3
+
+from ligoTest.gracedb.journal import Journal
+from ligoTest.gracedb.index import LabelIndex, GPSIndex, NodeIndex, AttributeIndex, EELIndex, TagIndex, Counters
+from ligoTest.gracedb.locks import FileLock
+from ligoTest.gracedb.durability import Durability
+from ligoTest.gracedb.compat import xrange, basestring, pickle, PICKLE_PROTOCOL
+
+#-------------------------------------------------
+
+class Storage(object):
+    '''
+    the interface through which FakeDb persists events.
+    each event is a top-level dictionary along with several collections of records (logs, labels, files).
+    optional collections (eg: emobservations, eels, voevents, tags) are only created when they are first written, since most events never have any.
+    uploaded files always live in a directory associated with each graceid, regardless of the backend.
+
+    children must overwrite the methods that touch data. The queries defined here (label2graceids, gps2graceids)
+    scan every event and should be overwritten when a backend can do better.
+
+    event directories are either all placed directly within the top-level directory (layout="flat") or
+    spread across nested shards (layout="sharded", eg: T/000/123/T123456) so that no directory holds more than ~1000 entries.
+
+    durability (see ligoTest.gracedb.durability) decides when what we write is forced onto disk.
+    if stats (see ligoTest.gracedb.stats) is not None, we count the bytes we read and write and the time we spend serializing records.
+    '''
+    name = 'storage'
+    collections = ['logs', 'labels', 'files']
+    optionalCollections = ['emobservations', 'eels', 'voevents', 'tags']
+    layouts = ['flat', 'sharded']
+
+    sortKeys = ['graceid', 'gpstime', 'far', 'created'] ### what we can order events by without reading them
+    attributeKeys = ['graceid', 'group', 'pipeline', 'search', 'gpstime', 'far', 'FAR', 'created'] ### top-level data we can report without reading events
+    rangeKeys = ['gpstime', 'far', 'created'] ### what queries can select ranges of
+    valueKeys = ['group', 'pipeline', 'search'] ### what queries can select exact values of
+
+    def __init__(self, directory, is_graceid=lambda graceid: True, cache=None, layout='flat', durability=None, stats=None):
+        self.service_url = directory
+        self.is_graceid = is_graceid ### used to tell event directories apart from everything else
+        self.cache = cache ### an LRUCache (see ligoTest.gracedb.cache) of decoded data or None
+        if layout not in self.layouts:
+            raise ValueError('layout=%s not understood'%layout)
+        self.layout = layout
+        self.durability = durability if durability is not None else Durability()
+        self.stats = stats
+
+    def directory(self, graceid):
+        '''
+        the directory associated with this graceid (where uploaded files are stored)
+        '''
+        if self.layout=='sharded':
+            return os.path.join(self.service_url, *self.__shards__(graceid))
+        return os.path.join(self.service_url, graceid)
+
+    def __shards__(self, graceid):
+        '''
+        the path to this graceid's directory within a sharded layout: letter, millions, thousands, graceid
+        '''
+        num = int(graceid[1:])
+        return [graceid[0], '%03d'%(num//1000000), '%03d'%((num//1000)%1000), graceid]
+
+    def iterGraceids(self, letter=None):
+        '''
+        iterate over the graceids of all events (only those starting with letter if it is not None) stored within the directory layout.
+        a sharded layout is walked one shard at a time, so we never hold the full listing in memory and graceids come out sorted.
+        NOTE: a flat layout is a single directory, so it still has to be listed all at once.
+        '''
+        if self.layout=='sharded':
+            letters = [letter] if letter is not None else sorted(path for path in os.listdir(self.service_url) if len(path)==1)
+            for letter in letters:
+                for shards in self.__walk__([letter], 2):
+                    for graceid in sorted(os.listdir(os.path.join(self.service_url, *shards))):
+                        if self.is_graceid(graceid):
+                            yield graceid
+
+        else:
+            for graceid in os.listdir(self.service_url):
+                if self.is_graceid(graceid) and ((letter is None) or (graceid[0]==letter)):
+                    yield graceid
+
+    def __walk__(self, shards, depth):
+        '''
+        iterate over the lists of path components that lead to the directories depth levels below shards
+        '''
+        path = os.path.join(self.service_url, *shards)
+        if not os.path.isdir(path):
+            return
+        if depth==0:
+            yield shards
+        else:
+            for shard in sorted(os.listdir(path)):
+                for ans in self.__walk__(shards+[shard], depth-1):
+                    yield ans
+
+    def path(self, graceid, kind):
+        '''
+        a reference to where a collection (or the top-level data if kind="toplevel") is stored
+        '''
+        raise NotImplementedError
+
+    def lock(self, graceid):
+        '''
+        an advisory lock for this graceid, which writers hold while they update the event.
+        this is shared across processes and re-entrant within a thread.
+        '''
+        return FileLock(os.path.join(self.directory(graceid), '.lock'))
+
+    def exists(self, graceid):
+        raise NotImplementedError
+
+    def graceids(self):
+        return list(self.iterGraceids())
+
+    def create(self, graceid):
+        '''
+        generate the data structures needed for this graceid
+        '''
+        raise NotImplementedError
+
+    def write(self, graceid, toplevel):
+        '''
+        record top-level data for this graceid
+        '''
+        raise NotImplementedError
+
+    def read(self, graceid):
+        '''
+        return top-level data for this graceid
+        '''
+        raise NotImplementedError
+
+    def append(self, graceid, kind, record):
+        '''
+        add record to a collection and return its index
+        '''
+        raise NotImplementedError
+
+    def extend(self, graceid, updates):
+        '''
+        add records to several collections at once. updates is a list of (kind, records) pairs.
+        returns a list with the index of the first new record in each collection.
+        children should overwrite this so that batches are applied with as few operations as possible.
+        '''
+        ans = []
+        for kind, records in updates:
+            inds = [self.append(graceid, kind, record) for record in records]
+            ans.append( inds[0] if inds else self.length(graceid, kind) )
+        return ans
+
+    def extract(self, graceid, kind):
+        '''
+        return a list of all records in a collection
+        '''
+        raise NotImplementedError
+
+    def length(self, graceid, kind):
+        return len(self.extract(graceid, kind))
+
+    @staticmethod
+    def sortValue(attributes, key):
+        '''
+        the value we sort on for key. Some pipelines report "FAR" instead of "far", so we accept either one
+        '''
+        if key=='far':
+            return attributes.get('far', attributes.get('FAR'))
+        return attributes.get(key)
+
+    def attributes(self, graceid):
+        '''
+        return the subset of top-level data listed in attributeKeys
+        '''
+        return self.__attributes__(self.read(graceid))
+
+    def __attributes__(self, toplevel):
+        return dict((key, toplevel[key]) for key in self.attributeKeys if key in toplevel)
+
+    def ordered(self, key, reverse=False):
+        '''
+        iterate over graceids sorted by key (one of sortKeys), largest first if reverse
+        '''
+        graceids = self.graceids()
+        if key=='graceid':
+            return iter(sorted(graceids, reverse=reverse))
+        values = self.sortValues(graceids, key)
+        return iter(sorted(graceids, key=lambda graceid: (values[graceid], graceid), reverse=reverse))
+
+    def sortValues(self, graceids, key):
+        '''
+        return a dictionary mapping each graceid to the value we sort on for key (one of sortKeys)
+        '''
+        return dict((graceid, self.sortValue(self.attributes(graceid), key)) for graceid in graceids)
+
+    ### lookups used by compiled queries (see ligoTest.gracedb.query)
+    ### the *Size methods estimate how many graceids a lookup returns so the query planner can pick the most selective one
+
+    def queryAttributes(self, graceid):
+        '''
+        return the values queries can test (rangeKeys and valueKeys) for graceid
+        '''
+        attributes = self.attributes(graceid)
+        return dict((key, self.sortValue(attributes, key)) for key in self.rangeKeys+self.valueKeys)
+
+    def labelSize(self, label):
+        return len(self.label2graceids(label))
+
+    def range2graceids(self, key, start=None, stop=None):
+        '''
+        return the set of graceids with start <= value <= stop for key (one of rangeKeys). Either end may be None (unbounded)
+        '''
+        ans = set()
+        for graceid in self.iterGraceids():
+            value = self.queryAttributes(graceid)[key]
+            if (value is not None) and ((start is None) or (start <= value)) and ((stop is None) or (value <= stop)):
+                ans.add( graceid )
+        return ans
+
+    def rangeSize(self, key, start=None, stop=None):
+        return len(self.range2graceids(key, start=start, stop=stop))
+
+    def value2graceids(self, key, value):
+        '''
+        return the set of graceids with this value for key (one of valueKeys)
+        '''
+        return set(graceid for graceid in self.iterGraceids() if self.queryAttributes(graceid)[key]==value)
+
+    def valueSize(self, key, value):
+        return len(self.value2graceids(key, value))
+
+    def count(self, kind=None, value=None):
+        '''
+        the number of events (kind=None), of events with this value for one of valueKeys (eg: kind="pipeline"), or of events labeled with value (kind="label").
+        children should maintain counters as events are created and labeled so this does not depend on the number of events
+        '''
+        if kind is None:
+            return len(self.graceids())
+        elif kind=='label':
+            return self.labelSize(value)
+        return self.valueSize(kind, value)
+
+    def __countKey__(self, kind=None, value=None):
+        if kind is None:
+            return 'total'
+        return '%s:%s'%(kind, value)
+
+    def __countKeys__(self, toplevel):
+        '''
+        the counters a new event contributes to
+        '''
+        return [self.__countKey__()] + [self.__countKey__(key, toplevel[key]) for key in self.valueKeys if toplevel.get(key) is not None]
+
+    def replace(self, graceid, kind, stuff):
+        '''
+        overwrite a collection (or the top-level data if kind="toplevel") without touching any index.
+        this is only meant for maintenance (eg: bin/migrate_FakeDb.py) while no one else is writing.
+        '''
+        raise NotImplementedError
+
+    def load(self, events):
+        '''
+        store many new events at once (eg: FakeDb.importEvents). events is a list of (graceid, toplevel, updates, node), where updates is a list of
+        (kind, records) pairs exactly as they should be stored. graceids must have been reserved (see reserve) so no one else writes these events while we do.
+        children should overwrite this so each index is updated once per batch rather than once per event.
+        '''
+        for graceid, toplevel, updates, node in events:
+            self.create(graceid)
+            self.extend(graceid, updates)
+            self.write(graceid, toplevel)
+            self.setNode(graceid, node)
+
+    def __counterPath__(self, letter):
+        return os.path.join(self.service_url, 'counters', letter)
+
+    def __maxIndex__(self, letter):
+        '''
+        the biggest index among known graceids with this letter, or -1 if there are none
+        '''
+        return max([int(graceid[1:]) for graceid in self.iterGraceids(letter=letter)] or [-1])
+
+    def reserve(self, letter, num=1):
+        '''
+        reserve num consecutive indecies for graceids with this letter and return the first one.
+        the next available index is kept in a counter file that we lock while updating, so this costs the same 
+        regardless of the number of events and is safe across processes.
+        '''
+        path = self.__counterPath__(letter)
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+            except OSError: ### another process beat us to it
+                pass
+
+        file_obj = open(path, 'a+')
+        fcntl.flock(file_obj, fcntl.LOCK_EX)
+        try:
+            file_obj.seek(0, 0)
+            count = file_obj.read().strip()
+            if count:
+                start = int(count)
+            else: ### bootstrap the counter from whatever is already there
+                start = self.__maxIndex__(letter)+1
+
+            file_obj.seek(0, 0)
+            file_obj.truncate()
+            file_obj.write("%d\n"%(start+num))
+            file_obj.flush()
+            self.durability.sync(path) ### never hand out the same graceid twice, even after a crash
+
+        finally:
+            fcntl.flock(file_obj, fcntl.LOCK_UN)
+            file_obj.close()
+
+        return start
+
+    def setNode(self, graceid, node):
+        '''
+        record the lvalert node associated with graceid
+        '''
+        raise NotImplementedError
+
+    def node(self, graceid):
+        '''
+        return the lvalert node associated with graceid or None if it was never recorded
+        '''
+        raise NotImplementedError
+
+    def label2graceids(self, label):
+        '''
+        return the set of graceids that have been labeled with label
+        '''
+        return set(graceid for graceid in self.graceids() if label in [d['name'] for d in self.extract(graceid, 'labels')])
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        '''
+        return the set of graceids with gpsstart <= gpstime <= gpsstop
+        '''
+        ans = set()
+        for graceid in self.graceids():
+            gpstime = self.read(graceid)['gpstime']
+            if (gpsstart<=gpstime) and (gpstime<=gpsstop):
+                ans.add( graceid )
+        return ans
+
+    @staticmethod
+    def tagNames(log):
+        '''
+        the tags a log message was written with. Older versions of FakeDb stored a single tag name as a string
+        '''
+        names = log.get('tag_names') or []
+        return [names] if isinstance(names, basestring) else list(names)
+
+    def logTags(self, graceid):
+        '''
+        the tags currently applied to graceid's log messages as a dictionary mapping N -> list of tag names (in the order they were applied).
+        log messages record the tags they were written with (tag_names), and the "tags" collection records every tag created or deleted since.
+        each record in "tags" is {'log_N', 'name', 'applied', ...}, where applied is False for deletions
+        '''
+        ans = dict()
+        for log in self.extract(graceid, 'logs'):
+            names = self.tagNames(log)
+            if names:
+                ans[log['N']] = names
+        for tag in self.extract(graceid, 'tags'):
+            names = ans.setdefault(tag['log_N'], [])
+            if tag['applied']:
+                if tag['name'] not in names:
+                    names.append( tag['name'] )
+            elif tag['name'] in names:
+                names.remove( tag['name'] )
+        return ans
+
+    def tag2keys(self, name, graceid=None):
+        '''
+        return the set of (graceid, N) for log messages currently tagged with name, only considering graceid's log messages if it is not None
+        '''
+        ans = set()
+        for graceid in (self.graceids() if graceid is None else [graceid]):
+            ans.update( (graceid, N) for N, names in self.logTags(graceid).items() if name in names )
+        return ans
+
+    @staticmethod
+    def inWaveband(band, waveband):
+        '''
+        whether band is waveband or a narrower waveband within it (eg: "em.radio.3-6GHz" is within "em.radio")
+        '''
+        return (band==waveband) or band.startswith(waveband+'.')
+
+    def eel2keys(self, group=None, waveband=None, start=None, stop=None):
+        '''
+        return (graceid, N) for the EELs from group in waveband (or any narrower waveband) created between start and stop, oldest first.
+        any of these may be None (no constraint)
+        '''
+        ans = []
+        for graceid in self.graceids():
+            for eel in self.extract(graceid, 'eels'):
+                if ((group is None) or (eel['group']==group)) \
+                  and ((waveband is None) or self.inWaveband(eel['waveband'], waveband)) \
+                  and ((start is None) or (start <= eel['created'])) \
+                  and ((stop is None) or (eel['created'] <= stop)):
+                    ans.append( (eel['created'], graceid, eel['N']) )
+        return [(graceid, N) for _, graceid, N in sorted(ans)]
+
+    ### removing events (see ligoTest.gracedb.retention)
+
+    def __trashDir__(self):
+        return os.path.join(self.service_url, 'trash')
+
+    def remove(self, graceids):
+        '''
+        remove these events along with everything that refers to them (indexes, counters, uploaded files).
+        before we touch anything, we record what we are about to remove in a journal within trash/ so that finishRemovals can complete a removal interrupted by a crash.
+        only one process may remove events at a time (see ligoTest.gracedb.retention)
+        '''
+        graceids = [graceid for graceid in graceids if self.exists(graceid)]
+        if not graceids:
+            return
+        trash = self.__trashDir__()
+        if not os.path.exists(trash):
+            os.makedirs(trash)
+        batch = tempfile.mkdtemp(dir=trash)
+        entries = [self.__removal__(graceid) for graceid in graceids]
+
+        tmp = batch+'.tmp'
+        file_obj = open(tmp, 'w')
+        json.dump(entries, file_obj)
+        file_obj.close()
+        self.durability.sync(tmp)
+        os.rename(tmp, batch+'.json')
+        self.durability.sync(trash) ### the journal must be on disk before we touch anything it describes
+
+        self.__remove__(batch, entries)
+
+    def finishRemovals(self):
+        '''
+        complete every removal that was interrupted by a crash
+        '''
+        trash = self.__trashDir__()
+        if not os.path.exists(trash):
+            return
+        for name in sorted(os.listdir(trash)):
+            if name.endswith('.json'):
+                path = os.path.join(trash, name)
+                file_obj = open(path, 'r')
+                entries = json.load(file_obj)
+                file_obj.close()
+                self.__remove__(path[:-5], entries)
+
+        for name in os.listdir(trash): ### whatever is left was never recorded in a journal, so nothing was moved into it
+            path = os.path.join(trash, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def __removal__(self, graceid):
+        '''
+        what __remove__ needs to know about graceid, which must survive being written as JSON
+        '''
+        return {'graceid':graceid}
+
+    def __remove__(self, batch, entries):
+        '''
+        remove the events described by entries (see __removal__). This must be safe to repeat after a crash, and finishes by deleting batch and its journal
+        '''
+        raise NotImplementedError
+
+    def __discard__(self, batch):
+        '''
+        delete a batch directory and its journal once the removal they describe is complete
+        '''
+        if os.path.exists(batch):
+            shutil.rmtree(batch)
+        os.remove(batch+'.json')
+        self.durability.sync(self.__trashDir__())
+
+    def size(self, graceid):
+        '''
+        roughly how many bytes removing graceid would free: everything within its directory except uploaded files that other events share (see ligoTest.gracedb.blobs)
+        '''
+        ans = 0
+        for dirpath, _, filenames in os.walk(self.directory(graceid)):
+            for filename in filenames:
+                stat = os.lstat(os.path.join(dirpath, filename))
+                if stat.st_nlink <= 2: ### otherwise other events still link to the same blob
+                    ans += stat.st_size
+        return ans
+
+    def reclaimable(self):
+        '''
+        the number of bytes we hold on disk that no longer store anything and will be reused by later writes
+        '''
+        return 0
+
+    def compact(self, threshold=0.5):
+        '''
+        shrink whatever we keep alongside events (eg: indexes) once at least threshold of it describes removed events.
+        returns the number of bytes freed
+        '''
+        return 0
+
+#-------------------------------------------------
+
+class PickleStorage(Storage):
+    '''
+    stores each event as a directory containing pickle files for the top-level data and each collection.
+    appending to a collection rewrites the entire pickle file.
+
+    we also maintain secondary indexes (label -> graceids and a sorted array of gpstimes) within an "index" directory.
+    these are updated as labels and top-level data are written, so queries do not have to visit every event.
+    the same directory holds a graceid -> node map so that sending lvalert messages never requires reading an event.
+
+    before extend touches anything, it records what it is about to do in a write journal within the event's directory (.intent) and removes it once it is done.
+    if a writer dies part way through, the next writer for that event finds the journal, rolls each collection back to its previous length and applies the updates again.
+    '''
+    name = 'pickle'
+    suffix = 'pkl'
+
+    def __init__(self, directory, **kwargs):
+        super(PickleStorage, self).__init__(directory, **kwargs)
+        self.indexDir = os.path.join(directory, 'index')
+        self.labelIndex = LabelIndex(os.path.join(self.indexDir, 'labels'))
+        self.gpsIndex = GPSIndex(os.path.join(self.indexDir, 'gpstimes'))
+        self.nodeIndex = NodeIndex(os.path.join(self.indexDir, 'nodes'))
+        self.attributeIndex = AttributeIndex(os.path.join(self.indexDir, 'attributes'), self.sortKeys[1:], self.sortValue, partitionKeys=self.valueKeys)
+        self.eelIndex = EELIndex(os.path.join(self.indexDir, 'eels'))
+        self.tagIndex = TagIndex(os.path.join(self.indexDir, 'tags'))
+        self.counters = Counters(os.path.join(self.indexDir, 'counts'))
+        self.__indexed__ = False
+
+    def __indexes__(self):
+        '''
+        make sure the index directory exists before we touch it.
+        if it does not, we build it from whatever events already exist (eg: directories populated before we kept indexes).
+        the index is built in a temporary directory and moved into place so other processes never see a partial index.
+        '''
+        if self.__indexed__:
+            return
+        if not os.path.exists(self.indexDir):
+            tmpDir = tempfile.mkdtemp(dir=self.service_url)
+            labelIndex = LabelIndex(os.path.join(tmpDir, 'labels'))
+            gpsIndex = GPSIndex(os.path.join(tmpDir, 'gpstimes'))
+            eelIndex = EELIndex(os.path.join(tmpDir, 'eels'))
+            open(labelIndex.path, 'w').close()
+            open(gpsIndex.path, 'w').close()
+
+            for graceid in self.graceids():
+                if not os.path.exists(self.path(graceid, 'toplevel')): ### still being created, so it will index itself
+                    continue
+                gpstime = self.read(graceid).get('gpstime')
+                if gpstime is not None:
+                    gpsIndex.add( [gpstime, graceid] )
+                for label in self.extract(graceid, 'labels'):
+                    labelIndex.add( [graceid, label['name']] )
+                eels = self.extract(graceid, 'eels')
+                if eels:
+                    eelIndex.extend( self.__eelRecords__(graceid, eels) )
+            self.__backfillAttributes__(os.path.join(tmpDir, 'attributes'))
+            self.__backfillTags__(os.path.join(tmpDir, 'tags'))
+
+            try:
+                os.rename(tmpDir, self.indexDir)
+            except OSError: ### another process built the index first, so we use theirs
+                shutil.rmtree(tmpDir)
+
+        else: ### the index directory may pre-date some of our indexes
+            for path, backfill in [(self.attributeIndex.path, self.__backfillAttributes__), (self.tagIndex.path, self.__backfillTags__)]:
+                if not os.path.exists(path):
+                    fd, tmp = tempfile.mkstemp(dir=self.indexDir, prefix='.tmp')
+                    os.close(fd)
+                    backfill(tmp)
+                    try:
+                        os.link(tmp, path) ### fails if another process beat us to it, in which case we use theirs
+                    except OSError:
+                        pass
+                    os.remove(tmp)
+
+        if not os.path.exists(self.counters.path): ### index directory pre-dates counters, so we count what the indexes already know
+            counts = dict()
+            for graceid in self.iterGraceids():
+                attributes = self.attributeIndex.attributes(graceid)
+                if attributes is not None: ### otherwise still being created, so it will count itself
+                    for key in self.__countKeys__(attributes):
+                        counts[key] = counts.get(key, 0) + 1
+            self.labelIndex.refresh()
+            for label, graceids in self.labelIndex.label2graceids.items():
+                counts[self.__countKey__('label', label)] = len(graceids)
+            self.counters.publish(counts)
+
+        self.__indexed__ = True
+
+    def __backfillAttributes__(self, path):
+        '''
+        write attribute index records for every existing event into path
+        '''
+        attributeIndex = AttributeIndex(path, [], self.sortValue)
+        open(path, 'w').close()
+        records = []
+        for graceid in self.iterGraceids():
+            if os.path.exists(self.path(graceid, 'toplevel')): ### otherwise still being created, so it will index itself
+                records.append( [graceid, self.__attributes__(self.read(graceid))] )
+        if records:
+            attributeIndex.extend( records )
+
+    def __backfillTags__(self, path):
+        '''
+        write tag index records for every existing event into path
+        '''
+        tagIndex = TagIndex(path)
+        open(path, 'w').close()
+        records = []
+        for graceid in self.iterGraceids():
+            if os.path.exists(self.path(graceid, 'toplevel')): ### otherwise still being created, so it will index itself
+                records += [[graceid, N, name, True] for N, names in self.logTags(graceid).items() for name in names]
+        if records:
+            tagIndex.extend( records )
+
+    def path(self, graceid, kind):
+        if kind=='toplevel':
+            return os.path.join(self.directory(graceid), 'toplevel.pkl')
+        return os.path.join(self.directory(graceid), '%s.%s'%(kind, self.suffix))
+
+    def __intentPath__(self, graceid):
+        return os.path.join(self.directory(graceid), '.intent')
+
+    def __sync__(self, graceid, paths, indexes=False):
+        '''
+        force paths, the event's directory (which records any renames) and, if indexes, the index files onto disk
+        '''
+        if not self.durability.enabled:
+            return
+        paths = paths + [self.directory(graceid)]
+        if indexes:
+            paths += [self.labelIndex.path, self.gpsIndex.path, self.attributeIndex.path, self.eelIndex.path, self.tagIndex.path, self.counters.path, self.indexDir]
+        self.durability.sync(*paths)
+
+    def exists(self, graceid):
+        return os.path.exists(self.directory(graceid))
+
+    def create(self, graceid):
+        d = self.directory(graceid)
+        if os.path.exists(d):
+            raise ValueError('graceid=%s already exists!'%graceid)
+        os.makedirs(d) ### make directory
+
+        ### touch a bunch of files to make sure they exist
+        for kind in self.collections:
+            self.__create__(self.path(graceid, kind))
+
+        if self.durability.enabled: ### the new directory (and any new shards) must be recorded in their parents
+            parents = []
+            while d!=self.service_url:
+                d = os.path.dirname(d)
+                parents.append( d )
+            self.__sync__(graceid, [self.path(graceid, kind) for kind in self.collections]+parents)
+
+    def write(self, graceid, toplevel):
+        self.__indexes__() ### before we write, so bootstrapping the indexes never counts this event on top of what we add below
+        self.__write__(toplevel, self.path(graceid, 'toplevel'))
+
+        gpstime = toplevel.get('gpstime')
+        if gpstime is not None:
+            self.gpsIndex.add( [gpstime, graceid] )
+        with self.counters.lock(): ### so removals can recount events without racing other writers
+            self.attributeIndex.add( [graceid, self.__attributes__(toplevel)] )
+            self.counters.increment( dict((key, 1) for key in self.__countKeys__(toplevel)) )
+        self.__sync__(graceid, [self.path(graceid, 'toplevel')], indexes=True)
+
+    def read(self, graceid):
+        return self.__extract__(self.path(graceid, 'toplevel'))
+
+    def append(self, graceid, kind, record):
+        return self.extend(graceid, [(kind, [record])])[0]
+
+    def extend(self, graceid, updates):
+        ans = []
+        with self.lock(graceid): ### make sure no other writer modifies these files between when we read and write them
+            self.__recover__(graceid) ### finish whatever a writer that died while holding this lock left behind
+            for kind, _ in updates:
+                if (kind in self.optionalCollections) and (not os.path.exists(self.path(graceid, kind))):
+                    self.__create__(self.path(graceid, kind))
+            self.__intend__(graceid, [(kind, self.length(graceid, kind), records) for kind, records in updates])
+
+            indexed = False
+            for kind, records in updates:
+                if (kind=='labels') and records: ### we count each label once per event, so we need to know which labels were already applied
+                    existing = set(record['name'] for record in self.extract(graceid, 'labels'))
+
+                ans.append( self.__extend__(records, self.path(graceid, kind)) ) ### a single read-modify-write per collection
+
+                if (kind=='labels') and records:
+                    self.__indexes__()
+                    with self.counters.lock(): ### so __recover__ can recount labels without racing other writers
+                        self.labelIndex.extend( [[graceid, record['name']] for record in records] )
+                        new = set(record['name'] for record in records).difference(existing)
+                        if new:
+                            self.counters.increment( dict((self.__countKey__('label', label), 1) for label in new) )
+                    indexed = True
+
+                if (kind=='eels') and records:
+                    self.__indexes__()
+                    self.eelIndex.extend( self.__eelRecords__(graceid, records) )
+                    indexed = True
+
+                tags = self.__tagRecords__(graceid, kind, records)
+                if tags:
+                    self.__indexes__()
+                    self.tagIndex.extend( tags )
+                    indexed = True
+
+            self.__sync__(graceid, [self.path(graceid, kind) for kind, _ in updates], indexes=indexed)
+            os.remove(self.__intentPath__(graceid)) ### everything is in place, so there is nothing left to recover
+
+        return ans
+
+    def __intend__(self, graceid, updates):
+        '''
+        record updates, a list of (kind, number of records before the update, new records), in the write journal for graceid.
+        callers must hold the lock for graceid
+        '''
+        path = self.__intentPath__(graceid)
+        file_obj = open(path, 'w')
+        json.dump(updates, file_obj)
+        file_obj.close()
+        self.__sync__(graceid, [path]) ### the journal must be on disk before we touch anything it describes
+
+    def __recover__(self, graceid):
+        '''
+        if a writer died part way through extend, roll each collection it was updating back to its previous length and apply its updates again.
+        label counters are recomputed from the label index. Callers must hold the lock for graceid
+        '''
+        path = self.__intentPath__(graceid)
+        if not os.path.exists(path):
+            return
+
+        try:
+            file_obj = open(path, 'r')
+            updates = json.load(file_obj)
+            file_obj.close()
+        except ValueError: ### the writer died while writing the journal, before it touched anything else
+            updates = []
+
+        labels = set()
+        eels = []
+        tags = []
+        for kind, N, records in updates:
+            if (kind in self.optionalCollections) and (not os.path.exists(self.path(graceid, kind))): ### eg: a crash lost the file we created before the journal
+                self.__create__(self.path(graceid, kind))
+            self.__truncate__(self.path(graceid, kind), N)
+            self.__extend__(records, self.path(graceid, kind))
+            if kind=='labels':
+                labels.update( record['name'] for record in records )
+            elif kind=='eels':
+                eels += records
+            tags += self.__tagRecords__(graceid, kind, records)
+
+        if eels: ### the index ignores EELs it already knows about
+            self.__indexes__()
+            self.eelIndex.extend( self.__eelRecords__(graceid, eels) )
+
+        if tags: ### these were the last changes to these log messages' tags, so applying them again leaves the index as it should be
+            self.__indexes__()
+            self.tagIndex.extend( tags )
+
+        if labels:
+            self.__indexes__()
+            with self.counters.lock():
+                missing = [[graceid, label] for label in labels if graceid not in self.labelIndex.graceids(label)]
+                if missing:
+                    self.labelIndex.extend( missing )
+                self.counters.assign( dict((self.__countKey__('label', label), self.labelIndex.size(label)) for label in labels) )
+
+        self.__sync__(graceid, [self.path(graceid, kind) for kind, _, _ in updates], indexes=bool(labels or eels or tags))
+        os.remove(path)
+
+    def extract(self, graceid, kind):
+        path = self.path(graceid, kind)
+        if (kind in self.optionalCollections) and (not os.path.exists(path)): ### never written
+            return []
+        return self.__extract__(path)
+
+    def length(self, graceid, kind):
+        if os.path.exists(self.__intentPath__(graceid)): ### writers number new records from this, so finish whatever a writer that died left behind first
+            with self.lock(graceid):
+                self.__recover__(graceid)
+        path = self.path(graceid, kind)
+        if (kind in self.optionalCollections) and (not os.path.exists(path)):
+            return 0
+        return self.__path2len__(path)
+
+    def replace(self, graceid, kind, stuff):
+        path = self.path(graceid, kind)
+        if kind=='toplevel':
+            self.__write__(stuff, path) ### top-level data is always pickled
+        else:
+            self.__fill__(stuff, path)
+
+    def load(self, events):
+        '''
+        files are written directly, without the write journal (.intent), since no one else touches reserved graceids until they are loaded.
+        each event's top-level data is written last, so until then readers treat it as still being created. We then append to each index
+        and update the counters once for the whole batch, and sync everything (when durability asks us to) once at the end.
+        '''
+        self.__indexes__() ### before we write, so bootstrapping the indexes never counts these events on top of what we add below
+        paths = []
+        directories = set()
+        gpstimes = []
+        attributes = []
+        nodes = []
+        labels = []
+        eels = []
+        tags = []
+        counts = dict()
+        for graceid, toplevel, updates, node in events:
+            d = self.directory(graceid)
+            if not os.path.exists(d): ### it may already hold uploaded files
+                os.makedirs(d)
+            while d!=self.service_url: ### the new directory (and any new shards) must be recorded in their parents
+                directories.add( d )
+                d = os.path.dirname(d)
+
+            updates = dict(updates)
+            for kind in self.collections + [kind for kind in self.optionalCollections if updates.get(kind)]:
+                records = updates.get(kind, [])
+                path = self.path(graceid, kind)
+                self.__fill__(records, path)
+                paths.append( path )
+                tags += self.__tagRecords__(graceid, kind, records)
+            self.__write__(toplevel, self.path(graceid, 'toplevel'))
+            paths.append( self.path(graceid, 'toplevel') )
+
+            gpstime = toplevel.get('gpstime')
+            if gpstime is not None:
+                gpstimes.append( [gpstime, graceid] )
+            attributes.append( [graceid, self.__attributes__(toplevel)] )
+            nodes.append( [graceid, node] )
+            eels += self.__eelRecords__(graceid, updates.get('eels', []))
+
+            names = set(record['name'] for record in updates.get('labels', []))
+            labels += [[graceid, name] for name in sorted(names)]
+            for key in self.__countKeys__(toplevel) + [self.__countKey__('label', name) for name in names]:
+                counts[key] = counts.get(key, 0) + 1
+
+        if gpstimes:
+            self.gpsIndex.extend( gpstimes )
+        if nodes:
+            self.nodeIndex.extend( nodes )
+        if eels:
+            self.eelIndex.extend( eels )
+        if tags:
+            self.tagIndex.extend( tags )
+        with self.counters.lock(): ### so removals can recount events without racing us
+            if attributes:
+                self.attributeIndex.extend( attributes )
+            if labels:
+                self.labelIndex.extend( labels )
+            if counts:
+                self.counters.increment( counts )
+
+        if self.durability.enabled:
+            self.durability.sync(*(paths + sorted(directories, reverse=True) + [self.service_url, self.labelIndex.path, self.gpsIndex.path, self.nodeIndex.path, self.attributeIndex.path, self.eelIndex.path, self.tagIndex.path, self.counters.path, self.indexDir]))
+
+    def setNode(self, graceid, node):
+        self.__indexes__()
+        self.nodeIndex.add( [graceid, node] )
+        self.durability.sync(self.nodeIndex.path)
+
+    def node(self, graceid):
+        self.__indexes__()
+        return self.nodeIndex.node(graceid)
+
+    def label2graceids(self, label):
+        self.__indexes__()
+        return self.labelIndex.graceids(label)
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        self.__indexes__()
+        return self.gpsIndex.graceids(gpsstart, gpsstop)
+
+    @staticmethod
+    def __eelRecords__(graceid, eels):
+        return [[eel['created'], graceid, eel['N'], eel['group'], eel['waveband']] for eel in eels]
+
+    def eel2keys(self, group=None, waveband=None, start=None, stop=None):
+        self.__indexes__()
+        return self.eelIndex.find(group=group, waveband=waveband, start=start, stop=stop)
+
+    @classmethod
+    def __tagRecords__(cls, graceid, kind, records):
+        '''
+        tag index records for records added to collection kind: the tags log messages are written with and every tag created or deleted afterwards
+        '''
+        if kind=='logs':
+            return [[graceid, log['N'], name, True] for log in records for name in cls.tagNames(log)]
+        if kind=='tags':
+            return [[graceid, tag['log_N'], tag['name'], tag['applied']] for tag in records]
+        return []
+
+    def tag2keys(self, name, graceid=None):
+        if graceid is not None: ### a single event's tags are cheaper to work out from its own collections
+            return super(PickleStorage, self).tag2keys(name, graceid=graceid)
+        self.__indexes__()
+        return self.tagIndex.keys(name)
+
+    def attributes(self, graceid):
+        self.__indexes__()
+        ans = self.attributeIndex.attributes(graceid)
+        if ans is None: ### not indexed yet (eg: still being created), so we read it
+            ans = super(PickleStorage, self).attributes(graceid)
+        return ans
+
+    def ordered(self, key, reverse=False):
+        if key=='graceid':
+            if (self.layout=='sharded') and (not reverse): ### shards are already walked in order
+                return self.iterGraceids()
+            return iter(sorted(self.iterGraceids(), reverse=reverse))
+        self.__indexes__()
+        return self.attributeIndex.ordered(key, reverse=reverse)
+
+    def labelSize(self, label):
+        self.__indexes__()
+        return self.labelIndex.size(label)
+
+    def range2graceids(self, key, start=None, stop=None):
+        self.__indexes__()
+        return self.attributeIndex.range(key, start=start, stop=stop)
+
+    def rangeSize(self, key, start=None, stop=None):
+        self.__indexes__()
+        return self.attributeIndex.rangeSize(key, start=start, stop=stop)
+
+    def value2graceids(self, key, value):
+        self.__indexes__()
+        return self.attributeIndex.partition(key, value)
+
+    def valueSize(self, key, value):
+        self.__indexes__()
+        return self.attributeIndex.partitionSize(key, value)
+
+    def count(self, kind=None, value=None):
+        self.__indexes__()
+        return self.counters.get(self.__countKey__(kind, value))
+
+    def __removal__(self, graceid):
+        self.__indexes__()
+        ans = super(PickleStorage, self).__removal__(graceid)
+        ans['attributes'] = self.attributes(graceid) if os.path.exists(self.path(graceid, 'toplevel')) else None ### None if it was never counted
+        ans['labels'] = sorted(set(label['name'] for label in self.extract(graceid, 'labels')))
+        return ans
+
+    def __remove__(self, batch, entries):
+        '''
+        move each event's directory into batch (waiting for anyone writing to it), forget it within every index and recount what it was counted in.
+        writers that come after us find no directory and fail, as they would for any unknown graceid
+        '''
+        parents = set()
+        for entry in entries:
+            graceid = entry['graceid']
+            directory = self.directory(graceid)
+            if os.path.exists(directory):
+                with self.lock(graceid):
+                    os.rename(directory, os.path.join(batch, graceid))
+                parents.add( os.path.dirname(directory) )
+        if self.durability.enabled:
+            self.durability.sync(batch, *parents)
+
+        self.__forget__(entries)
+        self.__discard__(batch)
+
+    def __forget__(self, entries):
+        '''
+        tombstone these events within every index and recompute the counters they contributed to from the indexes.
+        recomputing (rather than decrementing) means doing this twice leaves the same counts
+        '''
+        self.__indexes__()
+        graceids = [entry['graceid'] for entry in entries]
+        with self.counters.lock():
+            for index in [self.labelIndex, self.gpsIndex, self.nodeIndex, self.attributeIndex, self.eelIndex, self.tagIndex]:
+                index.remove( graceids )
+
+            counts = dict()
+            for entry in entries:
+                if entry['attributes'] is not None:
+                    for key in self.valueKeys:
+                        value = entry['attributes'].get(key)
+                        if value is not None:
+                            counts[self.__countKey__(key, value)] = self.attributeIndex.partitionSize(key, value)
+                for label in entry['labels']:
+                    counts[self.__countKey__('label', label)] = self.labelIndex.size(label)
+            self.attributeIndex.refresh() ### len does not read the tombstones on its own
+            counts[self.__countKey__()] = len(self.attributeIndex)
+            self.counters.assign( counts )
+
+        if self.durability.enabled:
+            self.durability.sync(self.labelIndex.path, self.gpsIndex.path, self.nodeIndex.path, self.attributeIndex.path, self.eelIndex.path, self.tagIndex.path, self.counters.path, self.indexDir)
+
+    def compact(self, threshold=0.5):
+        self.__indexes__()
+        sync = self.durability.sync if self.durability.enabled else None
+        return sum(index.compact(threshold=threshold, sync=sync) for index in [self.labelIndex, self.gpsIndex, self.nodeIndex, self.attributeIndex, self.eelIndex, self.tagIndex])
+
+    ### manipulations of individual files
+
+    def __create__(self, path):
+        self.__write__([], path)
+
+    def __fill__(self, stuff, path):
+        '''overwrite pkl file so it holds exactly stuff'''
+        self.__write__(stuff, path)
+
+    def __path2len__(self, path):
+        return len(self.__extract__(path))
+
+    def __extend__(self, stuff, path):
+        '''append several things to pkl file, returning the index of the first one'''
+        ans = self.__extract__(path)
+        N = len(ans)
+        ans += stuff
+        self.__write__(ans, path)
+
+        return N
+
+    def __truncate__(self, path, N):
+        '''keep only the first N things in pkl file'''
+        self.__write__(self.__extract__(path)[:N], path)
+
+    def __write__(self, stuff, path):
+        '''write stuff into a temporary file and rename it over pkl file, so readers (and crashes) never see a partial file'''
+        tmp = path+'.tmp' ### writers of each file are serialized by the event's lock
+        file_obj = open(tmp, 'wb')
+        if self.stats is None:
+            pickle.dump(stuff, file_obj, PICKLE_PROTOCOL)
+        else:
+            t0 = time.time()
+            pickle.dump(stuff, file_obj, PICKLE_PROTOCOL)
+            self.stats.serialization('pickle', time.time()-t0)
+            self.stats.write(file_obj.tell())
+        file_obj.close()
+        self.durability.sync(tmp) ### otherwise the rename could reach the disk before the data does
+        os.rename(tmp, path)
+
+        if self.cache is not None: ### we already know what's in the file, so there's no need to read it back
+            self.__cache__(path, stuff)
+
+    def __stamp__(self, path):
+        '''
+        (mtime, size) identifies the version of path we've cached
+        '''
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size)
+
+    def __cache__(self, path, stuff):
+        stamp = self.__stamp__(path)
+        self.cache.put(path, stamp, stuff)
+
+    def __extract__(self, path):
+        '''read from cache if the file has not changed since we last read it. Otherwise, read from disk'''
+        if self.cache is None:
+            return self.__load__(path)
+
+        stamp = self.__stamp__(path)
+        ans = self.cache.get(path, stamp)
+        if ans is None:
+            ans = self.__load__(path)
+            self.cache.put(path, stamp, ans)
+
+        return ans
+
+    def __load__(self, path):
+        '''read from pkl file'''
+        file_obj = open(path, 'rb')
+        if self.stats is None:
+            ans = pickle.load(file_obj)
+        else:
+            t0 = time.time()
+            ans = pickle.load(file_obj)
+            self.stats.serialization('pickle', time.time()-t0)
+            self.stats.read(file_obj.tell())
+        file_obj.close()
+
+        return ans
+
+class JournalStorage(PickleStorage):
+    '''
+    like PickleStorage, but collections are append-only journals of JSON records (see ligoTest.gracedb.journal).
+    appending a record and counting records do not depend on how many records already exist.
+    '''
+    name = 'journal'
+    suffix = 'jsonl'
+
+    def __create__(self, path):
+        Journal(path).create()
+
+    def __fill__(self, stuff, path):
+        Journal(path, stats=self.stats).create(stuff)
+
+    def __path2len__(self, path):
+        return len(Journal(path)) ### the journal caches the number of records in its header
+
+    def __extend__(self, stuff, path):
+        return Journal(path, stats=self.stats).extend(stuff)
+
+    def __truncate__(self, path, N):
+        Journal(path).truncate(N)
+
+    def __load__(self, path):
+        if path.endswith('.'+self.suffix):
+            return Journal(path, stats=self.stats).extract()
+        return super(JournalStorage, self).__load__(path) ### top-level data is still pickled
+
+#-------------------------------------------------
+
+class SQLiteStorage(Storage):
+    '''
+    stores all events in a single SQLite database with indexed tables for events, logs, labels and files.
+    the database runs in WAL mode so that many reader processes can query it while another process writes.
+
+    cached data is validated with a generation counter: SQLite's data_version (which changes whenever another connection commits)
+    along with the number of writes made through this connection.
+
+    SQLite keeps its own journal, so durability only sets how often it syncs (PRAGMA synchronous). With "group", transactions are synced
+    when the WAL is checkpointed, so a crash of the machine can lose the most recent ones but never corrupts the database.
+    '''
+    name = 'sqlite'
+    filename = 'fakedb.sqlite'
+
+    attributeKeys = ['graceid', 'group', 'pipeline', 'search', 'gpstime', 'created'] ### copied verbatim into their own columns
+    __columns__ = {'graceid':'graceid', 'group':'grp', 'pipeline':'pipeline', 'search':'search', 'gpstime':'gpstime', 'far':'far', 'created':'created'}
+
+    __schema__ = [
+        "CREATE TABLE IF NOT EXISTS events (graceid TEXT PRIMARY KEY, grp TEXT, pipeline TEXT, search TEXT, gpstime REAL, far REAL, created REAL, toplevel TEXT)",
+        "CREATE INDEX IF NOT EXISTS events_gpstime ON events (gpstime)",
+        "CREATE INDEX IF NOT EXISTS events_far ON events (far)",
+        "CREATE INDEX IF NOT EXISTS events_created ON events (created)",
+        "CREATE INDEX IF NOT EXISTS events_grp ON events (grp)",
+        "CREATE INDEX IF NOT EXISTS events_pipeline ON events (pipeline)",
+        "CREATE INDEX IF NOT EXISTS events_search ON events (search)",
+        "CREATE TABLE IF NOT EXISTS logs (graceid TEXT, N INTEGER, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE TABLE IF NOT EXISTS labels (graceid TEXT, N INTEGER, name TEXT, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE INDEX IF NOT EXISTS labels_name ON labels (name, graceid)",
+        "CREATE TABLE IF NOT EXISTS files (graceid TEXT, N INTEGER, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE TABLE IF NOT EXISTS emobservations (graceid TEXT, N INTEGER, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE TABLE IF NOT EXISTS tags (graceid TEXT, N INTEGER, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE TABLE IF NOT EXISTS tagged (name TEXT, graceid TEXT, N INTEGER, PRIMARY KEY (name, graceid, N))",
+        "CREATE TABLE IF NOT EXISTS voevents (graceid TEXT, N INTEGER, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE TABLE IF NOT EXISTS eels (graceid TEXT, N INTEGER, grp TEXT, waveband TEXT, created REAL, record TEXT, PRIMARY KEY (graceid, N))",
+        "CREATE INDEX IF NOT EXISTS eels_grp ON eels (grp, created)",
+        "CREATE INDEX IF NOT EXISTS eels_waveband ON eels (waveband, created)",
+        "CREATE INDEX IF NOT EXISTS eels_created ON eels (created)",
+        "CREATE TABLE IF NOT EXISTS counters (letter TEXT PRIMARY KEY, next INTEGER)",
+        "CREATE TABLE IF NOT EXISTS nodes (graceid TEXT PRIMARY KEY, node TEXT)",
+        "CREATE TABLE IF NOT EXISTS counts (key TEXT PRIMARY KEY, n INTEGER)",
+    ]
+
+    __synchronous__ = {'none':'OFF', 'fsync':'FULL', 'group':'NORMAL'} ### durability -> PRAGMA synchronous
+
+    def __init__(self, directory, **kwargs):
+        super(SQLiteStorage, self).__init__(directory, **kwargs)
+        self.database = os.path.join(directory, self.filename)
+
+        ### isolation_level=None means we manage transactions ourselves
+        ### check_same_thread=False lets an instance move between threads (eg: ligoTest.gracedb.aio's executor), but callers must never use it from two threads at once
+        self.conn = sqlite3.connect(self.database, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=%s"%self.__synchronous__[self.durability.name])
+        tagged = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tagged'").fetchone() is not None
+        for statement in self.__schema__:
+            self.conn.execute(statement)
+
+        self.generation = 0 ### the number of writes made through self.conn
+        self.graceid2node = dict() ### nodes never change, so we remember every one we look up
+
+        if self.conn.execute("SELECT COUNT(*) FROM counts").fetchone()[0]==0: ### database pre-dates counters (or is new)
+            self.__initCounts__()
+        if not tagged: ### database pre-dates the tagged table (or is new)
+            self.__initTagged__()
+
+    def __initTagged__(self):
+        '''
+        record the tags log messages were written with. Until the first tag is created or deleted, these are the only tags there are
+        '''
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.conn.execute("SELECT COUNT(*) FROM tags").fetchone()[0]==0: ### otherwise someone else already did this
+                for graceid, record in self.conn.execute("SELECT graceid, record FROM logs").fetchall():
+                    log = json.loads(record)
+                    self.conn.executemany("INSERT OR IGNORE INTO tagged (name, graceid, N) VALUES (?, ?, ?)", [(name, graceid, log['N']) for name in self.tagNames(log)])
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def __initCounts__(self):
+        '''
+        count what is already in the database. Even an empty database gets a "total" counter, so we only ever do this once
+        '''
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.conn.execute("SELECT COUNT(*) FROM counts").fetchone()[0]==0: ### no one beat us to it
+                counts = [(self.__countKey__(), self.conn.execute("SELECT COUNT(*) FROM events WHERE toplevel IS NOT NULL").fetchone()[0])]
+                for key in self.valueKeys:
+                    column = self.__columns__[key]
+                    counts += [(self.__countKey__(key, value), n) for value, n in self.conn.execute("SELECT %s, COUNT(*) FROM events WHERE toplevel IS NOT NULL AND %s IS NOT NULL GROUP BY %s"%(column, column, column))]
+                counts += [(self.__countKey__('label', name), n) for name, n in self.conn.execute("SELECT name, COUNT(DISTINCT graceid) FROM labels GROUP BY name")]
+                self.conn.executemany("INSERT INTO counts (key, n) VALUES (?, ?)", counts)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def __increment__(self, keys, delta=1):
+        '''
+        add delta to each of these counters. Callers manage the transaction
+        '''
+        self.conn.executemany("INSERT OR IGNORE INTO counts (key, n) VALUES (?, 0)", [(key,) for key in keys])
+        self.conn.executemany("UPDATE counts SET n=n+? WHERE key=?", [(delta, key) for key in keys])
+
+    def __stamp__(self):
+        return (self.conn.execute("PRAGMA data_version").fetchone()[0], self.generation)
+
+    def __cached__(self, key, query, *args):
+        '''
+        return the decoded rows produced by query, reading from the cache if nothing has been written since we last ran it
+        '''
+        if self.cache is None:
+            return self.__decode__([row[0] for row in self.conn.execute(query, args)])
+
+        stamp = self.__stamp__()
+        ans = self.cache.get(key, stamp)
+        if ans is None:
+            rows = [row[0] for row in self.conn.execute(query, args)]
+            ans = self.__decode__(rows)
+            self.cache.put(key, stamp, ans)
+
+        return ans
+
+    def __decode__(self, rows):
+        if self.stats is None:
+            return [json.loads(row) for row in rows]
+        t0 = time.time()
+        ans = [json.loads(row) for row in rows]
+        self.stats.serialization('json', time.time()-t0)
+        self.stats.read(sum(len(row) for row in rows))
+        return ans
+
+    def __encode__(self, records):
+        if self.stats is None:
+            return [json.dumps(record) for record in records]
+        t0 = time.time()
+        ans = [json.dumps(record) for record in records]
+        self.stats.serialization('json', time.time()-t0)
+        self.stats.write(sum(len(row) for row in ans))
+        return ans
+
+    def path(self, graceid, kind):
+        return "%s?graceid=%s&table=%s"%(self.database, graceid, 'events' if kind=='toplevel' else kind)
+
+    def exists(self, graceid):
+        return self.conn.execute("SELECT 1 FROM events WHERE graceid=?", (graceid,)).fetchone() is not None
+
+    def iterGraceids(self, letter=None):
+        if letter is None:
+            cursor = self.conn.execute("SELECT graceid FROM events ORDER BY graceid")
+        else:
+            cursor = self.conn.execute("SELECT graceid FROM events WHERE graceid LIKE ? ORDER BY graceid", (letter+'%',))
+        for row in cursor: ### rows are fetched as we go
+            yield row[0]
+
+    def create(self, graceid):
+        if self.exists(graceid):
+            raise ValueError('graceid=%s already exists!'%graceid)
+
+        d = self.directory(graceid)
+        if not os.path.exists(d): ### still need somewhere to put uploaded files
+            os.makedirs(d)
+        self.conn.execute("INSERT INTO events (graceid) VALUES (?)", (graceid,))
+        self.generation += 1
+
+    def write(self, graceid, toplevel):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("UPDATE events SET grp=?, pipeline=?, search=?, gpstime=?, far=?, created=?, toplevel=? WHERE graceid=?",
+                (toplevel.get('group'), toplevel.get('pipeline'), toplevel.get('search'), toplevel.get('gpstime'), toplevel.get('far', toplevel.get('FAR')), toplevel.get('created'), self.__encode__([toplevel])[0], graceid)
+            )
+            self.__increment__( self.__countKeys__(toplevel) )
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.generation += 1
+
+    def read(self, graceid):
+        return dict(self.__cached__(('toplevel', graceid), "SELECT toplevel FROM events WHERE graceid=?", graceid)[0])
+
+    def setNode(self, graceid, node):
+        self.conn.execute("INSERT OR REPLACE INTO nodes (graceid, node) VALUES (?, ?)", (graceid, node))
+        self.graceid2node[graceid] = node
+
+    def node(self, graceid):
+        if graceid not in self.graceid2node:
+            row = self.conn.execute("SELECT node FROM nodes WHERE graceid=?", (graceid,)).fetchone()
+            if row is None:
+                return None
+            self.graceid2node[graceid] = row[0]
+        return self.graceid2node[graceid]
+
+    def reserve(self, letter, num=1):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT next FROM counters WHERE letter=?", (letter,)).fetchone()
+            if row:
+                start = row[0]
+            else: ### bootstrap the counter from whatever is already there
+                start = self.__maxIndex__(letter)+1
+            self.conn.execute("INSERT OR REPLACE INTO counters (letter, next) VALUES (?, ?)", (letter, start+num))
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return start
+
+    def __table__(self, kind):
+        if (kind not in self.collections) and (kind not in self.optionalCollections):
+            raise ValueError('collection=%s not understood'%kind)
+        return kind
+
+    def append(self, graceid, kind, record):
+        return self.extend(graceid, [(kind, [record])])[0]
+
+    def extend(self, graceid, updates):
+        '''
+        all updates are applied within a single transaction
+        '''
+        ans = []
+        self.conn.execute("BEGIN IMMEDIATE") ### grab the write lock before counting so concurrent writers can't pick the same N
+        try:
+            for kind, records in updates:
+                table = self.__table__(kind)
+                N = self.conn.execute("SELECT COUNT(*) FROM %s WHERE graceid=?"%table, (graceid,)).fetchone()[0]
+                if table=='labels': ### we count each label once per event
+                    existing = set(row[0] for row in self.conn.execute("SELECT name FROM labels WHERE graceid=?", (graceid,)))
+                    self.__increment__( [self.__countKey__('label', label) for label in set(record['name'] for record in records).difference(existing)] )
+                self.__insert__(graceid, table, N, records)
+                ans.append(N)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.generation += 1
+
+        return ans
+
+    def __insert__(self, graceid, table, N, records):
+        '''
+        insert records into table starting at index N. Callers manage the transaction
+        '''
+        rows = self.__encode__(records)
+        if table=='labels':
+            self.conn.executemany("INSERT INTO labels (graceid, N, name, record) VALUES (?, ?, ?, ?)", [(graceid, N+i, record['name'], row) for i, (record, row) in enumerate(zip(records, rows))])
+        elif table=='eels':
+            self.conn.executemany("INSERT INTO eels (graceid, N, grp, waveband, created, record) VALUES (?, ?, ?, ?, ?, ?)", [(graceid, N+i, record['group'], record['waveband'], record['created'], row) for i, (record, row) in enumerate(zip(records, rows))])
+        else:
+            self.conn.executemany("INSERT INTO %s (graceid, N, record) VALUES (?, ?, ?)"%table, [(graceid, N+i, row) for i, row in enumerate(rows)])
+
+        ### keep the tagged table (tag name -> log messages) up to date
+        if table=='logs':
+            self.conn.executemany("INSERT OR IGNORE INTO tagged (name, graceid, N) VALUES (?, ?, ?)", [(name, graceid, log['N']) for log in records for name in self.tagNames(log)])
+        elif table=='tags':
+            for tag in records: ### order matters, so we apply these one at a time
+                if tag['applied']:
+                    self.conn.execute("INSERT OR IGNORE INTO tagged (name, graceid, N) VALUES (?, ?, ?)", (tag['name'], graceid, tag['log_N']))
+                else:
+                    self.conn.execute("DELETE FROM tagged WHERE name=? AND graceid=? AND N=?", (tag['name'], graceid, tag['log_N']))
+
+    def extract(self, graceid, kind):
+        return list(self.__cached__((kind, graceid), "SELECT record FROM %s WHERE graceid=? ORDER BY N"%self.__table__(kind), graceid))
+
+    def length(self, graceid, kind):
+        return self.conn.execute("SELECT COUNT(*) FROM %s WHERE graceid=?"%self.__table__(kind), (graceid,)).fetchone()[0]
+
+    def replace(self, graceid, kind, stuff):
+        if kind=='toplevel':
+            self.conn.execute("UPDATE events SET toplevel=? WHERE graceid=?", (self.__encode__([stuff])[0], graceid))
+        else:
+            table = self.__table__(kind)
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM %s WHERE graceid=?"%table, (graceid,))
+                self.__insert__(graceid, table, 0, stuff)
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        self.generation += 1
+
+    def load(self, events):
+        '''
+        every event is inserted (along with its records, node and counters) within a single transaction
+        '''
+        for graceid, _, _, _ in events:
+            d = self.directory(graceid)
+            if not os.path.exists(d): ### it may already hold uploaded files
+                os.makedirs(d)
+
+        keys = []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.__encode__([toplevel for _, toplevel, _, _ in events])
+            self.conn.executemany("INSERT INTO events (graceid, grp, pipeline, search, gpstime, far, created, toplevel) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(graceid, toplevel.get('group'), toplevel.get('pipeline'), toplevel.get('search'), toplevel.get('gpstime'), toplevel.get('far', toplevel.get('FAR')), toplevel.get('created'), row) for (graceid, toplevel, _, _), row in zip(events, rows)]
+            )
+            for graceid, toplevel, updates, _ in events:
+                for kind, records in updates:
+                    if records:
+                        self.__insert__(graceid, self.__table__(kind), 0, records)
+                        if kind=='labels': ### we count each label once per event
+                            keys += [self.__countKey__('label', name) for name in set(record['name'] for record in records)]
+                keys += self.__countKeys__(toplevel)
+            self.conn.executemany("INSERT OR REPLACE INTO nodes (graceid, node) VALUES (?, ?)", [(graceid, node) for graceid, _, _, node in events])
+
+            counts = dict()
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+            self.conn.executemany("INSERT OR IGNORE INTO counts (key, n) VALUES (?, 0)", [(key,) for key in counts])
+            self.conn.executemany("UPDATE counts SET n=n+? WHERE key=?", [(n, key) for key, n in counts.items()])
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.generation += 1
+
+        for graceid, _, _, node in events:
+            self.graceid2node[graceid] = node
+
+    def label2graceids(self, label):
+        return set(row[0] for row in self.conn.execute("SELECT DISTINCT graceid FROM labels WHERE name=?", (label,)))
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        return set(row[0] for row in self.conn.execute("SELECT graceid FROM events WHERE gpstime BETWEEN ? AND ?", (gpsstart, gpsstop)))
+
+    def tag2keys(self, name, graceid=None):
+        if graceid is None:
+            return set(self.conn.execute("SELECT graceid, N FROM tagged WHERE name=?", (name,)))
+        return set(self.conn.execute("SELECT graceid, N FROM tagged WHERE name=? AND graceid=?", (name, graceid)))
+
+    def eel2keys(self, group=None, waveband=None, start=None, stop=None):
+        where = []
+        args = []
+        if group is not None:
+            where.append( "grp=?" )
+            args.append( group )
+        if waveband is not None:
+            where.append( "(waveband=? OR substr(waveband, 1, ?)=?)" ) ### narrower wavebands extend the name (LIKE would treat "_" as a wildcard)
+            args += [waveband, len(waveband)+1, waveband+'.']
+        if start is not None:
+            where.append( "created >= ?" )
+            args.append( start )
+        if stop is not None:
+            where.append( "created <= ?" )
+            args.append( stop )
+        query = "SELECT graceid, N FROM eels"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        return [(graceid, N+1) for graceid, N in self.conn.execute(query+" ORDER BY created, graceid, N", args)] ### rows count from 0 while EELs count from 1
+
+    def attributes(self, graceid):
+        columns = [self.__columns__[key] for key in self.attributeKeys]
+        row = self.conn.execute("SELECT %s FROM events WHERE graceid=?"%(", ".join(columns)), (graceid,)).fetchone()
+        return dict((key, val) for key, val in zip(self.attributeKeys, row) if val is not None) ### absent from the top-level data if it is NULL
+
+    def sortValues(self, graceids, key):
+        column = self.__columns__[key]
+        graceids = list(graceids)
+        ans = dict()
+        for i in xrange(0, len(graceids), 500): ### stay well within SQLite's limit on the number of parameters
+            chunk = graceids[i:i+500]
+            ans.update( self.conn.execute("SELECT graceid, %s FROM events WHERE graceid IN (%s)"%(column, ", ".join("?"*len(chunk))), chunk) )
+        return ans
+
+    def queryAttributes(self, graceid):
+        keys = self.rangeKeys+self.valueKeys
+        row = self.conn.execute("SELECT %s FROM events WHERE graceid=?"%(", ".join(self.__columns__[key] for key in keys)), (graceid,)).fetchone()
+        return dict(zip(keys, row))
+
+    def labelSize(self, label):
+        return self.conn.execute("SELECT COUNT(DISTINCT graceid) FROM labels WHERE name=?", (label,)).fetchone()[0]
+
+    def __range__(self, select, key, start, stop):
+        column = self.__columns__[key]
+        where = ["%s IS NOT NULL"%column]
+        args = []
+        if start is not None:
+            where.append( "%s >= ?"%column )
+            args.append( start )
+        if stop is not None:
+            where.append( "%s <= ?"%column )
+            args.append( stop )
+        return self.conn.execute("SELECT %s FROM events WHERE %s"%(select, " AND ".join(where)), args)
+
+    def range2graceids(self, key, start=None, stop=None):
+        return set(row[0] for row in self.__range__("graceid", key, start, stop))
+
+    def rangeSize(self, key, start=None, stop=None):
+        return self.__range__("COUNT(*)", key, start, stop).fetchone()[0]
+
+    def value2graceids(self, key, value):
+        return set(row[0] for row in self.conn.execute("SELECT graceid FROM events WHERE %s=?"%self.__columns__[key], (value,)))
+
+    def valueSize(self, key, value):
+        return self.conn.execute("SELECT COUNT(*) FROM events WHERE %s=?"%self.__columns__[key], (value,)).fetchone()[0]
+
+    def count(self, kind=None, value=None):
+        row = self.conn.execute("SELECT n FROM counts WHERE key=?", (self.__countKey__(kind, value),)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def ordered(self, key, reverse=False):
+        if key not in self.sortKeys:
+            raise ValueError('cannot order events by %s'%key)
+        order = "DESC" if reverse else "ASC"
+        for row in self.conn.execute("SELECT graceid FROM events ORDER BY %s %s, graceid %s"%(self.__columns__[key], order, order)): ### rows are fetched as we go
+            yield row[0]
+
+    def __remove__(self, batch, entries):
+        '''
+        delete every row that refers to these events and decrement what they were counted in within a single transaction, then delete their directories.
+        events that are already gone are skipped, so doing this twice leaves the same counts
+        '''
+        tables = ['events', 'nodes', 'tagged'] + self.collections + self.optionalCollections
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for entry in entries:
+                graceid = entry['graceid']
+                row = self.conn.execute("SELECT toplevel FROM events WHERE graceid=?", (graceid,)).fetchone()
+                if row is None:
+                    continue
+                keys = [self.__countKey__('label', name) for (name,) in self.conn.execute("SELECT DISTINCT name FROM labels WHERE graceid=?", (graceid,))]
+                if row[0] is not None: ### otherwise it was never counted
+                    keys += self.__countKeys__(json.loads(row[0]))
+                self.__increment__(keys, delta=-1)
+                for table in tables:
+                    self.conn.execute("DELETE FROM %s WHERE graceid=?"%table, (graceid,))
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.generation += 1
+
+        for entry in entries:
+            self.graceid2node.pop(entry['graceid'], None)
+            directory = self.directory(entry['graceid'])
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+        self.__discard__(batch)
+
+    def size(self, graceid):
+        ans = super(SQLiteStorage, self).size(graceid)
+        ans += self.conn.execute("SELECT COALESCE(SUM(LENGTH(toplevel)), 0) FROM events WHERE graceid=?", (graceid,)).fetchone()[0]
+        for table in self.collections + self.optionalCollections:
+            ans += self.conn.execute("SELECT COALESCE(SUM(LENGTH(record)), 0) FROM %s WHERE graceid=?"%table, (graceid,)).fetchone()[0]
+        return ans
+
+    def reclaimable(self):
+        '''
+        pages SQLite freed when rows were deleted, which it reuses rather than returning to the filesystem
+        '''
+        return self.conn.execute("PRAGMA freelist_count").fetchone()[0] * self.conn.execute("PRAGMA page_size").fetchone()[0]
+
+#-------------------------------------------------
+
+storages = dict( (storage.name, storage) for storage in [PickleStorage, JournalStorage, SQLiteStorage] )
+
+def initStorage(name, directory, **kwargs):
+    '''
+    instantiate the storage backend associated with name
+    '''
+    if name not in storages:
+        raise ValueError('storage=%s not understood'%name)
+    return storages[name](directory, **kwargs)
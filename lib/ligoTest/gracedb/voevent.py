@@ -0,0 +1,164 @@
+description = "a module that builds VOEvent XML for FakeDb from per-event templates, so each VOEvent only fills in what changes between them"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import time
+
+from xml.sax.saxutils import escape, quoteattr
+
+from ligoTest.gracedb.footprints import gps2utc
+from ligoTest.gracedb.compat import basestring
+
+#-------------------------------------------------
+
+### what each type of VOEvent is called within the XML and the GCN packet type GraceDb reports for it
+__alertTypes__ = {
+    'PR' : ('Preliminary', 150),
+    'IN' : ('Initial', 151),
+    'UP' : ('Update', 152),
+    'RE' : ('Retraction', 164),
+}
+
+__instruments__ = {
+    'H1' : 'LIGO Hanford 4 km gravitational wave detector',
+    'L1' : 'LIGO Livingston 4 km gravitational wave detector',
+    'V1' : 'Virgo 3 km gravitational wave detector',
+}
+
+### optional kwargs of FakeDb.createVOEvent that we report as Params, along with their dataType
+__params__ = [
+    ('CoincComment',   'int'),
+    ('ProbHasNS',      'float'),
+    ('ProbHasRemnant', 'float'),
+    ('BNS',            'float'),
+    ('NSBH',           'float'),
+    ('BBH',            'float'),
+    ('MassGap',        'float'),
+    ('Terrestrial',    'float'),
+]
+
+### everything that depends only on the event is filled in by eventTemplate. Fields that change with each VOEvent are filled in by render
+__voeventFields__ = ['ivorn', 'date', 'packetType', 'internal', 'N', 'alertType', 'hardwareInj', 'openAlert', 'params']
+
+__template__ = '''<?xml version='1.0' encoding='UTF-8'?>
+<voe:VOEvent xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="2.0" role=%(role)s ivorn=%(ivorn)s xsi:schemaLocation="http://www.ivoa.net/xml/VOEvent/v2.0 http://www.ivoa.net/xml/VOEvent/VOEvent-v2.0.xsd">
+  <Who>
+    <Date>%(date)s</Date>
+    <Author>
+      <contactName>LIGO Scientific Collaboration and Virgo Collaboration</contactName>
+    </Author>
+  </Who>
+  <What>
+    <Param dataType="int" name="Packet_Type" value="%(packetType)s"/>
+    <Param dataType="int" name="internal" value="%(internal)s"/>
+    <Param dataType="int" name="Pkt_Ser_Num" ucd="meta.number" value="%(N)s"/>
+    <Param dataType="string" name="GraceID" ucd="meta.id" value=%(graceid)s/>
+    <Param dataType="string" name="AlertType" ucd="meta.version" value="%(alertType)s"/>
+    <Param dataType="int" name="HardwareInj" ucd="meta.number" value="%(hardwareInj)s"/>
+    <Param dataType="int" name="OpenAlert" ucd="meta.number" value="%(openAlert)s"/>
+    <Param dataType="string" name="EventPage" ucd="meta.ref.url" value=%(eventPage)s/>
+    <Param dataType="string" name="Instruments" ucd="meta.code" value=%(instruments)s/>
+    <Param dataType="float" name="FAR" ucd="arith.rate;stat.falsealarm" unit="Hz" value=%(far)s/>
+    <Param dataType="string" name="Group" ucd="meta.code" value=%(group)s/>
+    <Param dataType="string" name="Pipeline" ucd="meta.code" value=%(pipeline)s/>
+    <Param dataType="string" name="Search" ucd="meta.code" value=%(search)s/>
+%(params)s  </What>
+  <WhereWhen>
+    <ObsDataLocation>
+      <ObservatoryLocation id="LIGO Virgo"/>
+      <ObservationLocation>
+        <AstroCoordSystem id="UTC-FK5-GEO"/>
+        <AstroCoords coord_system_id="UTC-FK5-GEO">
+          <Time unit="s">
+            <TimeInstant>
+              <ISOTime>%(isotime)s</ISOTime>
+            </TimeInstant>
+          </Time>
+        </AstroCoords>
+      </ObservationLocation>
+    </ObsDataLocation>
+  </WhereWhen>
+  <How>
+    <Description>Candidate gravitational wave event identified by low-latency analysis</Description>
+%(how)s  </How>
+  <Description>Report of a candidate gravitational wave event</Description>
+</voe:VOEvent>
+'''
+
+#-------------------------------------------------
+
+def alertType(voevent_type):
+    '''
+    the name (eg: "Preliminary") and GCN packet type of a VOEvent type (eg: "PR")
+    '''
+    return __alertTypes__[voevent_type]
+
+def __attr__(value):
+    '''
+    an XML attribute value (with quotes) that survives being used as a template. None becomes an empty string
+    '''
+    return quoteattr('' if value is None else '%s'%value).replace('%', '%%')
+
+def eventTemplate(graceid, event, eventPage):
+    '''
+    fill everything that depends only on the event (a dictionary of its top-level data) into the VOEvent template.
+    what we return is itself a template for render. Events never change once they are created, so callers can build this once per event and keep it
+    '''
+    gpstime = event.get('gpstime')
+    if gpstime is None:
+        isotime = ''
+    else: ### keep the fractional second, which gps2utc drops
+        isotime = '%s.%06d'%(gps2utc(int(gpstime)), int(round((gpstime%1)*1e6)) % 1000000)
+
+    instruments = event.get('instruments') or ''
+    fields = dict((name, '%%(%s)s'%name) for name in __voeventFields__)
+    fields.update( {'graceid'     : __attr__(graceid),
+                    'eventPage'   : __attr__(eventPage),
+                    'instruments' : __attr__(instruments),
+                    'role'        : '"test"' if ('%s'%event.get('group')).lower()=='test' else '"observation"',
+                    'far'         : __attr__(event.get('far', event.get('FAR'))), ### some pipelines report "FAR" instead of "far"
+                    'group'       : __attr__(event.get('group')),
+                    'pipeline'    : __attr__(event.get('pipeline')),
+                    'search'      : __attr__(event.get('search')),
+                    'isotime'     : isotime,
+                    'how'         : ''.join('    <Description>%s</Description>\n'%escape(__instruments__.get(ifo, ifo)).replace('%', '%%') for ifo in instruments.split(',') if ifo),
+                   }
+                 )
+    return __template__%fields
+
+def __flag__(value):
+    '''
+    0 or 1 from a bool, a number or a string (form-encoded requests send "true" or "1")
+    '''
+    if isinstance(value, basestring):
+        return int(value.strip().lower() in ['1', 'true', 't', 'yes'])
+    return int(bool(value))
+
+def render(template, graceid, N, voevent_type, internal=1, hardware_inj=0, open_alert=0, skymap_type=None, skymap_filename=None, **kwargs):
+    '''
+    fill in the fields of a template from eventTemplate that change with each VOEvent. kwargs may hold any of the probabilities and flags GraceDb reports (ProbHasNS, BNS, ...).
+    returns the ivorn and the XML
+    '''
+    name, packetType = alertType(voevent_type)
+    ivorn = 'ivo://gwnet/LVC#%s-%d-%s'%(graceid, N, name)
+
+    params = ''
+    if skymap_filename and (voevent_type!='RE'):
+        params += '    <Group type="GW_SKYMAP" name=%s>\n'%quoteattr(skymap_type or '')
+        params += '      <Param dataType="string" name="skymap_fits" ucd="meta.ref.url" value=%s/>\n'%quoteattr(skymap_filename)
+        params += '    </Group>\n'
+    for param, dataType in __params__:
+        if kwargs.get(param) is not None:
+            params += '    <Param dataType="%s" name="%s" value=%s/>\n'%(dataType, param, quoteattr('%s'%kwargs[param]))
+
+    return ivorn, template%{'ivorn'       : quoteattr(ivorn),
+                            'date'        : time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+                            'packetType'  : packetType,
+                            'internal'    : __flag__(internal),
+                            'N'           : N,
+                            'alertType'   : name,
+                            'hardwareInj' : __flag__(hardware_inj),
+                            'openAlert'   : __flag__(open_alert),
+                            'params'      : params,
+                           }
@@ -47,7 +47,7 @@ def alert2listener( node, message, node2cmd={}, verbose=False, dont_wait=False )
     forks a process via subprocess
     used within lvalertTest_listen
     '''
-    if node2cmd.has_key(node):
+    if node in node2cmd:
         if dont_wait:
             file_obj = tempfile.SpooledTemporaryFile(mode="w+r", max_size=1000)
             file_obj.write(message)
@@ -61,7 +61,7 @@ def alert2listener( node, message, node2cmd={}, verbose=False, dont_wait=False )
             file_obj.close()
 
         else:
-            print sp.Popen( node2cmd[node], stdin=sp.PIPE, stdout=sp.PIPE ).communicate(message)[0] ### we don't capture the output because lvalert_listen does not
+            print( sp.Popen( node2cmd[node], stdin=sp.PIPE, stdout=sp.PIPE ).communicate(message)[0] ) ### we don't capture the output because lvalert_listen does not
 
 def alert2server( node, message, username=None, netrc=None, server='lvalert.cgca.uwm.edu', resource=None, max_attempts=None, verbose=False ):
     '''
@@ -94,7 +94,7 @@ def alert2interactiveQueue( node, message, node2proc={}, verbose=False):
     pushes alert through multiprocessing connection to child process
     used within lvalertTest_listenMP
     '''
-    if node2proc.has_key(node):
+    if node in node2proc:
         proc, conn, mp_child_name = node2proc[node]
         if not proc.is_alive():
             for proc, conn, mp_child_name in node2proc.values():
@@ -147,6 +147,7 @@ class LVAlertBuffer():
 class FileMonitor():
     '''
     wraps around a file and knows how to monitor it for changes as well as extract those changes
+    if the file is rotated (renamed away and replaced by a new file, see ligoTest.gracedb.retention), we finish reading the old one and then read the new one from the start
     WARNING: holds an open file object in 'r' mode. This may cause issues if we have too many of these things...
     '''
 
@@ -155,14 +156,27 @@ class FileMonitor():
             raise ValueError('could not find filename=%s'%filename)
         self.filename = filename
         self.file_obj = open(filename, 'r')
+        self.inode = os.fstat(self.file_obj.fileno()).st_ino
         self.file_obj.seek(0, 2) ### go to end of file
         self.setTimestamp()
 
     def getTimestamp(self):
         '''
-        queries the timestamp associated with this file
+        queries the timestamp associated with this file. Returns None if the file is missing (eg: while it is rotated)
         '''
-        return os.path.getmtime(self.filename)
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None
+
+    def wasRotated(self):
+        '''
+        determines whether filename now refers to a different file than the one we are reading
+        '''
+        try:
+            return os.stat(self.filename).st_ino!=self.inode
+        except OSError: ### not replaced yet
+            return False
 
     def setTimestamp(self):
         '''
@@ -174,16 +188,31 @@ class FileMonitor():
         '''
         determines whether the file has been modified
         '''
-        return self.timestamp!=self.getTimestamp()
+        return self.wasRotated() or (self.timestamp!=self.getTimestamp())
 
     def extract(self):
         '''
         extracts the new messages and returns them
         '''
-        line = self.file_obj.readline().strip()
         nodeMessage = []
-        while line:
-            nodeMessage.append( line2alert(line) )
-            line = self.file_obj.readline().strip()
+        if self.wasRotated(): ### writers append to the old file until it is replaced, so whatever is left in it is complete
+            nodeMessage += self.__extract__()
+            self.file_obj.close()
+            self.file_obj = open(self.filename, 'r')
+            self.inode = os.fstat(self.file_obj.fileno()).st_ino
+        return nodeMessage + self.__extract__()
+
+    def __extract__(self):
+        '''
+        the complete messages written since we last read self.file_obj
+        '''
+        nodeMessage = []
+        line = self.file_obj.readline()
+        while line.strip():
+            if not line.endswith("\n"): ### someone is still writing this line, so we back up and pick it up next time
+                self.file_obj.seek(-len(line), 1)
+                break
+            nodeMessage.append( line2alert(line.strip()) )
+            line = self.file_obj.readline()
 
         return nodeMessage
@@ -143,6 +143,36 @@ class Schedule(object):
         for action in self.actions:
             action.setExpiration( t0 )
 
+    def coalesce(self):
+        '''
+        merges WriteLog actions that are scheduled at the same time for the same event into a single WriteLogs action
+        so that coincident uploads are applied (and announced) together. Only runs of WriteLogs with no other action for that event between them are merged
+        '''
+        actions = []
+        batches = {}
+        for action in self.actions:
+            if batches and (action.dt!=actions[-1].dt): ### we only merge actions with the same dt, and self.actions is ordered by dt
+                batches = {}
+
+            if isinstance(action, WriteLog):
+                key = (id(action.graceDBevent), action.gdb_url, action.expiration)
+                if batches.has_key(key):
+                    batches[key].add( action )
+                    continue
+                else:
+                    batch = WriteLogs.fromWriteLog( action )
+                    batches[key] = batch
+                    action = batch
+
+            elif hasattr(action, 'graceDBevent'): ### any other action for this event ends its runs of WriteLogs so nothing is reordered around it
+                for key in [key for key in batches.keys() if key[0]==id(action.graceDBevent)]:
+                    batches.pop(key)
+
+            actions.append( action )
+
+        ### replace batches that only contain a single WriteLog with the original action
+        self.actions = [action.actions[0] if isinstance(action, WriteLogs) and (len(action.actions)==1) else action for action in actions]
+
 #-------------------------------------------------
 
 class CreateEvent(Action):
@@ -259,6 +289,47 @@ class WriteLog(Action):
         httpResponse = gdb.writeLog( self.graceDBevent.get_graceid(), self.message, filename=self.filename, tagname=self.tagname )
         return httpResponse
 
+class WriteLogs(Action):
+    '''
+    write several log messages for the same event at the same time
+    '''
+    def __init__(self, dt, graceDBevent, logs=[], gdb_url='https://gracedb.ligo.org/api'):
+        self.graceDBevent = graceDBevent
+        self.gdb_url = gdb_url
+
+        self.actions = [] ### the WriteLog actions we've merged
+        for message, filename, tagname in logs:
+            self.add( WriteLog( dt, graceDBevent, message, filename=filename, tagname=tagname, gdb_url=gdb_url ) )
+
+        super(WriteLogs, self).__init__(dt, self.writeLogs)
+
+    @staticmethod
+    def fromWriteLog(action):
+        batch = WriteLogs( action.dt, action.graceDBevent, gdb_url=action.gdb_url )
+        batch.expiration = action.expiration
+        batch.add( action )
+        return batch
+
+    def add(self, action):
+        self.actions.append( action )
+
+    def __str__(self):
+        return """WriteLogs -> %s
+    randStr    : %s
+    graceid    : %s
+    messages   : %s
+    filenames  : %s
+    tagnames   : %s
+    timeout    : %.3f
+    expiration : %s"""%(self.gdb_url, self.graceDBevent.get_randStr(), self.graceDBevent.get_graceid(force=True), [a.message for a in self.actions], [a.filename for a in self.actions], [a.tagname for a in self.actions], self.dt, "%.3f"%self.expiration if self.expiration else "None")
+
+    def writeLogs(self, *args, **kwargs):
+        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
+        if hasattr(gdb, 'writeLogs'): ### FakeDb can do this all at once
+            return gdb.writeLogs( self.graceDBevent.get_graceid(), [(a.message, a.filename, a.tagname) for a in self.actions] )
+        else: ### real GraceDb does not, so we fall back to one message at a time
+            return FakeTTPResponse( [a.writeLog().json() for a in self.actions] ) ### NOTE: a single response listing every log message, just like FakeDb.writeLogs
+
 class WriteFile(Action):
     '''
     write a file. 